@@ -8,7 +8,7 @@ from sqlalchemy.orm import sessionmaker
 
 
 from adbot.domain.events import AdBotStop
-from adbot.domain import models
+from adbot.domain import migrations
 from adbot.domain.services import AdBotServices
 from adbot.presentation.telegram.tg_bot import TGBot
 from adbot.presentation.presentation_interface import PresentationInterface
@@ -80,11 +80,24 @@ class AdBotApp(AsyncMixin):
     async def _db_connect(self) -> sessionmaker:
         engine = create_async_engine(config.get_db_dsn(), pool_pre_ping=True)
         async with engine.begin() as conn:
-            await conn.run_sync(models.Base.metadata.create_all)
+            await conn.run_sync(migrations.run_migrations)
         return async_sessionmaker(bind=engine, expire_on_commit=False)
 
     async def _create_ad_bot_services(self, db_pool: sessionmaker) -> AdBotServices:
-        return await AdBotServices(db_pool)
+        return await AdBotServices(
+            db_pool,
+            matching_workers=config.MATCHING_WORKERS,
+            duplicates_window_minutes=config.DUPLICATES_WINDOW_MINUTES,
+            near_duplicates_threshold=config.NEAR_DUPLICATES_THRESHOLD,
+            retention_days=config.RETENTION_DAYS,
+            retention_max_messages=config.RETENTION_MAX_MESSAGES,
+            archive_dir=config.ARCHIVE_DIR or None,
+            digest_interval_minutes=config.DIGEST_INTERVAL_MINUTES,
+            digest_max_messages=config.DIGEST_MAX_MESSAGES,
+            messagebus_workers=config.MESSAGEBUS_WORKERS,
+            messagebus_queue_size=config.MESSAGEBUS_QUEUE_SIZE,
+            messagebus_partitions=config.MESSAGEBUS_PARTITIONS
+        )
 
     def _create_tg_bot(self, ad_bot_services: AdBotServices) -> PresentationInterface:
         tg_bot = TGBot(
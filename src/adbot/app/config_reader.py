@@ -38,6 +38,36 @@ class Settings(BaseSettings):
     API_HASH: SecretStr
     PHONE: str
 
+    # Number of worker processes for keyword matching (0 - match in the main process)
+    MATCHING_WORKERS: int = 0
+
+    # Messages with the same text as a message added less than this number of minutes
+    # earlier are not forwarded (0 - disabled)
+    DUPLICATES_WINDOW_MINUTES: int = 24 * 60
+    # Messages with similarity (0..1) to such message not less than this value are not
+    # forwarded to users who received that message
+    NEAR_DUPLICATES_THRESHOLD: float = 0.7
+
+    # Processed messages older than this number of days and messages beyond the newest
+    # RETENTION_MAX_MESSAGES messages are deleted (0 - no limit)
+    RETENTION_DAYS: int = 0
+    RETENTION_MAX_MESSAGES: int = 0
+    # Directory to archive deleted messages ('' - don't archive)
+    ARCHIVE_DIR: str = ''
+
+    # Users in digest mode receive queued messages in one message every
+    # DIGEST_INTERVAL_MINUTES minutes or when DIGEST_MAX_MESSAGES messages are queued
+    DIGEST_INTERVAL_MINUTES: int = 30
+    DIGEST_MAX_MESSAGES: int = 20
+
+    # Number of concurrent event handlers (0 - run every handler in its own task without
+    # limit) and the max number of queued events of one type
+    MESSAGEBUS_WORKERS: int = 0
+    MESSAGEBUS_QUEUE_SIZE: int = 1000
+    # Max number of users whose events are handled concurrently in ordered lanes
+    # (events of one user are handled in order, 0 - disabled)
+    MESSAGEBUS_PARTITIONS: int = 0
+
     # Testing config
     TESTBOT_NAME: str = ''
     CLIENT_ID: int = 0
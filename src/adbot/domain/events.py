@@ -1,17 +1,33 @@
 from dataclasses import dataclass
+from datetime import datetime
+from typing import Hashable, Optional
 
 
 class AdBotEvent:
-    pass
+    # Name of attribute that is used as partition key: events with the same key are
+    # handled in order (see `MessageBus`). None - no key.
+    partition_key_attr: Optional[str] = None
+    # Interactive events (updates of user's menu) are handled before queued bulk
+    # events and are ordered separately from them (see `MessageBus`)
+    interactive: bool = False
+
+    def partition_key(self) -> Optional[Hashable]:
+        if self.partition_key_attr is None:
+            return None
+        return getattr(self, self.partition_key_attr)
 
 
 @dataclass
 class AdBotUserDataUpdated(AdBotEvent):
+    partition_key_attr = 'user_id'
+    interactive = True
     user_id: int
 
 
 @dataclass
 class AdBotInactivityTimeout(AdBotEvent):
+    partition_key_attr = 'user_id'
+    interactive = True
     user_id: int
 
 
@@ -22,10 +38,31 @@ class AdBotCriticalError(AdBotEvent):
 
 @dataclass
 class AdBotMessageForwardRequest(AdBotEvent):
+    partition_key_attr = 'user_id'
     user_id: int
     telegram_id: int
     message_url: str
     message_text: str
+    # timestamps for latency tracing
+    fetched_dt: Optional[datetime] = None
+    added_dt: Optional[datetime] = None
+    processed_dt: Optional[datetime] = None
+    requested_dt: Optional[datetime] = None
+    outbox_id: Optional[int] = None     # id of outbox entry to acknowledge
+
+
+@dataclass
+class AdBotDigestForwardRequest(AdBotEvent):
+    partition_key_attr = 'user_id'
+    user_id: int
+    telegram_id: int
+    message_urls: list[str]
+    # timestamps of the oldest message for latency tracing
+    fetched_dt: Optional[datetime] = None
+    added_dt: Optional[datetime] = None
+    requested_dt: Optional[datetime] = None
+    outbox_id: Optional[int] = None     # id of outbox entry to acknowledge
+
 
 @dataclass
 class AdBotStop(AdBotEvent):
@@ -0,0 +1,93 @@
+from collections.abc import Iterable
+
+from .keyword_matcher import KeywordMatcher
+
+
+class KeywordIndex:
+    """
+        In-memory index of keywords of subscribed users (keyword -> set of user ids)
+        with the compiled `KeywordMatcher` for this set of keywords.
+        Keeps keyword lists of all the users (subscribed or not), so that changes of
+        subscription state can be applied without reading DB.
+        Index is updated by deltas (`add_keyword`, `remove_keyword`,
+        `set_subscription_state`), matcher is patched in place.
+        `generation` is the value of the DB generation counter this index corresponds
+        to.
+    """
+
+    def __init__(self):
+        self.generation: int | None = None
+        self._user_keywords: dict[int, set[str]] = {}
+        self._subscribers: dict[str, set[int]] = {}
+        self.matcher = KeywordMatcher()
+
+
+    def load(
+        self, rows: Iterable[tuple[int, str, bool]], generation: int | None
+    ) -> None:
+        """
+            Replaces index data with `rows` (user_id, keyword, subscription_state).
+        """
+        self._user_keywords = {}
+        self._subscribers = {}
+        for user_id, keyword, subscription_state in rows:
+            self._user_keywords.setdefault(user_id, set()).add(keyword)
+            if subscription_state:
+                self._subscribers.setdefault(keyword, set()).add(user_id)
+        self.matcher = KeywordMatcher(self._subscribers.keys())
+        self.generation = generation
+
+
+    def subscribers(self, keyword: str) -> set[int]:
+        return self._subscribers.get(keyword, set())
+
+
+    def as_dict(self) -> dict[str, set[int]]:
+        """
+            Returns dict of keywords of subscribed users, where key is keyword and value
+            is set of users ids.
+        """
+        return self._subscribers
+
+
+    def add_keyword(self, user_id: int, keyword: str, subscription_state: bool) -> None:
+        self._user_keywords.setdefault(user_id, set()).add(keyword)
+        if subscription_state:
+            self._add_subscriber(keyword, user_id)
+
+
+    def remove_keyword(self, user_id: int, keyword: str) -> None:
+        user_keywords = self._user_keywords.get(user_id)
+        if user_keywords is None:
+            return
+        user_keywords.discard(keyword)
+        if not user_keywords:
+            self._user_keywords.pop(user_id)
+        self._remove_subscriber(keyword, user_id)
+
+
+    def set_subscription_state(self, user_id: int, new_state: bool) -> None:
+        if new_state:
+            for keyword in self._user_keywords.get(user_id, ()):
+                self._add_subscriber(keyword, user_id)
+        else:
+            for keyword in self._user_keywords.get(user_id, ()):
+                self._remove_subscriber(keyword, user_id)
+
+
+    def _add_subscriber(self, keyword: str, user_id: int) -> None:
+        users = self._subscribers.get(keyword)
+        if users is None:
+            users = self._subscribers[keyword] = set()
+            self.matcher.add(keyword)
+        users.add(user_id)
+
+
+    def _remove_subscriber(self, keyword: str, user_id: int) -> None:
+        users = self._subscribers.get(keyword)
+        if users is None:
+            return
+        users.discard(user_id)
+        if not users:
+            self._subscribers.pop(keyword)
+            self.matcher.remove(keyword)
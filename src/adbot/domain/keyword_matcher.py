@@ -0,0 +1,139 @@
+from collections import deque
+from collections.abc import Iterable
+
+
+class KeywordMatcher:
+    """
+        Multi-pattern substring matcher (Aho-Corasick automaton).
+        Finds all the keywords that occur in the text in one pass over the text.
+        Semantics are the same as `keyword in text` for every keyword (empty keyword
+        matches any text). Matching is case-sensitive, callers have to normalize the
+        case of keywords and texts themselves.
+        Keywords can be added and removed in place. Removing only unmarks the trie
+        node, adding recalculates the links lazily (on the next search). The trie is
+        rebuilt from scratch when too many removed nodes are accumulated.
+    """
+
+    def __init__(self, keywords: Iterable[str] = ()):
+        self._build(keywords)
+
+
+    def __len__(self) -> int:
+        return len(self._keywords)
+
+
+    def __contains__(self, keyword: str) -> bool:
+        return keyword in self._keywords
+
+
+    @property
+    def keywords(self) -> frozenset[str]:
+        return frozenset(self._keywords)
+
+
+    def add(self, keyword: str) -> None:
+        """
+            Adds keyword to the matcher. Does nothing if keyword is already added.
+        """
+        if keyword not in self._keywords:
+            self._insert(keyword)
+            self._links_outdated = True
+
+
+    def remove(self, keyword: str) -> None:
+        """
+            Removes keyword from the matcher. Does nothing if keyword wasn't added.
+        """
+        if keyword not in self._keywords:
+            return
+        node = 0
+        for ch in keyword:
+            node = self._goto[node][ch]
+        self._word[node] = None
+        self._keywords.remove(keyword)
+        self._removed_cnt += 1
+        if self._removed_cnt > max(len(self._keywords), 100):
+            self._build(list(self._keywords))
+
+
+    def find_all(self, text: str) -> set[str]:
+        """
+            Returns the set of keywords that occur in `text`.
+        """
+        if self._links_outdated:
+            self._build_links()
+        goto = self._goto
+        fail = self._fail
+        out = self._out
+        word = self._word
+        found = set()
+        if word[0] is not None:
+            found.add(word[0])
+        node = 0
+        for ch in text:
+            while True:
+                nxt = goto[node].get(ch)
+                if nxt is not None:
+                    node = nxt
+                    break
+                if node == 0:
+                    break
+                node = fail[node]
+            hit = node if word[node] is not None else out[node]
+            while hit:
+                if word[hit] is not None:   # None if keyword was removed
+                    found.add(word[hit])
+                hit = out[hit]
+        return found
+
+
+    def _build(self, keywords: Iterable[str]) -> None:
+        self._goto: list[dict[str, int]] = [{}]     # transitions of trie nodes
+        self._fail: list[int] = [0]                 # failure links
+        self._out: list[int] = [0]      # nearest node on the failure chain with keyword
+        self._word: list[str | None] = [None]       # keyword ending at this node
+        self._keywords: set[str] = set()
+        self._removed_cnt = 0
+        for keyword in keywords:
+            self._insert(keyword)
+        self._build_links()
+
+
+    def _insert(self, keyword: str) -> None:
+        if keyword in self._keywords:
+            return
+        node = 0
+        for ch in keyword:
+            nxt = self._goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(0)
+                self._word.append(None)
+                self._goto[node][ch] = nxt
+            node = nxt
+        self._word[node] = keyword
+        self._keywords.add(keyword)
+
+
+    def _build_links(self) -> None:
+        """
+            Calculates failure links and output links (BFS over the trie).
+        """
+        queue = deque()
+        for child in self._goto[0].values():
+            self._fail[child] = 0
+            self._out[child] = 0
+            queue.append(child)
+        while queue:
+            node = queue.popleft()
+            for ch, child in self._goto[node].items():
+                f = self._fail[node]
+                while f and (ch not in self._goto[f]):
+                    f = self._fail[f]
+                f = self._goto[f].get(ch, 0)
+                self._fail[child] = f
+                self._out[child] = f if self._word[f] is not None else self._out[f]
+                queue.append(child)
+        self._links_outdated = False
@@ -0,0 +1,103 @@
+from bisect import bisect_left
+from datetime import datetime
+from typing import Optional
+
+# Upper bounds of histogram buckets (seconds): 1 ms, 2 ms, 4 ms, ... ~ 36 hours
+BUCKET_BOUNDS = tuple(0.001 * 2 ** i for i in range(28))
+
+# Stages of message's way from fetcher to user
+STAGE_FETCH_TO_ADD = 'fetch_to_add'             # fetcher pickup -> `add_message`
+STAGE_ADD_TO_PROCESS = 'add_to_process'         # `add_message` -> matched
+STAGE_PROCESS_TO_FORWARD = 'process_to_forward' # matched -> forward request posted
+STAGE_FORWARD_TO_SEND = 'forward_to_send'       # forward request posted -> sent
+STAGE_TOTAL = 'total'                           # fetcher pickup (or `add_message`)
+                                                # -> sent
+
+
+class LatencyHistogram:
+    """
+        Histogram of latencies with exponential buckets (`BUCKET_BOUNDS`).
+        Percentiles are estimated by the upper bound of the bucket (not more than
+        max registered value).
+    """
+
+    def __init__(self):
+        self._counts = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+
+    def record(self, seconds: float) -> None:
+        seconds = max(seconds, 0.0)
+        self._counts[bisect_left(BUCKET_BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+
+    def percentile(self, p: float) -> float:
+        """
+            Returns estimation of `p`-th percentile (0 < p <= 100) or 0.0 if histogram
+            is empty.
+        """
+        if self.count == 0:
+            return 0.0
+        rank = max(1, round(self.count * p / 100))
+        cnt = 0
+        for bucket, bucket_cnt in enumerate(self._counts):
+            cnt += bucket_cnt
+            if cnt >= rank:
+                break
+        if bucket < len(BUCKET_BOUNDS):
+            return min(BUCKET_BOUNDS[bucket], self.max)
+        return self.max
+
+
+    def summary(self) -> dict[str, float]:
+        return {
+            'count': self.count,
+            'mean': (self.total / self.count) if self.count else 0.0,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'max': self.max,
+        }
+
+
+class LatencyStats:
+    """
+        In-process latency histograms per stage.
+    """
+
+    def __init__(self):
+        self._histograms: dict[str, LatencyHistogram] = {}
+
+
+    def record(
+        self, stage: str, start_dt: Optional[datetime], end_dt: Optional[datetime] = None
+    ) -> None:
+        """
+            Records latency between `start_dt` and `end_dt` (now by default).
+            Does nothing if `start_dt` is None (timestamp wasn't set).
+        """
+        if start_dt is None:
+            return
+        if end_dt is None:
+            end_dt = datetime.now()
+        histogram = self._histograms.get(stage)
+        if histogram is None:
+            histogram = self._histograms[stage] = LatencyHistogram()
+        histogram.record((end_dt - start_dt).total_seconds())
+
+
+    def summary(self) -> dict[str, dict[str, float]]:
+        """
+            Returns dict where key is stage name and value is dict with the count of
+            records, mean, p50, p90, p99 and max latencies (seconds).
+        """
+        return {stage: h.summary() for stage, h in self._histograms.items()}
+
+
+    def reset(self) -> None:
+        self._histograms = {}
@@ -0,0 +1,87 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import multiprocessing
+from typing import Optional, Sequence
+
+from .keyword_matcher import KeywordMatcher
+
+logger = logging.getLogger(__name__)
+
+
+# Worker process state (copy of compiled keyword index)
+_worker_matcher: Optional[KeywordMatcher] = None
+_worker_generation: Optional[int] = None
+
+
+def _match_chunk(
+    generation: Optional[int], msgs: Sequence[tuple[int, str]],
+    keywords: Optional[list[str]] = None
+) -> Optional[list[tuple[int, list[str]]]]:
+    """
+        Runs in worker process. Matches messages (id, text) against worker's copy of
+        keywords index.
+        If `keywords` is passed, worker's index is rebuilt first.
+        Returns list of (message id, list of found keywords) or None if worker's index
+        is outdated (its generation differs from `generation`).
+    """
+    global _worker_matcher, _worker_generation
+    if keywords is not None:
+        _worker_matcher = KeywordMatcher(keywords)
+        _worker_generation = generation
+    elif (_worker_matcher is None) or (generation is None) or \
+            (generation != _worker_generation):
+        return None
+    return [
+        (msg_id, list(_worker_matcher.find_all(text.lower()))) for msg_id, text in msgs
+    ]
+
+
+class MatchingPool:
+    """
+        Matches messages against keywords in a pool of worker processes, so that
+        CPU-bound matching of large backlogs doesn't block the event loop.
+        Every worker keeps its own copy of compiled keyword index. Keywords are sent to
+        the worker only when the keywords generation changes (worker reports that its
+        index is outdated and the chunk is resent together with keywords).
+    """
+
+    def __init__(self, workers: int):
+        self._workers = workers
+        self._executor = ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context('spawn')
+        )
+
+
+    async def match(
+        self, msgs: Sequence[tuple[int, str]], keywords: Sequence[str],
+        generation: Optional[int]
+    ) -> list[tuple[int, list[str]]]:
+        """
+            Splits messages (id, text) into parts (one part per worker) and matches them
+            in worker processes.
+            `keywords` is the list of keywords that corresponds to `generation`.
+            Returns list of (message id, list of found keywords).
+        """
+        loop = asyncio.get_running_loop()
+        part_size = -(-len(msgs) // self._workers)
+        parts = [msgs[i:i + part_size] for i in range(0, len(msgs), part_size)]
+        send_keywords = list(keywords) if generation is None else None
+        results = await asyncio.gather(*[
+            loop.run_in_executor(
+                self._executor, _match_chunk, generation, part, send_keywords
+            ) for part in parts
+        ])
+        hits = []
+        for part, result in zip(parts, results):
+            if result is None:
+                logger.debug(f'Matching pool. Refresh keywords index ({generation=})')
+                result = await loop.run_in_executor(
+                    self._executor, _match_chunk, generation, part, list(keywords)
+                )
+            hits.extend(result)
+        return hits
+
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
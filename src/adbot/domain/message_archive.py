@@ -0,0 +1,123 @@
+from datetime import datetime
+import gzip
+import json
+import os
+from typing import Iterator, Optional
+
+SEGMENT_MAX_BYTES = 64 * 1024 * 1024
+INDEX_FILE_NAME = 'index.jsonl'
+
+
+class MessageArchive:
+    """
+        Append-only archive of deleted messages.
+        Messages are stored in segment files (`segment_<first message id>.jsonl.gz`),
+        every batch of messages is appended to the current segment as separate gzip
+        member with one JSON object per line. New segment is started when the size of
+        the current one exceeds `segment_max_bytes`.
+        Offset index (`index.jsonl`) has one line per batch: segment name, offset and
+        length of gzip member and the range of message ids, so that a batch can be read
+        without decompressing the whole segment.
+        Messages must be appended in the order of their ids.
+    """
+
+    def __init__(self, path: str, segment_max_bytes: int = SEGMENT_MAX_BYTES):
+        self._path = path
+        self._segment_max_bytes = segment_max_bytes
+        os.makedirs(path, exist_ok=True)
+        self._index = self._read_index()
+
+
+    def append(self, messages: list[dict]) -> None:
+        """
+            Appends batch of messages (dicts with JSON-serializable values except
+            `datetime`, that is stored in ISO format). Every message must have `id` key.
+        """
+        if not messages:
+            return
+        data = gzip.compress(
+            ''.join(
+                json.dumps(msg, ensure_ascii=False, default=_json_default) + '\n'
+                    for msg in messages
+            ).encode('utf-8')
+        )
+        segment = self._current_segment(messages[0]['id'])
+        segment_path = os.path.join(self._path, segment)
+        with open(segment_path, 'ab') as f:
+            offset = f.tell()
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        entry = {
+            'segment': segment,
+            'offset': offset,
+            'length': len(data),
+            'first_id': messages[0]['id'],
+            'last_id': messages[-1]['id'],
+            'count': len(messages),
+        }
+        with open(os.path.join(self._path, INDEX_FILE_NAME), 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+        self._index.append(entry)
+
+
+    def get(self, msg_id: int) -> Optional[dict]:
+        """
+            Returns archived message by id or None if it's not found.
+        """
+        for entry in self._index:
+            if entry['first_id'] <= msg_id <= entry['last_id']:
+                for msg in self._read_batch(entry):
+                    if msg['id'] == msg_id:
+                        return msg
+        return None
+
+
+    def iter_messages(self) -> Iterator[dict]:
+        for entry in self._index:
+            yield from self._read_batch(entry)
+
+
+    def __len__(self) -> int:
+        return sum(entry['count'] for entry in self._index)
+
+
+    def _current_segment(self, first_id: int) -> str:
+        if self._index:
+            segment = self._index[-1]['segment']
+            segment_path = os.path.join(self._path, segment)
+            if os.path.getsize(segment_path) < self._segment_max_bytes:
+                return segment
+        return f'segment_{first_id:012d}.jsonl.gz'
+
+
+    def _read_batch(self, entry: dict) -> list[dict]:
+        with open(os.path.join(self._path, entry['segment']), 'rb') as f:
+            f.seek(entry['offset'])
+            data = gzip.decompress(f.read(entry['length']))
+        return [json.loads(line) for line in data.decode('utf-8').splitlines()]
+
+
+    def _read_index(self) -> list[dict]:
+        index_path = os.path.join(self._path, INDEX_FILE_NAME)
+        if not os.path.exists(index_path):
+            return []
+        index = []
+        with open(index_path) as f:
+            lines = f.readlines()
+        for line in lines:
+            try:
+                index.append(json.loads(line))
+            except json.JSONDecodeError:
+                # Incomplete line written before crash. Data of this batch is not
+                # lost (messages are deleted from DB after archiving), rewrite index
+                with open(index_path, 'w') as f:
+                    f.writelines(json.dumps(entry) + '\n' for entry in index)
+                break
+        return index
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f'Object of type {value.__class__.__name__} is not serializable')
@@ -1,8 +1,9 @@
 import  asyncio
 from collections import deque
 from collections.abc import Awaitable, Callable
+from dataclasses import dataclass
 import logging
-from typing import Sequence, TypeAlias
+from typing import Hashable, Optional, Sequence, TypeAlias
 
 from .events import AdBotEvent
 
@@ -10,16 +11,108 @@ logger = logging.getLogger(__name__)
 
 EventHandler: TypeAlias = Callable[[AdBotEvent], Awaitable[None]]
 
+EVENT_QUEUE_SIZE = 1000     # max number of queued handler calls per event type
+DEAD_LETTERS_MAX_LEN = 1000 # oldest failed handler calls are dropped
+
 
 class MessageBusException(Exception):
     pass
 
 
+@dataclass
+class DeadLetter:
+    handler: EventHandler
+    event: AdBotEvent
+    error: Exception
+    retries: int    # number of retries before the last failure
+
+
+class _WorkersPool:
+    """
+        Limits the number of concurrently running handler calls by `workers`.
+        Waiting calls of interactive events (see `AdBotEvent.interactive`) get free
+        workers before waiting calls of other events.
+    """
+
+    def __init__(self, workers: int):
+        self._free = workers
+        self._waiters: dict[bool, deque[asyncio.Future]] = {True: deque(), False: deque()}
+
+
+    async def acquire(self, interactive: bool) -> None:
+        if self._free > 0:
+            self._free -= 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[interactive].append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and (not waiter.cancelled()):
+                self.release()      # worker was passed to cancelled call
+            raise
+
+
+    def release(self) -> None:
+        for interactive in (True, False):
+            waiters = self._waiters[interactive]
+            while waiters:
+                waiter = waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result(None)     # worker is passed to waiting call
+                    return
+        self._free += 1
+
+
 class MessageBus:
+    """
+        Delivers events to subscribed handlers.
+        If `workers` is 0, every handler call is run in its own asyncio task as soon as
+        event is posted.
+        Otherwise handler calls are queued in bounded queues (one queue per event type,
+        up to `queue_size` calls) and run by the pool of `workers` concurrent tasks.
+        If `partitions` > 0, handler calls for events with partition key (see
+        `AdBotEvent.partition_key`) are queued in the ordered lane of this key and run
+        one by one, so that events with the same key are handled in order and events
+        with different keys are handled concurrently. Lanes exist while they have
+        queued calls, up to `partitions` lanes are run at a time (others wait for free
+        lane) and up to `queue_size` calls are queued in lanes for interactive events
+        and the same number for other events (see `AdBotEvent.interactive`), so that
+        interactive events don't wait behind bulk ones. Handler calls of lanes are run
+        by the pool of `workers` too. Interactive events get free workers first.
+        `publish` waits while the queue is full, so that producers are slowed down
+        instead of piling up tasks. Handlers shouldn't publish
+        events of the type they handle (it can deadlock when the queue is full).
+        Failed handler calls are retried up to `max_retries` times and then put to
+        `dead_letters` (see `retry_dead_letters`).
+    """
 
-    def __init__(self):
+    def __init__(
+        self, workers: int = 0, queue_size: int = EVENT_QUEUE_SIZE, partitions: int = 0,
+        max_retries: int = 0
+    ):
         self._subscribers: dict[EventHandler, set[str]] = {}
-        self._queue: deque[asyncio.Task] = deque()
+        # Handlers subscribed to event type and handlers of event type including
+        # handlers subscribed to its base classes (built on first dispatch)
+        self._type_handlers: dict[type, list[EventHandler]] = {}
+        self._dispatch_table: dict[type, tuple[EventHandler, ...]] = {}
+        self._tasks: set[asyncio.Task] = set()  # running handler tasks
+        self._workers = workers
+        self._queue_size = queue_size
+        self._queues: dict[str, asyncio.Queue] = {}     # event type -> queue
+        self._dispatchers: list[asyncio.Task] = []
+        self._workers_pool: Optional[_WorkersPool] = None
+        if workers > 0:
+            self._workers_pool = _WorkersPool(workers)
+        self._partitions = partitions
+        # Ordered lanes: (interactive, partition key) -> queued handler calls
+        self._lanes: dict[tuple[bool, Hashable], deque] = {}
+        self._lane_tasks: set[asyncio.Task] = set()
+        self._lanes_semaphores: dict[bool, asyncio.Semaphore] = {}   # running lanes
+        self._lane_calls_cnt: dict[bool, int] = {False: 0, True: 0}  # queued calls
+        self._lane_calls_freed: dict[bool, asyncio.Event] = {}
+        self._max_retries = max_retries
+        self.dead_letters: deque[DeadLetter] = deque(maxlen=DEAD_LETTERS_MAX_LEN)
 
 
     def subscribe(self, events: Sequence[AdBotEvent], handler: EventHandler) -> None:
@@ -45,42 +138,79 @@ class MessageBus:
             logger.error(f"Messagebus. Duplicated handler: {handler}")
             raise MessageBusException(f"Duplicated handler: {handler}")
         self._subscribers[handler] = event_types
+        for event in events:
+            self._type_handlers.setdefault(event, []).append(handler)
+        self._dispatch_table = {}
 
 
     def post_event(self, event: AdBotEvent) -> None:
         """
             Posts the event. Starts asyncio task to process this event by each subsrcibed
-            handler.
+            handler (or puts handler calls to the queue if the pool of workers or
+            ordered lanes are used).
+            If the queue is full, handler call is put to the queue by separate task
+            (use `publish` to wait instead). Handler calls are put to ordered lanes
+            without waiting even if `queue_size` calls are queued there.
         """
-        logger.debug(f'Messagebus. Event posted: {event.__class__.__name__}')
-        catched = False
-        event_cls = event.__class__.__name__
-        for handler, events_str in self._subscribers.items():
-            if event_cls in events_str:
-                logger.debug(
-                    f'Messagebus. Event {event.__class__.__name__} handled by handler' \
-                        ' {handler}'
+        for handler in self._get_handlers(event):
+            lane_key = self._get_lane_key(event)
+            if lane_key is not None:
+                self._append_to_lane(lane_key, (handler, event, 0))
+                continue
+            queue = self._get_target_queue(event)
+            if queue is None:
+                self._add_task(self._run_handler(handler, event, 0))
+                continue
+            try:
+                queue.put_nowait((handler, event, 0))
+            except asyncio.QueueFull:
+                logger.warning(
+                    'Messagebus. Queue of %s is full', event.__class__.__name__
                 )
-                catched = True
-                self._queue.append(asyncio.create_task(handler(event)))
-        if not catched:
-            logger.warning(
-                f'Messagebus. Handlers not found for event {event.__class__.__name__}'
+                self._add_task(queue.put((handler, event, 0)))
+
+
+    async def publish(self, event: AdBotEvent) -> None:
+        """
+            Posts the event. If the pool of workers or ordered lanes are used, waits
+            while the queue is full.
+        """
+        for handler in self._get_handlers(event):
+            await self._put(handler, event, 0)
+
+
+    async def retry_dead_letters(self) -> int:
+        """
+            Posts failed handler calls from `dead_letters` again (their retry counters
+            are incremented).
+            Returns the number of posted handler calls.
+        """
+        dead_letters = list(self.dead_letters)
+        self.dead_letters.clear()
+        for dead_letter in dead_letters:
+            await self._put(
+                dead_letter.handler, dead_letter.event, dead_letter.retries + 1
             )
-        
-        # pop finished tasks from queue
-        while self._queue and self._queue[0].done():
-            self._queue.popleft()
+        return len(dead_letters)
+
+
+    def get_queue_sizes(self) -> dict[str, int]:
+        """
+            Returns the number of queued handler calls per event type.
+        """
+        return {event_cls: queue.qsize() for event_cls, queue in self._queues.items()}
 
 
     async def wait_for_tasks_done(self):
         logger.debug(f'Waiting for tasks in messagebus queue to be done')
-        tasks = asyncio.gather(*self._queue, return_exceptions=True)
+        tasks = asyncio.ensure_future(self._wait_all())
         
         try:
             await asyncio.wait_for(tasks, timeout=10)
         except (asyncio.TimeoutError, asyncio.exceptions.CancelledError):
             logger.error(f'Some tasks in messagebus queue were cancelled')
+            for task in self._tasks:
+                task.cancel()
         else:
             logger.debug(f'All tasks in messagebus queue are done')
             return
@@ -89,5 +219,220 @@ class MessageBus:
             await tasks
         except asyncio.exceptions.CancelledError:
             pass
-           
 
+
+    def stop(self) -> None:
+        """
+            Stops the pool of workers and ordered lanes. Queued handler calls are
+            cancelled.
+        """
+        for task in [*self._dispatchers, *self._lane_tasks]:
+            task.cancel()
+        self._dispatchers = []
+        self._queues = {}
+        self._lanes = {}
+        self._lane_tasks = set()
+        self._lanes_semaphores = {}
+        self._lane_calls_cnt = {False: 0, True: 0}
+        self._lane_calls_freed = {}
+
+
+    async def _wait_all(self) -> None:
+        while True:
+            await asyncio.gather(
+                *self._tasks, *self._lane_tasks, return_exceptions=True
+            )
+            for queue in self._queues.values():
+                await queue.join()
+            if (not self._tasks) and (not self._lane_tasks):
+                return
+
+
+    async def _run_handler(
+        self, handler: EventHandler, event: AdBotEvent, retries: int
+    ) -> None:
+        """
+            Runs handler. Retries it up to `_max_retries` times on exception, then puts
+            it to `dead_letters`.
+        """
+        while True:
+            try:
+                await handler(event)
+                return
+            except Exception as e:
+                if retries < self._max_retries:
+                    retries += 1
+                    logger.warning(
+                        'Messagebus. Handler %s failed on event %s: %r. Retry %d',
+                        handler, event.__class__.__name__, e, retries
+                    )
+                    continue
+                logger.error(
+                    'Messagebus. Handler %s failed on event %s: %r',
+                    handler, event.__class__.__name__, e
+                )
+                self.dead_letters.append(DeadLetter(handler, event, e, retries))
+                return
+
+
+    async def _put(self, handler: EventHandler, event: AdBotEvent, retries: int) -> None:
+        if self._get_lane_key(event) is not None:
+            await self._put_to_lane(handler, event, retries)
+            return
+        queue = self._get_target_queue(event)
+        if queue is None:
+            self._add_task(self._run_handler(handler, event, retries))
+        else:
+            await queue.put((handler, event, retries))
+
+
+    def _get_target_queue(self, event: AdBotEvent) -> Optional[asyncio.Queue]:
+        """
+            Returns the queue of event type if the pool of workers is used, None if
+            handlers should be run in separate tasks.
+        """
+        if self._workers > 0:
+            return self._get_queue(event)
+        return None
+
+
+    def _get_lane_key(self, event: AdBotEvent) -> Optional[tuple[bool, Hashable]]:
+        """
+            Returns the key of ordered lane for handler calls of `event`, None if they
+            are not ordered.
+        """
+        if self._partitions > 0:
+            key = event.partition_key()
+            if key is not None:
+                return (event.interactive, key)
+        return None
+
+
+    def _get_lanes_semaphore(self, interactive: bool) -> asyncio.Semaphore:
+        semaphore = self._lanes_semaphores.get(interactive)
+        if semaphore is None:
+            semaphore = self._lanes_semaphores[interactive] = \
+                asyncio.Semaphore(self._partitions)
+        return semaphore
+
+
+    async def _put_to_lane(
+        self, handler: EventHandler, event: AdBotEvent, retries: int
+    ) -> None:
+        """
+            Puts handler call to the lane of event's partition key. Waits while there
+            are `queue_size` queued calls.
+        """
+        interactive = event.interactive
+        while self._lane_calls_cnt[interactive] >= self._queue_size:
+            freed = self._lane_calls_freed.setdefault(interactive, asyncio.Event())
+            freed.clear()
+            await freed.wait()
+        self._append_to_lane(self._get_lane_key(event), (handler, event, retries))
+
+
+    def _append_to_lane(self, lane_key: tuple[bool, Hashable], call: tuple) -> None:
+        """
+            Appends handler call to the lane. The lane is created at once (so that next
+            calls of the key are queued behind this one) and waits for the free lane
+            before running.
+        """
+        self._lane_calls_cnt[lane_key[0]] += 1
+        lane = self._lanes.get(lane_key)
+        if lane is not None:
+            lane.append(call)
+            return
+        lane = self._lanes[lane_key] = deque([call])
+        task = asyncio.create_task(self._run_lane(lane_key, lane))
+        self._lane_tasks.add(task)
+        task.add_done_callback(self._lane_tasks.discard)
+
+
+    async def _run_lane(self, lane_key: tuple[bool, Hashable], lane: deque) -> None:
+        """
+            Waits for the free lane and runs handler calls from `lane` one by one (when
+            one of workers is free if the pool of workers is used). Removes the lane
+            when it's empty.
+        """
+        interactive = lane_key[0]
+        lanes_semaphore = self._get_lanes_semaphore(interactive)
+        await lanes_semaphore.acquire()
+        try:
+            while lane:
+                handler, event, retries = lane[0]
+                if self._workers_pool is None:
+                    await self._run_handler(handler, event, retries)
+                else:
+                    await self._workers_pool.acquire(interactive)
+                    try:
+                        await self._run_handler(handler, event, retries)
+                    finally:
+                        self._workers_pool.release()
+                lane.popleft()
+                self._lane_calls_cnt[interactive] -= 1
+                freed = self._lane_calls_freed.get(interactive)
+                if freed is not None:
+                    freed.set()
+        finally:
+            lanes_semaphore.release()
+            if self._lanes.get(lane_key) is lane:
+                del self._lanes[lane_key]
+
+
+    def _get_handlers(self, event: AdBotEvent) -> tuple[EventHandler, ...]:
+        event_cls = event.__class__
+        logger.debug('Messagebus. Event posted: %s', event_cls.__name__)
+        handlers = self._dispatch_table.get(event_cls)
+        if handlers is None:
+            handlers = self._dispatch_table[event_cls] = self._build_handlers(event_cls)
+        if not handlers:
+            logger.warning(
+                'Messagebus. Handlers not found for event %s', event_cls.__name__
+            )
+        return handlers
+
+
+    def _build_handlers(self, event_cls: type) -> tuple[EventHandler, ...]:
+        """
+            Returns handlers subscribed to `event_cls` or its base classes (in the order
+            of subscription).
+        """
+        handlers = {
+            handler for cls in event_cls.__mro__
+                for handler in self._type_handlers.get(cls, ())
+        }
+        return tuple(handler for handler in self._subscribers if handler in handlers)
+
+
+    def _add_task(self, coro: Awaitable) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+
+    def _get_queue(self, event: AdBotEvent) -> asyncio.Queue:
+        event_cls = event.__class__.__name__
+        queue = self._queues.get(event_cls)
+        if queue is None:
+            queue = self._queues[event_cls] = asyncio.Queue(self._queue_size)
+            self._dispatchers.append(asyncio.create_task(self._dispatch(queue)))
+        return queue
+
+
+    async def _dispatch(self, queue: asyncio.Queue) -> None:
+        """
+            Takes handler calls from `queue` and runs them when one of workers is free.
+        """
+        while True:
+            handler, event, retries = await queue.get()
+            await self._workers_pool.acquire(event.interactive)
+            logger.debug(
+                'Messagebus. Event %s handled by handler %s',
+                event.__class__.__name__, handler
+            )
+            task = self._add_task(self._run_handler(handler, event, retries))
+            def on_done(_, queue=queue):
+                self._workers_pool.release()
+                queue.task_done()
+            task.add_done_callback(on_done)
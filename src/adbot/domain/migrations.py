@@ -0,0 +1,190 @@
+from datetime import datetime
+import logging
+from typing import Callable
+
+from sqlalchemy import (
+    Boolean, Column, Connection, DateTime, ForeignKey, Index, Integer, LargeBinary,
+    MetaData, String, Table, UnicodeText, column, inspect, insert, select, table, update
+)
+
+from . import models
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_VERSION_ID = 1
+
+
+def _add_columns(conn: Connection, table_name: str, columns: list[Column]) -> None:
+    """
+        Adds `columns` that don't exist in DB table. New columns must be nullable.
+    """
+    existing = {column['name'] for column in inspect(conn).get_columns(table_name)}
+    for column in columns:
+        if column.name not in existing:
+            column_type = column.type.compile(dialect=conn.dialect)
+            logger.info(f'Migrations. Add column {table_name}.{column.name}')
+            conn.exec_driver_sql(
+                f'ALTER TABLE {table_name} ADD COLUMN {column.name} {column_type}'
+            )
+
+
+# Migrations don't use `models`: tables, columns and indexes are declared in every
+# migration as they were when it was released, so that later changes of models don't
+# change what the migration does.
+
+def _migration_1_message_columns(conn: Connection) -> None:
+    """
+        Columns of chat_message table added for duplicates detection, latency tracing
+        and retention, table of keywords generation counter. Length of text_hash is
+        fixed (md5 hex digest is 32 chars).
+    """
+    _add_columns(conn, 'chat_message', [
+        Column('fetched_dt', DateTime),
+        Column('added_dt', DateTime),
+        Column('processed_dt', DateTime),
+        Column('minhash', LargeBinary),
+    ])
+    chat_message = table('chat_message', column('added_dt'))
+    conn.execute(
+        update(chat_message)
+            .where(chat_message.c.added_dt == None)
+            .values(added_dt=datetime.now())
+    )
+    keywords_generation = Table(
+        'keywords_generation', MetaData(),
+        Column('id', Integer, primary_key=True),
+        Column('generation', Integer, nullable=False),
+    )
+    keywords_generation.create(conn, checkfirst=True)
+    if conn.dialect.name == 'postgresql':
+        conn.exec_driver_sql(
+            'ALTER TABLE chat_message ALTER COLUMN text_hash TYPE VARCHAR(32)'
+        )
+
+
+def _migration_2_indexes(conn: Connection) -> None:
+    """
+        Indexes for hot predicates (unprocessed messages, text_hash, telegram_id,
+        users with enabled forwarding, etc.).
+    """
+    metadata = MetaData()
+    chat_message = Table(
+        'chat_message', metadata,
+        Column('id', Integer, primary_key=True),
+        Column('processed', Boolean),
+        Column('text_hash', String(32)),
+        Column('added_dt', DateTime),
+    )
+    user_account = Table(
+        'user_account', metadata,
+        Column('id', Integer, primary_key=True),
+        Column('telegram_id', Integer),
+        Column('forwarding_state', Boolean),
+    )
+    user_message_link = Table(
+        'user_message_link', metadata,
+        Column('message_id', Integer),
+    )
+    indexes = [
+        Index('ix_chat_message_text_hash', chat_message.c.text_hash),
+        Index('ix_chat_message_added_dt', chat_message.c.added_dt),
+        Index(
+            'ix_chat_message_unprocessed', chat_message.c.id,
+            postgresql_where=(chat_message.c.processed == False),
+            sqlite_where=(chat_message.c.processed == False)
+        ),
+        Index('ix_user_account_telegram_id', user_account.c.telegram_id),
+        Index(
+            'ix_user_account_forwarding', user_account.c.id,
+            postgresql_where=(user_account.c.forwarding_state == True),
+            sqlite_where=(user_account.c.forwarding_state == True)
+        ),
+        Index('ix_user_message_link_message_id', user_message_link.c.message_id),
+    ]
+    for index in indexes:
+        index.create(conn, checkfirst=True)
+
+
+def _migration_3_digest_mode(conn: Connection) -> None:
+    """
+        Columns of user_account table for digest mode.
+    """
+    _add_columns(conn, 'user_account', [
+        Column('digest_mode', Boolean),
+        Column('digest_sent_dt', DateTime),
+    ])
+
+
+def _migration_4_outbox(conn: Connection) -> None:
+    """
+        Outbox table for acknowledged delivery of forwarded messages.
+    """
+    metadata = MetaData()
+    Table('user_account', metadata, Column('id', Integer, primary_key=True))
+    outbox = Table(
+        'outbox', metadata,
+        Column('id', Integer, primary_key=True),
+        Column('user_id', Integer, ForeignKey('user_account.id'), nullable=False),
+        Column('telegram_id', Integer, nullable=False),
+        Column('is_digest', Boolean, nullable=False),
+        Column('url', UnicodeText, nullable=False),
+        Column('text', UnicodeText),
+        Column('fetched_dt', DateTime),
+        Column('added_dt', DateTime),
+        Column('processed_dt', DateTime),
+        Column('state', String(10), nullable=False),
+        Column('attempts', Integer, nullable=False),
+        Column('due_dt', DateTime, nullable=False),
+        Column('done_dt', DateTime),
+        Index('ix_outbox_state_due_dt', 'state', 'due_dt'),
+    )
+    outbox.create(conn, checkfirst=True)
+
+
+# List of migrations (version, function). Versions must be in ascending order.
+# Migration is applied once to existing DB with lower version. New DB is created with
+# the latest schema (by `create_all`) and doesn't need migrations.
+MIGRATIONS: list[tuple[int, Callable[[Connection], None]]] = [
+    (1, _migration_1_message_columns),
+    (2, _migration_2_indexes),
+    (3, _migration_3_digest_mode),
+    (4, _migration_4_outbox),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def run_migrations(conn: Connection) -> int:
+    """
+        Creates tables of new DB (latest schema) or applies migrations that were not
+        applied yet to existing DB.
+        Should be called in transaction (via `AsyncConnection.run_sync`).
+        Returns schema version.
+    """
+    is_new_db = not inspect(conn).has_table(models.GroupChatMessage.__tablename__)
+    if is_new_db:
+        models.Base.metadata.create_all(conn)
+    else:
+        # Tables of existing DB are created and changed by migrations only
+        models.SchemaVersion.__table__.create(conn, checkfirst=True)
+
+    st = select(models.SchemaVersion.version) \
+        .where(models.SchemaVersion.id == SCHEMA_VERSION_ID)
+    version = conn.scalar(st)
+    if version is None:
+        version = LATEST_VERSION if is_new_db else 0
+        conn.execute(
+            insert(models.SchemaVersion)
+                .values(id=SCHEMA_VERSION_ID, version=version)
+        )
+
+    for migration_version, migration in MIGRATIONS:
+        if migration_version > version:
+            logger.info(f'Migrations. Apply migration {migration_version}')
+            migration(conn)
+            version = migration_version
+            conn.execute(
+                update(models.SchemaVersion)
+                    .where(models.SchemaVersion.id == SCHEMA_VERSION_ID)
+                    .values(version=version)
+            )
+    return version
@@ -0,0 +1,89 @@
+from collections.abc import Iterable
+from hashlib import blake2b
+import random
+import re
+from typing import Optional
+
+NUM_PERM = 32       # number of hash functions (length of signature)
+MIN_TOKENS = 5      # texts with less words don't get signature
+
+_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+_TOKEN_RE = re.compile(r'\w+')
+
+# Parameters of hash functions have to be the same in all processes and after restart
+# (signatures are stored in DB)
+_rnd = random.Random(20230901)
+_PERMUTATIONS = [
+    (_rnd.randrange(1, _PRIME), _rnd.randrange(0, _PRIME)) for _ in range(NUM_PERM)
+]
+
+
+def _feature_hash(feature: str) -> int:
+    return int.from_bytes(
+        blake2b(feature.encode('utf-8'), digest_size=8).digest(), 'little'
+    )
+
+
+def _features(text: str) -> Optional[set[str]]:
+    """
+        Returns set of features of the text: lowercased words and pairs of adjacent
+        words (punctuation and emoji are ignored).
+        Returns None if text has less than MIN_TOKENS words.
+    """
+    tokens = _TOKEN_RE.findall(text.lower())
+    if len(tokens) < MIN_TOKENS:
+        return None
+    return set(tokens).union(f'{a} {b}' for a, b in zip(tokens, tokens[1:]))
+
+
+def minhash_many(texts: Iterable[str]) -> list[Optional[tuple[int, ...]]]:
+    """
+        Calculates MinHash signatures (NUM_PERM 32-bit values) of texts.
+        Hashes of features are cached during the call, so calculating signatures of
+        several texts in one call is faster.
+        Returns None for texts that have less than MIN_TOKENS words.
+    """
+    cache: dict[str, int] = {}
+    signatures = []
+    for text in texts:
+        features = _features(text)
+        if features is None:
+            signatures.append(None)
+            continue
+        hashes = []
+        for feature in features:
+            h = cache.get(feature)
+            if h is None:
+                h = cache[feature] = _feature_hash(feature)
+            hashes.append(h)
+        signatures.append(tuple(
+            min([(a * h + b) % _PRIME for h in hashes]) & _MAX_HASH
+                for a, b in _PERMUTATIONS
+        ))
+    return signatures
+
+
+def minhash(text: str) -> Optional[tuple[int, ...]]:
+    return minhash_many([text])[0]
+
+
+def similarity(sig1: tuple[int, ...], sig2: tuple[int, ...]) -> float:
+    """
+        Returns estimated Jaccard similarity of texts by their signatures.
+    """
+    return sum(1 for a, b in zip(sig1, sig2) if a == b) / NUM_PERM
+
+
+def to_bytes(signature: Optional[tuple[int, ...]]) -> Optional[bytes]:
+    if signature is None:
+        return None
+    return b''.join(v.to_bytes(4, 'little') for v in signature)
+
+
+def from_bytes(data: Optional[bytes]) -> Optional[tuple[int, ...]]:
+    if data is None:
+        return None
+    return tuple(
+        int.from_bytes(data[i:i + 4], 'little') for i in range(0, len(data), 4)
+    )
@@ -1,6 +1,10 @@
+from datetime import datetime
 from typing import List, Optional
 
-from sqlalchemy import Table, Column, String, Boolean, ForeignKey, UnicodeText, Unicode
+from sqlalchemy import (
+    Table, Column, String, Boolean, DateTime, ForeignKey, Index, Integer, LargeBinary,
+    UnicodeText, Unicode
+)
 from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy.orm import Mapped, mapped_column, relationship, query_expression
 
@@ -9,6 +13,13 @@ class Base(DeclarativeBase):
     pass
 
 
+# States of outbox messages
+OUTBOX_PENDING = 'pending'
+OUTBOX_IN_FLIGHT = 'in_flight'
+OUTBOX_SENT = 'sent'
+OUTBOX_FAILED = 'failed'
+
+
 # Table for storying links of 'many to many' relationship between User and Keyword
 # (List of keywords in user's list)
 user_keyword_link = Table(
@@ -26,6 +37,7 @@ user_message_link = Table(
     Base.metadata,
     Column("user_id", ForeignKey("user_account.id"), primary_key=True),
     Column("message_id", ForeignKey("chat_message.id"), primary_key=True),
+    Index("ix_user_message_link_message_id", "message_id"),
 )
 
 
@@ -34,13 +46,16 @@ class User(Base):
     __tablename__ = "user_account"
 
     id: Mapped[int] = mapped_column(primary_key=True)  # Telegram user ID
-    telegram_id: Mapped[int] = mapped_column(nullable=True)
+    telegram_id: Mapped[int] = mapped_column(nullable=True, index=True)
     telegram_name: Mapped[str] = mapped_column(Unicode(32), nullable=True, default=None)
     subscription_state: Mapped[bool] = mapped_column(
         Boolean, nullable=True, default=False
     )
     forwarding_state: Mapped[bool] = mapped_column(Boolean, nullable=True, default=False)
     menu_closed: Mapped[bool] = mapped_column(Boolean, nullable=True, default=True)
+    # Digest mode: queued messages are forwarded in one message (with several URLs)
+    digest_mode: Mapped[bool] = mapped_column(Boolean, nullable=True, default=False)
+    digest_sent_dt: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
     forward_queue_len: Mapped[int] = query_expression()
     keywords_limit: int = 10
 
@@ -81,10 +96,75 @@ class GroupChatMessage(Base):
     processed: Mapped[bool] = mapped_column(Boolean, default=False)
     text: Mapped[str] = mapped_column(UnicodeText)
     url: Mapped[str] = mapped_column(String(120))
-    text_hash: Mapped[str] = mapped_column(String(16))
+    text_hash: Mapped[str] = mapped_column(String(32), index=True)
+    fetched_dt: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+    added_dt: Mapped[Optional[datetime]] = mapped_column(
+        DateTime, nullable=True, default=datetime.now, index=True
+    )
+    processed_dt: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+    minhash: Mapped[Optional[bytes]] = mapped_column(LargeBinary, nullable=True)
 
     users: Mapped[List[User]] = relationship(
         secondary=user_message_link, back_populates="forward_queue"
     )
 
 
+# Outbox of messages to forward to users (durable delivery with acknowledgement).
+# Row is `pending` until it's posted to presentation layer, then `in_flight` until
+# sending is acknowledged (`sent`) or failed (back to `pending` or `failed` if it
+# shouldn't be retried).
+# `due_dt` is the time of the next attempt for `pending` rows and the lease expiration
+# time for `in_flight` rows (row is posted again after the lease expired).
+class OutboxMessage(Base):
+    __tablename__ = "outbox"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey("user_account.id"))
+    telegram_id: Mapped[int] = mapped_column()
+    is_digest: Mapped[bool] = mapped_column(Boolean, default=False)
+    # URL of message or URLs of digest (separated by new line)
+    url: Mapped[str] = mapped_column(UnicodeText)
+    text: Mapped[Optional[str]] = mapped_column(UnicodeText, nullable=True)
+    fetched_dt: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+    added_dt: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+    processed_dt: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+    state: Mapped[str] = mapped_column(String(10), default=OUTBOX_PENDING)
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    due_dt: Mapped[datetime] = mapped_column(DateTime, default=datetime.now)
+    done_dt: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index("ix_outbox_state_due_dt", "state", "due_dt"),
+    )
+
+
+# Partial indexes (where supported by DB) for hot predicates: unprocessed messages and
+# users with enabled forwarding
+Index(
+    "ix_chat_message_unprocessed", GroupChatMessage.id,
+    postgresql_where=(GroupChatMessage.processed == False),
+    sqlite_where=(GroupChatMessage.processed == False)
+)
+Index(
+    "ix_user_account_forwarding", User.id,
+    postgresql_where=(User.forwarding_state == True),
+    sqlite_where=(User.forwarding_state == True)
+)
+
+
+# Generation counter of keywords data (user's keyword lists and subscription states).
+# Every writer increments it, so that in-memory keyword index can detect that data was
+# changed by another writer.
+class KeywordsGeneration(Base):
+    __tablename__ = "keywords_generation"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    generation: Mapped[int] = mapped_column(default=0)
+
+
+# Version of DB schema (see `migrations` module)
+class SchemaVersion(Base):
+    __tablename__ = "schema_version"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    version: Mapped[int] = mapped_column(Integer, default=0)
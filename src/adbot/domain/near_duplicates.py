@@ -0,0 +1,129 @@
+from dataclasses import dataclass
+from datetime import datetime
+import heapq
+
+from .minhash import NUM_PERM, similarity
+
+# Weights of errors for choosing LSH parameters: missed near-duplicate is worse than
+# extra candidate (candidates are checked by estimated similarity anyway)
+LSH_FALSE_POSITIVE_WEIGHT = 0.1
+LSH_FALSE_NEGATIVE_WEIGHT = 0.9
+_INTEGRATION_STEPS = 100
+
+
+def _integrate(f, a: float, b: float) -> float:
+    step = (b - a) / _INTEGRATION_STEPS
+    return sum(f(a + (i + 0.5) * step) for i in range(_INTEGRATION_STEPS)) * step
+
+
+def lsh_params(threshold: float, num_perm: int = NUM_PERM) -> tuple[int, int]:
+    """
+        Returns the number of bands and rows per band (bands * rows <= `num_perm`)
+        that minimize weighted probabilities of false positives (similarity is less
+        than `threshold`) and false negatives (similarity is not less than
+        `threshold`) of LSH candidates.
+        Messages with similarity `s` become candidates with probability
+        1 - (1 - s ** rows) ** bands.
+    """
+    best = None
+    for bands in range(1, num_perm + 1):
+        for rows in range(1, num_perm // bands + 1):
+            probability = lambda s: 1 - (1 - s ** rows) ** bands
+            false_positive = _integrate(probability, 0.0, threshold)
+            false_negative = _integrate(lambda s: 1 - probability(s), threshold, 1.0)
+            error = LSH_FALSE_POSITIVE_WEIGHT * false_positive + \
+                LSH_FALSE_NEGATIVE_WEIGHT * false_negative
+            if (best is None) or (error < best[0]):
+                best = (error, bands, rows)
+    return best[1], best[2]
+
+
+@dataclass
+class NearDuplicate:
+    msg_id: int
+    signature: tuple[int, ...]
+    added_dt: datetime
+    recipients: set[int]    # ids of users this message (or its repeats) was queued for
+
+
+class NearDuplicatesIndex:
+    """
+        LSH index of MinHash signatures of recently processed messages.
+        Signature is split into bands (the number of bands and rows is derived from
+        `threshold`, see `lsh_params`), messages that have the same values in at least
+        one band are candidates, candidates are checked by estimated similarity of
+        signatures.
+        Entries can be added in any order of `added_dt`, `evict` removes old ones.
+    """
+
+    def __init__(self, threshold: float):
+        self._threshold = threshold
+        self._bands, self._rows = lsh_params(threshold)
+        self._entries: dict[int, NearDuplicate] = {}
+        self._eviction_heap: list[tuple[datetime, int]] = []    # (added_dt, msg_id)
+        self._buckets: dict[tuple, set[int]] = {}
+
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+    def find(self, signature: tuple[int, ...]) -> list[NearDuplicate]:
+        """
+            Returns messages whose similarity with `signature` is not less than
+            threshold.
+        """
+        candidates = set()
+        for key in self._bucket_keys(signature):
+            candidates.update(self._buckets.get(key, ()))
+        res = []
+        for msg_id in candidates:
+            entry = self._entries[msg_id]
+            if similarity(signature, entry.signature) >= self._threshold:
+                res.append(entry)
+        return res
+
+
+    def add(self, entry: NearDuplicate) -> None:
+        self.remove(entry.msg_id)
+        self._entries[entry.msg_id] = entry
+        heapq.heappush(self._eviction_heap, (entry.added_dt, entry.msg_id))
+        for key in self._bucket_keys(entry.signature):
+            self._buckets.setdefault(key, set()).add(entry.msg_id)
+
+
+    def remove(self, msg_id: int) -> None:
+        entry = self._entries.pop(msg_id, None)
+        if entry is None:
+            return
+        for key in self._bucket_keys(entry.signature):
+            bucket = self._buckets[key]
+            bucket.discard(msg_id)
+            if not bucket:
+                del self._buckets[key]
+
+
+    def evict(self, older_than: datetime) -> None:
+        """
+            Removes entries added before `older_than`.
+        """
+        heap = self._eviction_heap
+        while heap and (heap[0][0] < older_than):
+            added_dt, msg_id = heapq.heappop(heap)
+            entry = self._entries.get(msg_id)
+            if (entry is not None) and (entry.added_dt == added_dt):
+                self.remove(msg_id)
+        if len(heap) > 2 * len(self._entries) + 1000:
+            # drop items of removed entries
+            self._eviction_heap = [
+                (entry.added_dt, msg_id) for msg_id, entry in self._entries.items()
+            ]
+            heapq.heapify(self._eviction_heap)
+
+
+    def _bucket_keys(self, signature: tuple[int, ...]) -> list[tuple]:
+        rows = self._rows
+        return [
+            (band, signature[band * rows:(band + 1) * rows])
+                for band in range(self._bands)
+        ]
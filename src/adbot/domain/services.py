@@ -1,26 +1,66 @@
 import asyncio
+from collections import Counter
 from datetime import datetime, timedelta
 from hashlib import md5
 import logging
-from typing import Optional
+from typing import Awaitable, Callable, Iterable, Optional, Sequence
 import random
 
 from sqlalchemy.ext.asyncio import async_sessionmaker, AsyncSession
-from sqlalchemy.orm import load_only, with_expression, selectinload
+from sqlalchemy.orm import selectinload
 
-from sqlalchemy import select, func
+from sqlalchemy import select, insert, update, delete, func, or_, tuple_, Row
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.exc import SQLAlchemyError, IntegrityError, OperationalError
 
 from ..common.async_mixin import AsyncMixin
-from .messagebus import MessageBus
+from .keyword_index import KeywordIndex
+from . import latency_stats
+from .latency_stats import LatencyStats
+from .matching_pool import MatchingPool
+from .message_archive import MessageArchive
+from . import minhash
+from .near_duplicates import NearDuplicate, NearDuplicatesIndex
+from .user_cache import UserCache
+from .messagebus import EVENT_QUEUE_SIZE, MessageBus
 from . import events
 from . import models
 from . import exceptions as exc
 
 
+KEYWORDS_GENERATION_ID = 1
+
 IDLE_TIMEOUT_MINUTES = 2
-CHECK_IDLE_CYCLES = 10
 CHECK_IDLE_INTERVAL_SEC = 20
+WAKE_DEBOUNCE_SEC = 0.5         # time to collect a batch of messages after wake up
+MIN_LOOP_WAIT_SEC = 1           # wait timeouts of main loop when there are no wake ups
+MAX_LOOP_WAIT_SEC = 60          # (the timeout grows while there is nothing to process)
+STAGE_QUEUE_SIZE = 4            # max number of pending jobs between main loop stages
+STAGE_RESTART_MIN_DELAY_SEC = 1 # delay before restart of main loop stage after DB error
+STAGE_RESTART_MAX_DELAY_SEC = 60    # (doubles after every successive error)
+PROCESS_MESSAGES_CHUNK_SIZE = 500
+DUPLICATES_WINDOW_MINUTES = 24 * 60
+NEAR_DUPLICATES_THRESHOLD = 0.7
+NEAR_DUPLICATES_LOAD_CHUNK_SIZE = 1000  # signatures are loaded on start by chunks
+MATCHING_POOL_MIN_MESSAGES = 100   # smaller chunks are matched in the main process
+INSERT_BATCH_SIZE = 400     # rows in one multi-row INSERT (limited by the number of
+                            # bind parameters in SQLite)
+FORWARD_MESSAGES_CHUNK_SIZE = 500
+DIGEST_INTERVAL_MINUTES = 30    # digests are sent not more often than this interval
+DIGEST_MAX_MESSAGES = 20        # ... unless this number of messages is queued
+RETENTION_BATCH_SIZE = 500      # messages deleted in one transaction
+RETENTION_INTERVAL_SEC = 60 * 60
+OUTBOX_LEASE_SEC = 5 * 60       # outbox entry is forwarded again if sending wasn't
+                                # acknowledged during this time (the lease is renewed
+                                # when the sending starts, see `record_message_sending`)
+OUTBOX_MAX_IN_FLIGHT = 1000     # max number of dispatched unacknowledged entries
+OUTBOX_MAX_IN_FLIGHT_PER_USER = 10  # ... and of the same user's entries
+OUTBOX_ACK_BATCH_SIZE = 100     # acknowledgements are written to DB by batches
+OUTBOX_FLUSH_INTERVAL_SEC = 5   # ... or every this interval
+OUTBOX_RETRY_MIN_DELAY_SEC = 10 # delay before retry of failed sending (doubles after
+OUTBOX_RETRY_MAX_DELAY_SEC = 60 * 60    # every attempt)
+OUTBOX_MAX_ATTEMPTS = 10
+OUTBOX_KEEP_DONE_HOURS = 24     # sent and failed outbox entries are deleted after this
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -28,28 +68,122 @@ logger.setLevel(logging.DEBUG)
 
 class AdBotServices(AsyncMixin):
 
-    def __init__(self, db_pool: async_sessionmaker):
+    def __init__(
+        self, db_pool: async_sessionmaker, matching_workers: int = 0,
+        duplicates_window_minutes: int = DUPLICATES_WINDOW_MINUTES,
+        near_duplicates_threshold: float = NEAR_DUPLICATES_THRESHOLD,
+        retention_days: int = 0, retention_max_messages: int = 0,
+        archive_dir: Optional[str] = None,
+        digest_interval_minutes: int = DIGEST_INTERVAL_MINUTES,
+        digest_max_messages: int = DIGEST_MAX_MESSAGES,
+        messagebus_workers: int = 0, messagebus_queue_size: int = EVENT_QUEUE_SIZE,
+        messagebus_partitions: int = 0
+    ):
         """
             Object initialisation implemented in __ainit__().
             To initialise object it has to be awaited after creation
             (o = await AdBotServices(db_pool)).
         """
-        super().__init__(db_pool)
-
-
-    async def __ainit__(self, db_pool: async_sessionmaker):
+        super().__init__(
+            db_pool, matching_workers, duplicates_window_minutes,
+            near_duplicates_threshold, retention_days, retention_max_messages,
+            archive_dir, digest_interval_minutes, digest_max_messages,
+            messagebus_workers, messagebus_queue_size, messagebus_partitions
+        )
+
+
+    async def __ainit__(
+        self, db_pool: async_sessionmaker, matching_workers: int = 0,
+        duplicates_window_minutes: int = DUPLICATES_WINDOW_MINUTES,
+        near_duplicates_threshold: float = NEAR_DUPLICATES_THRESHOLD,
+        retention_days: int = 0, retention_max_messages: int = 0,
+        archive_dir: Optional[str] = None,
+        digest_interval_minutes: int = DIGEST_INTERVAL_MINUTES,
+        digest_max_messages: int = DIGEST_MAX_MESSAGES,
+        messagebus_workers: int = 0, messagebus_queue_size: int = EVENT_QUEUE_SIZE,
+        messagebus_partitions: int = 0
+    ):
         """
-            Initializes object, preload data from DB into cache (menu_closed states).
+            Initializes object, preload data from DB into cache (menu_closed states,
+            keywords index, forward queues lengths).
+            If `matching_workers` > 0, large chunks of messages will be matched against
+            keywords in the pool of `matching_workers` worker processes.
+            Messages with the same text as a message added less than
+            `duplicates_window_minutes` earlier are not forwarded (0 - disabled).
+            Messages whose similarity with such message is not less than
+            `near_duplicates_threshold` are not forwarded to users who received that
+            message.
+            Processed messages older than `retention_days` and messages beyond the
+            newest `retention_max_messages` are deleted (0 - no limit). If `archive_dir`
+            is set, deleted messages are archived there (see `MessageArchive`).
+            Users in digest mode receive queued messages in one message with up to
+            `digest_max_messages` URLs every `digest_interval_minutes` minutes or when
+            `digest_max_messages` messages are queued.
+            Events are handled by `messagebus_workers` concurrent handlers with up to
+            `messagebus_queue_size` queued events of one type. Events of one user are
+            handled in order, up to `messagebus_partitions` users at a time (see
+            `MessageBus`).
             Raises `AdBotExceptionSQL` exception on DB error.
         """
         self._stop = True
         self._stopped = True
         self._db_pool = db_pool
-        self.messagebus = MessageBus()
+        self.messagebus = MessageBus(
+            messagebus_workers, messagebus_queue_size, messagebus_partitions
+        )
+        self._user_cache = UserCache()  # snapshots of users for get_user_by_... methods
+        self._forward_queue_lens: dict[int, int] = {}   # user id -> number of queued
+                                                        # messages
         self._updated_uids = set()  # ids of users whose data were updated
                                     # by _process_messages method
-        self._CHECK_IDLE_CYCLES = CHECK_IDLE_CYCLES
         self._CHECK_IDLE_INTERVAL_SEC = CHECK_IDLE_INTERVAL_SEC
+        self._WAKE_DEBOUNCE_SEC = WAKE_DEBOUNCE_SEC
+        self._MIN_LOOP_WAIT_SEC = MIN_LOOP_WAIT_SEC
+        self._MAX_LOOP_WAIT_SEC = MAX_LOOP_WAIT_SEC
+        self._loop_wait_sec = MIN_LOOP_WAIT_SEC
+        self._wake_event = asyncio.Event()  # set when there is work for main loop
+        self._processed_cnt = 0     # number of messages processed by last iteration
+        self._STAGE_QUEUE_SIZE = STAGE_QUEUE_SIZE
+        self._STAGE_RESTART_MIN_DELAY_SEC = STAGE_RESTART_MIN_DELAY_SEC
+        self._STAGE_RESTART_MAX_DELAY_SEC = STAGE_RESTART_MAX_DELAY_SEC
+        self._latency_stats = LatencyStats()
+        self._PROCESS_MESSAGES_CHUNK_SIZE = PROCESS_MESSAGES_CHUNK_SIZE
+        self._MATCHING_POOL_MIN_MESSAGES = MATCHING_POOL_MIN_MESSAGES
+        self._FORWARD_MESSAGES_CHUNK_SIZE = FORWARD_MESSAGES_CHUNK_SIZE
+        self._digest_interval = timedelta(minutes=digest_interval_minutes)
+        self._digest_max_messages = digest_max_messages
+        self._duplicates_window = timedelta(minutes=duplicates_window_minutes)
+        self._near_duplicates = NearDuplicatesIndex(near_duplicates_threshold)
+        self._keywords_index = KeywordIndex()
+        self._keywords_update_required = True
+        self._matching_pool: Optional[MatchingPool] = None
+        if matching_workers > 0:
+            self._matching_pool = MatchingPool(matching_workers)
+        self._retention_period: Optional[timedelta] = None
+        if retention_days > 0:
+            self._retention_period = timedelta(days=retention_days)
+        self._retention_max_messages = retention_max_messages
+        self._archive: Optional[MessageArchive] = None
+        if archive_dir:
+            self._archive = MessageArchive(archive_dir)
+        self._RETENTION_BATCH_SIZE = RETENTION_BATCH_SIZE
+        self._RETENTION_INTERVAL_SEC = RETENTION_INTERVAL_SEC
+        self._OUTBOX_LEASE_SEC = OUTBOX_LEASE_SEC
+        self._OUTBOX_MAX_IN_FLIGHT = OUTBOX_MAX_IN_FLIGHT
+        self._OUTBOX_MAX_IN_FLIGHT_PER_USER = OUTBOX_MAX_IN_FLIGHT_PER_USER
+        self._OUTBOX_ACK_BATCH_SIZE = OUTBOX_ACK_BATCH_SIZE
+        self._OUTBOX_FLUSH_INTERVAL_SEC = OUTBOX_FLUSH_INTERVAL_SEC
+        self._OUTBOX_RETRY_MIN_DELAY_SEC = OUTBOX_RETRY_MIN_DELAY_SEC
+        self._OUTBOX_RETRY_MAX_DELAY_SEC = OUTBOX_RETRY_MAX_DELAY_SEC
+        self._OUTBOX_MAX_ATTEMPTS = OUTBOX_MAX_ATTEMPTS
+        self._OUTBOX_KEEP_DONE_HOURS = OUTBOX_KEEP_DONE_HOURS
+        self._outbox_lock = asyncio.Lock()  # dispatching and writing of acks
+        self._outbox_sent_ids: list[int] = []   # buffered acknowledgements
+        self._outbox_failed: dict[int, bool] = {}   # outbox id -> retry
+        self._outbox_renewed_ids: set[int] = set()  # buffered lease renewals
+        # Entries dispatched by this instance: outbox id -> (user id, lease expiration)
+        self._outbox_leases: dict[int, tuple[int, datetime]] = {}
+        self._outbox_ack_event = asyncio.Event()    # set when ack batch is full
 
         # Set last_activity_dt for all users with menu_closed=False
         self._menu_activity_cache = {}  #cached data (menu_closed and laste_activity_dt)
@@ -62,6 +196,10 @@ class AdBotServices(AsyncMixin):
                         'menu_closed': False,
                         'act_dt': datetime.now()
                     }
+                await self._init_keywords_generation(session)
+                await self._reload_keywords_index(session)
+                await self._load_near_duplicates_index(session)
+                await self._load_forward_queue_lens(session)
         except SQLAlchemyError as e:
             self._db_error_handle(e)
             raise exc.AdBotExceptionSQL("SQLAlchemyError")
@@ -80,68 +218,97 @@ class AdBotServices(AsyncMixin):
                 `SQLAlchemyError` exception on DB error
         """
         st = select(models.User) \
-                .outerjoin_from(models.User, models.user_message_link) \
-                .group_by(models.User.id) \
                 .where(models.User.id == user_id) \
-                .options(
-                    selectinload(models.User.keywords),
-                    with_expression(
-                        models.User.forward_queue_len,
-                        func.count(models.user_message_link.c.user_id)
-                    )
-                )
+                .options(selectinload(models.User.keywords))
         user = await session.scalar(st)
         if user is not None:
             return user
         raise exc.AdBotExceptionUserNotExist(f"User with id={user_id} doesn`t exist")
 
 
+    async def _update_user(
+        self, session: AsyncSession, user_id: int, *conditions, **values
+    ) -> Optional[Row]:
+        """
+            Updates columns of user (`values`) by one UPDATE ... RETURNING statement
+            without loading the user. Additional `conditions` can be passed.
+            Returns the row with `id` and updated columns or None if no row matched.
+            Gets `session` as a parameter, doesn't commit.
+            Raises:
+                `SQLAlchemyError` exception on DB error
+        """
+        st = update(models.User) \
+            .where(models.User.id == user_id, *conditions) \
+            .values(**values) \
+            .returning(models.User.id, *(getattr(models.User, c) for c in values)) \
+            .execution_options(synchronize_session=False)
+        return (await session.execute(st)).one_or_none()
+
+
+    async def _check_user_exists(self, session: AsyncSession, user_id: int) -> None:
+        """
+            Raises:
+                `AdBotExceptionUserNotExist` if user doesn't exist
+                `SQLAlchemyError` exception on DB error
+        """
+        st = select(models.User.id).where(models.User.id == user_id)
+        if (await session.scalar(st)) is None:
+            raise exc.AdBotExceptionUserNotExist(f"User with id={user_id} doesn`t exist")
+
+
     async def get_user_by_id(self, user_id: int) -> models.User:
         """
             Returns `user` object by primary key `id`.
+            User is read from cache (see `UserCache`) or from DB, returned object must
+            not be modified.
             Raises:
                 `AdBotExceptionUserNotExist` if user doesn't exist
                 `AdBotExceptionSQL` exception on DB error
         """
-        try:
-            async with self._db_pool() as session:
-                session: AsyncSession
-                return await self._get_user_by_id(session, user_id)
-        except SQLAlchemyError as e:
-            self._db_error_handle(e)
-            raise exc.AdBotExceptionSQL("SQLAlchemyError")
+        user = self._user_cache.get_by_id(user_id)
+        if user is None:
+            generation = self._user_cache.generation
+            try:
+                async with self._db_pool() as session:
+                    session: AsyncSession
+                    user = await self._get_user_by_id(session, user_id)
+            except SQLAlchemyError as e:
+                self._db_error_handle(e)
+                raise exc.AdBotExceptionSQL("SQLAlchemyError")
+            self._user_cache.put(user, generation)
+        user.forward_queue_len = self._forward_queue_lens.get(user.id, 0)
+        return user
         
 
     async def get_user_by_telegram_id(self, telegram_id: int) -> models.User:
         """
             Returns `user` object by `telegram_id` key.
+            User is read from cache (see `UserCache`) or from DB, returned object must
+            not be modified.
             Raises:
                 `AdBotExceptionUserNotExist` if user doesn't exist
                 `AdBotExceptionSQL` exception on DB error
         """
-        try:
-            async with self._db_pool() as session:
-                session: AsyncSession
-                st = select(models.User) \
-                        .outerjoin_from(models.User, models.user_message_link) \
-                        .group_by(models.User.id) \
-                        .where(models.User.telegram_id == telegram_id) \
-                        .options(
-                            selectinload(models.User.keywords),
-                            with_expression(
-                                models.User.forward_queue_len,
-                                func.count(models.user_message_link.c.user_id)
-                            )
-                        )
-                user = await session.scalar(st)
-                if user is not None:
-                    return user
+        user = self._user_cache.get_by_telegram_id(telegram_id)
+        if user is None:
+            generation = self._user_cache.generation
+            try:
+                async with self._db_pool() as session:
+                    session: AsyncSession
+                    st = select(models.User) \
+                            .where(models.User.telegram_id == telegram_id) \
+                            .options(selectinload(models.User.keywords))
+                    user = await session.scalar(st)
+            except SQLAlchemyError as e:
+                self._db_error_handle(e)
+                raise exc.AdBotExceptionSQL("SQLAlchemyError")
+            if user is None:
                 raise exc.AdBotExceptionUserNotExist(
                     f"User with telegram_id={telegram_id} doesn`t exist"
                 )
-        except SQLAlchemyError as e:
-            self._db_error_handle(e)
-            raise exc.AdBotExceptionSQL("SQLAlchemyError")
+            self._user_cache.put(user, generation)
+        user.forward_queue_len = self._forward_queue_lens.get(user.id, 0)
+        return user
 
 
     async def create_user_by_telegram_data(
@@ -201,12 +368,24 @@ class AdBotServices(AsyncMixin):
         try:
             async with self._db_pool() as session:
                 session: AsyncSession
-                user = await self._get_user_by_id(session, user_id)
-                user.subscription_state = new_state
+                row = await self._update_user(
+                    session, user_id,
+                    models.User.subscription_state.is_distinct_from(new_state),
+                    subscription_state=new_state
+                )
+                if row is None:
+                    await self._check_user_exists(session, user_id)
+                    return  # state wasn't changed
+                generation = await self._increment_keywords_generation(session)
                 await session.commit()
         except SQLAlchemyError as e:
             self._db_error_handle(e)
             raise exc.AdBotExceptionSQL("SQLAlchemyError")
+        self._user_cache.invalidate(user_id)
+        self._update_keywords_index(
+            generation,
+            lambda index: index.set_subscription_state(row.id, row.subscription_state)
+        )
 
 
     # Forwarding state management
@@ -220,15 +399,49 @@ class AdBotServices(AsyncMixin):
                 `AdBotExceptionUserNotExist` if user doesn`t exist
                 `AdBotExceptionSQL` exception on DB error
         """
+        try:
+            async with self._db_pool() as session:
+                session: AsyncSession
+                row = await self._update_user(
+                    session, user_id, forwarding_state=new_state
+                )
+                if row is None:
+                    raise exc.AdBotExceptionUserNotExist(
+                        f"User with id={user_id} doesn`t exist"
+                    )
+                await session.commit()
+        except SQLAlchemyError as e:
+            self._db_error_handle(e)
+            raise exc.AdBotExceptionSQL("SQLAlchemyError")
+        self._user_cache.invalidate(user_id)
+        if row.forwarding_state:
+            self._wake_event.set()  # forward queued messages
+
+
+    # Digest mode management
+
+    async def set_digest_mode(self, user_id: int, new_state: bool) -> None:
+        """
+            Sets digest mode to `new_state`.
+            In digest mode queued messages are forwarded to user in one message (see
+            `_forward_digests`).
+            Raises:
+                `AdBotExceptionUserNotExist` if user doesn`t exist
+                `AdBotExceptionSQL` exception on DB error
+        """
         try:
             async with self._db_pool() as session:
                 session: AsyncSession
                 user = await self._get_user_by_id(session, user_id)
-                user.forwarding_state = new_state
+                if new_state and not user.digest_mode:
+                    user.digest_sent_dt = datetime.now()    # start digest interval
+                user.digest_mode = new_state
                 await session.commit()
         except SQLAlchemyError as e:
             self._db_error_handle(e)
             raise exc.AdBotExceptionSQL("SQLAlchemyError")
+        self._user_cache.invalidate(user_id)
+        self._wake_event.set()  # forward queued messages
 
 
     # Menu closed state management
@@ -246,15 +459,20 @@ class AdBotServices(AsyncMixin):
         try:
             async with self._db_pool() as session:
                 session: AsyncSession
-                user = await self._get_user_by_id(session, user_id)
-                user.menu_closed = new_state
+                row = await self._update_user(session, user_id, menu_closed=new_state)
+                if row is None:
+                    raise exc.AdBotExceptionUserNotExist(
+                        f"User with id={user_id} doesn`t exist"
+                    )
                 await session.commit()
         except SQLAlchemyError as e:
             self._db_error_handle(e)
             raise exc.AdBotExceptionSQL("SQLAlchemyError")
+        self._user_cache.invalidate(user_id)
         # update data in _menu_activity_cache
-        if new_state:
+        if row.menu_closed:
             self._menu_activity_cache.pop(user_id, None)
+            self._wake_event.set()  # forward queued messages
         else:
             self._menu_activity_cache[user_id] = {
                 'menu_closed': False,
@@ -322,9 +540,19 @@ class AdBotServices(AsyncMixin):
                         )
                         if (kw is None):
                             kw = models.Keyword(word=keyword)
-                        if kw not in user.keywords:
-                            user.keywords.append(kw)
+                        if kw in user.keywords:
+                            return True
+                        user.keywords.append(kw)
+                        subscription_state = user.subscription_state
+                        generation = await self._increment_keywords_generation(session)
                         await session.commit()
+                    self._user_cache.invalidate(user_id)
+                    self._update_keywords_index(
+                        generation,
+                        lambda index: index.add_keyword(
+                            user_id, keyword, subscription_state
+                        )
+                    )
                     return True
 
                 except (IntegrityError, OperationalError):
@@ -353,10 +581,15 @@ class AdBotServices(AsyncMixin):
                 kw = await session.scalar(select(models.Keyword).where(
                     models.Keyword.word == keyword)
                 )
-                if kw:
-                    if kw in user.keywords:
-                        user.keywords.remove(kw)
-                    await session.commit()
+                if (kw is None) or (kw not in user.keywords):
+                    return True
+                user.keywords.remove(kw)
+                generation = await self._increment_keywords_generation(session)
+                await session.commit()
+            self._user_cache.invalidate(user_id)
+            self._update_keywords_index(
+                generation, lambda index: index.remove_keyword(user_id, keyword)
+            )
             return True
         except SQLAlchemyError as e:
             self._db_error_handle(e)
@@ -366,10 +599,13 @@ class AdBotServices(AsyncMixin):
     # Messages management
 
     async def add_message(
-        self, cat_id: int, source_id: int, msg_text: str, url: str
+        self, cat_id: int, source_id: int, msg_text: str, url: str,
+        fetched_dt: Optional[datetime] = None
     ) -> bool:
         """
             Inserts message into DB.
+            `fetched_dt` is the time the message was picked up by message fetcher (for
+            latency tracing).
             Returns True on success.
             Raises:
                 `AdBotExceptionSQL` exception on DB error
@@ -384,112 +620,1013 @@ class AdBotServices(AsyncMixin):
                     url=url,
                     text_hash=md5(
                         msg_text.encode('utf-8'), usedforsecurity=False
-                    ).hexdigest()
+                    ).hexdigest(),
+                    fetched_dt=fetched_dt,
+                    added_dt=datetime.now(),
+                    minhash=minhash.to_bytes(minhash.minhash(msg_text))
                 )
                 session.add(msg)
                 await session.commit()
+            self._latency_stats.record(
+                latency_stats.STAGE_FETCH_TO_ADD, fetched_dt, msg.added_dt
+            )
+            self._wake_event.set()
             return True
         except SQLAlchemyError as e:
             self._db_error_handle(e)
             raise exc.AdBotExceptionSQL("SQLAlchemyError")
 
 
-    async def _process_messages(self) -> None:
+    # Latency stats
+
+    def record_message_sent(
+        self,
+        event: events.AdBotMessageForwardRequest | events.AdBotDigestForwardRequest,
+        sent_dt: Optional[datetime] = None
+    ) -> None:
+        """
+            Records latencies of the message that was sent to user by presentation layer
+            (from forward request to sending and total latency from fetching or adding
+            the message).
+        """
+        if sent_dt is None:
+            sent_dt = datetime.now()
+        self._latency_stats.record(
+            latency_stats.STAGE_FORWARD_TO_SEND, event.requested_dt, sent_dt
+        )
+        self._latency_stats.record(
+            latency_stats.STAGE_TOTAL, event.fetched_dt or event.added_dt, sent_dt
+        )
+        if event.outbox_id is not None:
+            self._outbox_sent_ids.append(event.outbox_id)
+            self._outbox_failed.pop(event.outbox_id, None)
+            self._release_outbox_lease(event.outbox_id)
+            self._check_outbox_acks_count()
+
+
+    def record_message_sending(
+        self,
+        event: events.AdBotMessageForwardRequest | events.AdBotDigestForwardRequest
+    ) -> None:
+        """
+            Records that presentation layer started sending the message (e.g. sender
+            took it from the queue). The lease of outbox entry is renewed for
+            `_OUTBOX_LEASE_SEC` seconds, so the entry isn't forwarded again while it
+            waited in queues.
+        """
+        lease = self._outbox_leases.get(event.outbox_id)
+        if lease is not None:
+            self._outbox_leases[event.outbox_id] = (
+                lease[0], datetime.now() + timedelta(seconds=self._OUTBOX_LEASE_SEC)
+            )
+            self._outbox_renewed_ids.add(event.outbox_id)
+
+
+    def record_message_failed(
+        self,
+        event: events.AdBotMessageForwardRequest | events.AdBotDigestForwardRequest,
+        retry: bool = True
+    ) -> None:
+        """
+            Records that the message wasn't sent to user by presentation layer.
+            If `retry` is True, the message will be forwarded again after delay (see
+            `_write_outbox_acks`), otherwise it's marked as failed.
+        """
+        if event.outbox_id is not None:
+            self._outbox_failed[event.outbox_id] = retry
+            self._release_outbox_lease(event.outbox_id)
+            self._check_outbox_acks_count()
+
+
+    def _release_outbox_lease(self, outbox_id: int) -> None:
+        self._outbox_leases.pop(outbox_id, None)
+        self._outbox_renewed_ids.discard(outbox_id)
+
+
+    def _check_outbox_acks_count(self) -> None:
+        if len(self._outbox_sent_ids) + len(self._outbox_failed) >= \
+                self._OUTBOX_ACK_BATCH_SIZE:
+            self._outbox_ack_event.set()
+
+
+    def get_latency_stats(self) -> dict[str, dict[str, float]]:
+        """
+            Returns latency stats of message processing stages: dict where key is
+            stage name (see `latency_stats` module) and value is dict with the count of
+            records, mean, p50, p90, p99 and max latencies (seconds).
+        """
+        return self._latency_stats.summary()
+
+
+    def reset_latency_stats(self) -> None:
+        self._latency_stats.reset()
+
+
+    async def _process_messages(
+        self, chunk_done: Optional[Callable[[], Awaitable[None]]] = None
+    ) -> None:
         """
             Filters unprocessed messages, puts them to users's forward queues according to
             total keywords list (only for users with `subscription state` = True)
+            Messages are read in chunks (`_PROCESS_MESSAGES_CHUNK_SIZE`) ordered by `id`,
+            every chunk is processed and commited in its own session. Next chunk is read
+            starting from the last processed id, so memory usage doesn't depend on the
+            size of backlog and chunks commited before an error are not lost.
+            `chunk_done` is awaited after every commited chunk.
             Raises:
                 `AdBotExceptionSQL` exception on DB error  
         """
+        last_id = 0
+        self._processed_cnt = 0
         try:
-            async with self._db_pool() as session:
-                session: AsyncSession
-                keywords = await self._get_all_keywords(session)
-                st = select(models.GroupChatMessage) \
-                    .where(models.GroupChatMessage.processed == False) \
-                    .options(selectinload(models.GroupChatMessage.users))
-                msgs = (await session.scalars(st)).all()
-                for msg in msgs:
-                    msg_text = msg.text.lower()
-                    for kw, user_ids in keywords.items():
-                        if kw in msg_text:
-                            for user_id in user_ids:
-                                user = await session.get(
-                                    models.User, user_id,
-                                    # options=[
-                                    #     selectinload(models.User.forward_queue)
-                                    # ]
-                                )
-                                # user.forward_queue.append(msg)
-                                if user not in msg.users:
-                                    msg.users.append(user)
-                                self._updated_uids.add(user.id)
-                    msg.processed = True
-                await session.commit()
+            while True:
+                last_id = await self._process_messages_chunk(last_id)
+                if last_id is None:
+                    break
+                if chunk_done is not None:
+                    await chunk_done()
         except SQLAlchemyError as e:
             self._db_error_handle(e)
             raise exc.AdBotExceptionSQL("SQLAlchemyError")
 
 
-    async def _get_all_keywords(self, session: AsyncSession) -> Optional[dict]:
+    async def _process_messages_chunk(self, last_id: int) -> Optional[int]:
         """
-            Creates total list of all keywords of users with `subscription state`=True.
-            Returns dict of keywords, where key is keyword and value is list of users ids.
+            Processes the chunk of unprocessed messages with `id` > `last_id`.
+            Duplicates of recently processed messages are skipped (see
+            `_filter_duplicates`), near-duplicates are not forwarded to users who
+            received similar message (see `_filter_near_duplicates`).
+            Links between users and messages (forward queue) are inserted by multi-row
+            INSERT statements, duplicated links are ignored by DB.
+            Returns id of the last processed message or None if there are no more
+            unprocessed messages.
             Raises:
                 SQLAlchemyError on DB error
         """
-        if True: #self._keywords_update_required:
-            self._keywords_cache = {}
-            st = select(models.Keyword) \
-                    .join_from(models.Keyword, models.user_keyword_link) \
-                    .join_from(models.user_keyword_link, models.User) \
-                    .where(models.User.subscription_state == True) \
-                    .group_by(models.Keyword.id) \
-                    .options(
-                        selectinload(models.Keyword.users).options(
-                            load_only(models.User.id, models.User.subscription_state)
-                        )
+        async with self._db_pool() as session:
+            session: AsyncSession
+            keywords = await self._get_all_keywords(session)
+            st = select(
+                    models.GroupChatMessage.id,
+                    models.GroupChatMessage.text,
+                    models.GroupChatMessage.text_hash,
+                    models.GroupChatMessage.added_dt,
+                    models.GroupChatMessage.minhash
+                ) \
+                .where(models.GroupChatMessage.processed == False) \
+                .where(models.GroupChatMessage.id > last_id) \
+                .order_by(models.GroupChatMessage.id) \
+                .limit(self._PROCESS_MESSAGES_CHUNK_SIZE)
+            msgs = (await session.execute(st)).all()
+            if not msgs:
+                return None
+            unique_msgs = await self._filter_duplicates(session, msgs)
+            msg_users: dict[int, set[int]] = {}
+            matches = await self._match_messages([(m.id, m.text) for m in unique_msgs])
+            for msg_id, msg_keywords in matches:
+                users = set()
+                for kw in msg_keywords:
+                    users.update(keywords.get(kw, ()))
+                msg_users[msg_id] = users
+            near_dup_ids = self._filter_near_duplicates(unique_msgs, msg_users)
+            processed_dt = datetime.now()
+            links = {
+                (user_id, msg_id)
+                    for msg_id, users in msg_users.items() for user_id in users
+            }
+            try:
+                inserted_uids = await self._insert_forward_queue_links(session, links)
+                st = update(models.GroupChatMessage) \
+                    .where(models.GroupChatMessage.id.in_([msg.id for msg in msgs])) \
+                    .values(processed=True, processed_dt=processed_dt)
+                await session.execute(st)
+                await session.commit()
+            except BaseException:
+                for msg_id in near_dup_ids:
+                    self._near_duplicates.remove(msg_id)
+                raise
+        self._updated_uids.update(user_id for user_id, _ in links)
+        for user_id in inserted_uids:
+            self._change_forward_queue_len(user_id, 1)
+        self._processed_cnt += len(msgs)
+        for msg in msgs:
+            self._latency_stats.record(
+                latency_stats.STAGE_ADD_TO_PROCESS, msg.added_dt, processed_dt
+            )
+        return msgs[-1].id
+
+
+    async def _filter_duplicates(
+        self, session: AsyncSession, msgs: Sequence[Row]
+    ) -> list[Row]:
+        """
+            Filters out duplicates: messages with the same `text_hash` as a message that
+            was added not earlier than `_duplicates_window` before and was processed
+            already (or goes earlier in this chunk).
+            The result of matching of duplicate would be the same as the result of the
+            earlier message, so users who received that message don't get it again.
+            Returns list of messages that should be matched.
+            Raises:
+                SQLAlchemyError on DB error
+        """
+        if not self._duplicates_window:
+            return list(msgs)
+
+        # Last `added_dt` of processed messages with the same hashes
+        min_dt = min((msg.added_dt for msg in msgs if msg.added_dt), default=None)
+        seen: dict[str, datetime] = {}
+        if min_dt is not None:
+            hashes = {msg.text_hash for msg in msgs}
+            dt_from = min_dt - self._duplicates_window
+            st = select(
+                    models.GroupChatMessage.text_hash,
+                    func.max(models.GroupChatMessage.added_dt)
+                ) \
+                .where(models.GroupChatMessage.text_hash.in_(hashes)) \
+                .where(models.GroupChatMessage.processed == True) \
+                .where(models.GroupChatMessage.added_dt >= dt_from) \
+                .group_by(models.GroupChatMessage.text_hash)
+            seen = dict((await session.execute(st)).all())
+
+        unique_msgs = []
+        for msg in msgs:
+            seen_dt = seen.get(msg.text_hash)
+            msg_dt = msg.added_dt or datetime.now()
+            if (seen_dt is not None) and (seen_dt >= msg_dt - self._duplicates_window):
+                logger.debug(f'Message {msg.id} is a duplicate, skip it')
+                continue
+            unique_msgs.append(msg)
+            seen[msg.text_hash] = msg_dt
+        return unique_msgs
+
+
+    def _filter_near_duplicates(
+        self, msgs: Sequence[Row], msg_users: dict[int, set[int]]
+    ) -> list[int]:
+        """
+            Removes from `msg_users` (message id -> set of users ids) users who received
+            similar message (near-duplicate) during `_duplicates_window`.
+            Adds messages to the near-duplicates index.
+            Returns ids of messages added to the index.
+        """
+        if not self._duplicates_window:
+            return []
+
+        missing = [msg for msg in msgs if msg.minhash is None]
+        signatures = dict(zip(
+            (msg.id for msg in missing), minhash.minhash_many(m.text for m in missing)
+        ))
+
+        min_dt = min((msg.added_dt for msg in msgs if msg.added_dt), default=None)
+        if min_dt is not None:
+            self._near_duplicates.evict(min_dt - self._duplicates_window)
+
+        added_ids = []
+        for msg in msgs:
+            signature = signatures.get(msg.id) or minhash.from_bytes(msg.minhash)
+            if signature is None:
+                continue
+            msg_dt = msg.added_dt or datetime.now()
+            received = set()
+            for entry in self._near_duplicates.find(signature):
+                if entry.added_dt >= msg_dt - self._duplicates_window:
+                    received.update(entry.recipients)
+            users = msg_users.get(msg.id, set())
+            if received:
+                logger.debug(f'Message {msg.id} is a near-duplicate')
+                msg_users[msg.id] = users - received
+            if users or received:
+                self._near_duplicates.add(
+                    NearDuplicate(msg.id, signature, msg_dt, users | received)
+                )
+                added_ids.append(msg.id)
+        return added_ids
+
+
+    async def _load_near_duplicates_index(self, session: AsyncSession) -> None:
+        """
+            Loads signatures of messages processed during `_duplicates_window` into
+            near-duplicates index. Users who received these messages are determined by
+            matching texts with current keywords.
+            Messages are read in chunks (`NEAR_DUPLICATES_LOAD_CHUNK_SIZE`).
+            Raises:
+                SQLAlchemyError on DB error
+        """
+        if not self._duplicates_window:
+            return
+        keywords = self._keywords_index.as_dict()
+        matcher = self._keywords_index.matcher
+        window_start = datetime.now() - self._duplicates_window
+        last_id = -1
+        while True:
+            st = select(
+                    models.GroupChatMessage.id,
+                    models.GroupChatMessage.text,
+                    models.GroupChatMessage.added_dt,
+                    models.GroupChatMessage.minhash
+                ) \
+                .where(models.GroupChatMessage.processed == True) \
+                .where(models.GroupChatMessage.minhash != None) \
+                .where(models.GroupChatMessage.added_dt >= window_start) \
+                .where(models.GroupChatMessage.id > last_id) \
+                .order_by(models.GroupChatMessage.id) \
+                .limit(NEAR_DUPLICATES_LOAD_CHUNK_SIZE)
+            msgs = (await session.execute(st)).all()
+            for msg in msgs:
+                users = set()
+                for kw in matcher.find_all(msg.text.lower()):
+                    users.update(keywords[kw])
+                if users:
+                    self._near_duplicates.add(NearDuplicate(
+                        msg.id, minhash.from_bytes(msg.minhash), msg.added_dt, users
+                    ))
+            if len(msgs) < NEAR_DUPLICATES_LOAD_CHUNK_SIZE:
+                break
+            last_id = msgs[-1].id
+
+
+    async def _match_messages(
+        self, msgs: Sequence[tuple[int, str]]
+    ) -> list[tuple[int, Iterable[str]]]:
+        """
+            Finds keywords in messages (id, text).
+            Large chunks are matched in the matching pool (if it's enabled).
+            Returns list of (message id, found keywords).
+        """
+        index = self._keywords_index
+        if (self._matching_pool is not None) and \
+                (len(msgs) >= self._MATCHING_POOL_MIN_MESSAGES):
+            return await self._matching_pool.match(
+                [(msg_id, text) for msg_id, text in msgs],
+                list(index.as_dict().keys()),
+                index.generation
+            )
+        matcher = index.matcher
+        return [(msg_id, matcher.find_all(text.lower())) for msg_id, text in msgs]
+
+
+    async def _load_forward_queue_lens(self, session: AsyncSession) -> None:
+        """
+            Loads the number of queued messages of every user. Then it's maintained by
+            methods that add and remove links (see `_change_forward_queue_len`).
+            Raises:
+                SQLAlchemyError on DB error
+        """
+        link = models.user_message_link
+        st = select(link.c.user_id, func.count()).group_by(link.c.user_id)
+        self._forward_queue_lens = {
+            user_id: cnt for user_id, cnt in (await session.execute(st)).all()
+        }
+
+
+    def _change_forward_queue_len(self, user_id: int, delta: int) -> None:
+        cnt = self._forward_queue_lens.get(user_id, 0) + delta
+        if cnt > 0:
+            self._forward_queue_lens[user_id] = cnt
+        else:
+            self._forward_queue_lens.pop(user_id, None)
+
+
+    async def _insert_forward_queue_links(
+        self, session: AsyncSession, links: set[tuple[int, int]]
+    ) -> list[int]:
+        """
+            Inserts links (user_id, message_id) into `user_message_link` table by
+            multi-row INSERT statements. Existing links are ignored.
+            Returns user ids of inserted links (one item per link).
+            Raises:
+                SQLAlchemyError on DB error
+        """
+        link = models.user_message_link
+        dialect = session.bind.dialect.name
+        if dialect == 'postgresql':
+            st = postgresql.insert(link).on_conflict_do_nothing()
+        elif dialect == 'sqlite':
+            st = sqlite.insert(link).on_conflict_do_nothing()
+        else:
+            st = None
+        rows = [{'user_id': user_id, 'message_id': msg_id} for user_id, msg_id in links]
+        if st is None:
+            # No conflicts handling, all links are inserted (or exception is raised)
+            for i in range(0, len(rows), INSERT_BATCH_SIZE):
+                await session.execute(insert(link).values(rows[i:i + INSERT_BATCH_SIZE]))
+            return [user_id for user_id, _ in links]
+        st = st.returning(link.c.user_id)
+        inserted_uids = []
+        for i in range(0, len(rows), INSERT_BATCH_SIZE):
+            res = await session.execute(st.values(rows[i:i + INSERT_BATCH_SIZE]))
+            inserted_uids.extend(res.scalars())
+        return inserted_uids
+
+
+    async def _get_all_keywords(self, session: AsyncSession) -> dict[str, set[int]]:
+        """
+            Returns total list of all keywords of users with `subscription state`=True
+            from the keywords index.
+            Returns dict of keywords, where key is keyword and value is set of users ids.
+            Index is reloaded from DB only if DB generation counter shows that data was
+            changed by another writer.
+            Raises:
+                SQLAlchemyError on DB error
+        """
+        generation = await self._get_keywords_generation(session)
+        if self._keywords_update_required or \
+                (generation != self._keywords_index.generation):
+            await self._reload_keywords_index(session)
+        return self._keywords_index.as_dict()
+
+
+    async def _reload_keywords_index(self, session: AsyncSession) -> None:
+        """
+            Loads keywords index (keyword lists of all users and their subscription
+            states) from DB.
+            Raises:
+                SQLAlchemyError on DB error
+        """
+        logger.debug('Reload keywords index')
+        generation = await self._get_keywords_generation(session)
+        st = select(
+                models.user_keyword_link.c.user_id,
+                models.Keyword.word,
+                models.User.subscription_state
+            ) \
+            .join_from(models.user_keyword_link, models.Keyword) \
+            .join_from(models.user_keyword_link, models.User)
+        self._keywords_index.load((await session.execute(st)).all(), generation)
+        self._keywords_update_required = False
+
+
+    async def _init_keywords_generation(self, session: AsyncSession) -> None:
+        """
+            Creates the row of keywords generation counter if it doesn't exist.
+            Raises:
+                SQLAlchemyError on DB error
+        """
+        if await self._get_keywords_generation(session) is None:
+            session.add(models.KeywordsGeneration(id=KEYWORDS_GENERATION_ID))
+            await session.commit()
+
+
+    async def _get_keywords_generation(self, session: AsyncSession) -> Optional[int]:
+        st = select(models.KeywordsGeneration.generation) \
+                .where(models.KeywordsGeneration.id == KEYWORDS_GENERATION_ID)
+        return await session.scalar(st)
+
+
+    async def _increment_keywords_generation(
+        self, session: AsyncSession
+    ) -> Optional[int]:
+        """
+            Increments keywords generation counter in the current transaction.
+            Has to be called by every method that changes keyword lists or subscription
+            states.
+            Returns new value of the counter.
+            Raises:
+                SQLAlchemyError on DB error
+        """
+        st = update(models.KeywordsGeneration) \
+                .where(models.KeywordsGeneration.id == KEYWORDS_GENERATION_ID) \
+                .values(generation=models.KeywordsGeneration.generation + 1)
+        await session.execute(st)
+        return await self._get_keywords_generation(session)
+
+
+    def _update_keywords_index(
+        self, generation: Optional[int], update_func: Callable[[KeywordIndex], None]
+    ) -> None:
+        """
+            Applies delta (`update_func`) to keywords index after the change with new
+            generation `generation` was commited.
+            If some changes made by other writers were missed, the delta isn't applied
+            and the index will be reloaded from DB on the next call of
+            `_get_all_keywords`.
+        """
+        index = self._keywords_index
+        if (index.generation is not None) and (generation == index.generation + 1):
+            update_func(index)
+            index.generation = generation
+        elif (index.generation is None) or (generation is None) or \
+                (generation > index.generation):
+            self._keywords_update_required = True
+
+
+    async def _apply_retention(self) -> int:
+        """
+            Deletes processed messages that are older than retention period or beyond
+            the newest `_retention_max_messages` messages, together with their links to
+            forward queues.
+            Messages are deleted in batches (`_RETENTION_BATCH_SIZE`), every batch in
+            its own short transaction. If archive is enabled, every batch is appended to
+            archive before it's deleted.
+            Returns the number of deleted messages.
+            Raises:
+                `AdBotExceptionSQL` exception on DB error
+        """
+        if (self._retention_period is None) and (self._retention_max_messages <= 0):
+            return 0
+        conditions = []
+        if self._retention_period is not None:
+            cutoff_dt = datetime.now() - self._retention_period
+            conditions.append(models.GroupChatMessage.added_dt < cutoff_dt)
+        deleted_cnt = 0
+        try:
+            if self._retention_max_messages > 0:
+                async with self._db_pool() as session:
+                    session: AsyncSession
+                    st = select(models.GroupChatMessage.id) \
+                        .order_by(models.GroupChatMessage.id.desc()) \
+                        .offset(self._retention_max_messages) \
+                        .limit(1)
+                    max_id = await session.scalar(st)
+                if max_id is not None:
+                    conditions.append(models.GroupChatMessage.id <= max_id)
+            if not conditions:
+                return 0
+            while True:
+                async with self._db_pool() as session:
+                    cnt = await self._delete_expired_messages_batch(
+                        session, or_(*conditions)
                     )
+                deleted_cnt += cnt
+                if cnt < self._RETENTION_BATCH_SIZE:
+                    break
+                await asyncio.sleep(0)  # let other tasks run between batches
+        except SQLAlchemyError as e:
+            self._db_error_handle(e)
+            raise exc.AdBotExceptionSQL("SQLAlchemyError")
+        if deleted_cnt:
+            logger.info(f'Retention. Deleted {deleted_cnt} messages')
+        return deleted_cnt
 
-            for kw in (await session.scalars(st)).all():
-                self._keywords_cache[kw.word] = [
-                    user.id for user in kw.users if user.subscription_state
-                ]
 
-        return self._keywords_cache     # Success
+    async def _delete_expired_messages_batch(self, session: AsyncSession, expired) -> int:
+        """
+            Deletes (and archives) the batch of processed messages that match `expired`
+            condition. Returns the number of deleted messages.
+            Raises:
+                SQLAlchemyError on DB error
+        """
+        msg_table = models.GroupChatMessage.__table__
+        columns = [msg_table.c.id]
+        if self._archive is not None:
+            columns = [c for c in msg_table.c if c.name != 'minhash']
+        st = select(*columns) \
+            .where(models.GroupChatMessage.processed == True) \
+            .where(expired) \
+            .order_by(models.GroupChatMessage.id) \
+            .limit(self._RETENTION_BATCH_SIZE)
+        rows = (await session.execute(st)).all()
+        if not rows:
+            return 0
+        ids = [row.id for row in rows]
+        if self._archive is not None:
+            await asyncio.to_thread(
+                self._archive.append, [row._asdict() for row in rows]
+            )
+        link = models.user_message_link
+        st = select(link.c.user_id, func.count()) \
+            .where(link.c.message_id.in_(ids)) \
+            .group_by(link.c.user_id)
+        deleted_links = (await session.execute(st)).all()
+        st = delete(link).where(link.c.message_id.in_(ids))
+        await session.execute(st)
+        st = delete(models.GroupChatMessage) \
+            .where(models.GroupChatMessage.id.in_(ids)) \
+            .execution_options(synchronize_session=False)
+        await session.execute(st)
+        await session.commit()
+        for user_id, cnt in deleted_links:
+            self._change_forward_queue_len(user_id, -cnt)
+        for msg_id in ids:
+            self._near_duplicates.remove(msg_id)
+        return len(ids)
 
 
     async def _forward_messages(self) -> None:
         """
-            Generates `AdBotMessageForwardRequest` events for every message in user's
-            forward queue.
-            Removes messages from user's forward queues.
-            Only for users with `forwarding` = True.
+            Moves messages from users's forward queues to outbox and generates
+            `AdBotMessageForwardRequest` events for them (see `_dispatch_outbox`).
+            Only for users with `forwarding` = True and closed menu.
+            Queued messages are read in chunks (`_FORWARD_MESSAGES_CHUNK_SIZE`), links
+            of every chunk are deleted by one DELETE statement.
+            Messages of users in digest mode are forwarded by `_forward_digests`.
+            Raises:
+                `AdBotExceptionSQL` exception on DB error
+        """
+        try:
+            while await self._forward_messages_chunk():
+                pass
+            await self._forward_digests()
+        except SQLAlchemyError as e:
+            self._db_error_handle(e)
+            raise exc.AdBotExceptionSQL("SQLAlchemyError")
+        await self._dispatch_outbox()
+
+
+    async def _forward_messages_chunk(self) -> int:
+        """
+            Moves the chunk of queued messages from forward queues to outbox.
+            Returns the number of moved messages.
             Raises:
                 SQLAlchemyError on DB error
         """
+        link = models.user_message_link
+        async with self._db_pool() as session:
+            session: AsyncSession
+            st = select(
+                    link.c.user_id,
+                    link.c.message_id,
+                    models.User.telegram_id,
+                    models.GroupChatMessage.url,
+                    models.GroupChatMessage.text,
+                    models.GroupChatMessage.fetched_dt,
+                    models.GroupChatMessage.added_dt,
+                    models.GroupChatMessage.processed_dt
+                ) \
+                .join(models.User, models.User.id == link.c.user_id) \
+                .join(
+                    models.GroupChatMessage,
+                    models.GroupChatMessage.id == link.c.message_id
+                ) \
+                .where(models.User.forwarding_state == True) \
+                .where(models.User.menu_closed == True) \
+                .where(func.coalesce(models.User.digest_mode, False) == False) \
+                .order_by(link.c.user_id, link.c.message_id) \
+                .limit(self._FORWARD_MESSAGES_CHUNK_SIZE)
+            rows = (await session.execute(st)).all()
+            if not rows:
+                return 0
+            now = datetime.now()
+            outbox_rows = [
+                {
+                    'user_id': row.user_id,
+                    'telegram_id': row.telegram_id,
+                    'is_digest': False,
+                    'url': row.url,
+                    'text': row.text,
+                    'fetched_dt': row.fetched_dt,
+                    'added_dt': row.added_dt,
+                    'processed_dt': row.processed_dt,
+                    'state': models.OUTBOX_PENDING,
+                    'attempts': 0,
+                    'due_dt': now,
+                } for row in rows
+            ]
+            await session.execute(insert(models.OutboxMessage.__table__), outbox_rows)
+            st = delete(link) \
+                .where(
+                    tuple_(link.c.user_id, link.c.message_id).in_(
+                        [(row.user_id, row.message_id) for row in rows]
+                    )
+                )
+            await session.execute(st)
+            await session.commit()
+        for row in rows:
+            self._change_forward_queue_len(row.user_id, -1)
+        return len(rows)
+
+
+    async def _forward_digests(self) -> None:
+        """
+            Moves queued messages to outbox as digests (up to `_digest_max_messages`
+            URLs in one digest) for users in digest mode whose last digest was sent more
+            than `_digest_interval` ago or who have at least `_digest_max_messages`
+            queued messages (only full digests are sent in this case).
+            Only for users with `forwarding` = True and closed menu.
+            Raises:
+                SQLAlchemyError on DB error
+        """
+        link = models.user_message_link
+        now = datetime.now()
+        queue_len = func.count(link.c.message_id)
+        async with self._db_pool() as session:
+            session: AsyncSession
+            st = select(
+                    models.User.id,
+                    models.User.telegram_id,
+                    models.User.digest_sent_dt
+                ) \
+                .join(link, link.c.user_id == models.User.id) \
+                .where(models.User.forwarding_state == True) \
+                .where(models.User.menu_closed == True) \
+                .where(models.User.digest_mode == True) \
+                .group_by(
+                    models.User.id, models.User.telegram_id, models.User.digest_sent_dt
+                ) \
+                .having(
+                    or_(
+                        queue_len >= self._digest_max_messages,
+                        models.User.digest_sent_dt == None,
+                        models.User.digest_sent_dt <= now - self._digest_interval
+                    )
+                )
+            users = (await session.execute(st)).all()
+        for user in users:
+            due_by_time = (user.digest_sent_dt is None) or \
+                (user.digest_sent_dt <= now - self._digest_interval)
+            async with self._db_pool() as session:
+                await self._forward_user_digests(
+                    session, user.id, user.telegram_id, due_by_time
+                )
+
+
+    async def _forward_user_digests(
+        self, session: AsyncSession, user_id: int, telegram_id: int, due_by_time: bool
+    ) -> None:
+        """
+            Moves queued messages of the user from forward queue to outbox as digests.
+            If `due_by_time` is False, only full digests are sent.
+            Raises:
+                SQLAlchemyError on DB error
+        """
+        link = models.user_message_link
+        sent_cnt = 0
+        while True:
+            st = select(
+                    link.c.message_id,
+                    models.GroupChatMessage.url,
+                    models.GroupChatMessage.fetched_dt,
+                    models.GroupChatMessage.added_dt,
+                    models.GroupChatMessage.processed_dt
+                ) \
+                .join(
+                    models.GroupChatMessage,
+                    models.GroupChatMessage.id == link.c.message_id
+                ) \
+                .where(link.c.user_id == user_id) \
+                .order_by(link.c.message_id) \
+                .limit(self._digest_max_messages)
+            rows = (await session.execute(st)).all()
+            if (not rows) or \
+                    ((not due_by_time) and (len(rows) < self._digest_max_messages)):
+                break
+            outbox_msg = models.OutboxMessage(
+                user_id=user_id,
+                telegram_id=telegram_id,
+                is_digest=True,
+                url='\n'.join(row.url for row in rows),
+                fetched_dt=rows[0].fetched_dt,
+                added_dt=rows[0].added_dt,
+                processed_dt=rows[0].processed_dt,
+                state=models.OUTBOX_PENDING,
+                attempts=0,
+                due_dt=datetime.now()
+            )
+            session.add(outbox_msg)
+            st = delete(link) \
+                .where(link.c.user_id == user_id) \
+                .where(link.c.message_id.in_([row.message_id for row in rows]))
+            await session.execute(st)
+            sent_cnt += len(rows)
+            if len(rows) < self._digest_max_messages:
+                break
+        if sent_cnt:
+            st = update(models.User) \
+                .where(models.User.id == user_id) \
+                .values(digest_sent_dt=datetime.now())
+            await session.execute(st)
+            await session.commit()
+            self._user_cache.invalidate(user_id)
+            self._change_forward_queue_len(user_id, -sent_cnt)
+
+
+    async def _dispatch_outbox(self) -> int:
+        """
+            Writes buffered acknowledgements and generates `AdBotMessageForwardRequest`
+            and `AdBotDigestForwardRequest` events for outbox entries that are due:
+            pending entries (new or failed entries whose retry delay expired) and
+            in-flight entries whose lease expired (sending wasn't acknowledged, e.g.
+            because of restart).
+            The number of leased entries is limited by `_OUTBOX_MAX_IN_FLIGHT` (and by
+            `_OUTBOX_MAX_IN_FLIGHT_PER_USER` for every user), the rest are dispatched
+            after acknowledgements, so that entries don't wait in the queues longer than
+            the lease.
+            Entries are leased for `_OUTBOX_LEASE_SEC` seconds after publishing, the
+            lease is renewed when the sending starts (see `record_message_sending`).
+            Waits while the queue of events is full (see `MessageBus.publish`).
+            Returns the number of generated events.
+            Raises:
+                `AdBotExceptionSQL` exception on DB error
+        """
+        outbox = models.OutboxMessage
+        dispatched_cnt = 0
+        try:
+            async with self._outbox_lock:
+                await self._write_outbox_acks()
+                last_id = 0
+                while True:
+                    now = datetime.now()
+                    # Entries with expired lease can be dispatched again
+                    self._outbox_leases = {
+                        outbox_id: lease
+                            for outbox_id, lease in self._outbox_leases.items()
+                                if lease[1] > now
+                    }
+                    free_cnt = self._OUTBOX_MAX_IN_FLIGHT - len(self._outbox_leases)
+                    if free_cnt <= 0:
+                        break
+                    user_leases_cnt = Counter(
+                        user_id for user_id, _ in self._outbox_leases.values()
+                    )
+                    async with self._db_pool() as session:
+                        session: AsyncSession
+                        user_rn = func.row_number() \
+                            .over(partition_by=outbox.user_id, order_by=outbox.id) \
+                            .label('user_rn')
+                        due = select(*outbox.__table__.c, user_rn) \
+                            .where(
+                                outbox.state.in_(
+                                    [models.OUTBOX_PENDING, models.OUTBOX_IN_FLIGHT]
+                                )
+                            ) \
+                            .where(outbox.due_dt <= now) \
+                            .where(outbox.id > last_id) \
+                            .subquery()
+                        st = select(due) \
+                            .where(due.c.user_rn <= self._OUTBOX_MAX_IN_FLIGHT_PER_USER) \
+                            .order_by(due.c.id) \
+                            .limit(self._FORWARD_MESSAGES_CHUNK_SIZE)
+                        rows = (await session.execute(st)).all()
+                        if not rows:
+                            break
+                        last_id = rows[-1].id
+                        leased_rows = []
+                        for row in rows:
+                            if (row.id in self._outbox_leases) or \
+                                    (user_leases_cnt[row.user_id] >=
+                                        self._OUTBOX_MAX_IN_FLIGHT_PER_USER):
+                                continue
+                            user_leases_cnt[row.user_id] += 1
+                            leased_rows.append(row)
+                            if len(leased_rows) == free_cnt:
+                                break
+                        if leased_rows:
+                            st = update(outbox) \
+                                .where(outbox.id.in_([row.id for row in leased_rows])) \
+                                .values(
+                                    state=models.OUTBOX_IN_FLIGHT,
+                                    attempts=outbox.attempts + 1,
+                                    due_dt=now + timedelta(seconds=self._OUTBOX_LEASE_SEC)
+                                ) \
+                                .execution_options(synchronize_session=False)
+                            await session.execute(st)
+                            await session.commit()
+                    lease_dt = now + timedelta(seconds=self._OUTBOX_LEASE_SEC)
+                    for row in leased_rows:
+                        self._outbox_leases[row.id] = (row.user_id, lease_dt)
+                    for row in leased_rows:
+                        await self.messagebus.publish(self._outbox_event(row, now))
+                        # `publish` can wait, the lease starts when it's published
+                        self._outbox_leases[row.id] = (
+                            row.user_id,
+                            datetime.now() + timedelta(seconds=self._OUTBOX_LEASE_SEC)
+                        )
+                    dispatched_cnt += len(leased_rows)
+                    if len(rows) < self._FORWARD_MESSAGES_CHUNK_SIZE:
+                        break
+        except SQLAlchemyError as e:
+            self._db_error_handle(e)
+            raise exc.AdBotExceptionSQL("SQLAlchemyError")
+        return dispatched_cnt
+
+
+    def _outbox_event(
+        self, row: Row, requested_dt: datetime
+    ) -> events.AdBotMessageForwardRequest | events.AdBotDigestForwardRequest:
+        if row.is_digest:
+            return events.AdBotDigestForwardRequest(
+                user_id=row.user_id,
+                telegram_id=row.telegram_id,
+                message_urls=row.url.split('\n'),
+                fetched_dt=row.fetched_dt,
+                added_dt=row.added_dt,
+                requested_dt=requested_dt,
+                outbox_id=row.id
+            )
+        self._latency_stats.record(
+            latency_stats.STAGE_PROCESS_TO_FORWARD, row.processed_dt, requested_dt
+        )
+        return events.AdBotMessageForwardRequest(
+            user_id=row.user_id,
+            telegram_id=row.telegram_id,
+            message_url=row.url,
+            message_text=row.text,
+            fetched_dt=row.fetched_dt,
+            added_dt=row.added_dt,
+            processed_dt=row.processed_dt,
+            requested_dt=requested_dt,
+            outbox_id=row.id
+        )
+
+
+    async def _flush_outbox_acks(self) -> None:
+        """
+            Writes buffered acknowledgements of outbox entries.
+            Raises:
+                `AdBotExceptionSQL` exception on DB error
+        """
+        try:
+            async with self._outbox_lock:
+                await self._write_outbox_acks()
+        except SQLAlchemyError as e:
+            self._db_error_handle(e)
+            raise exc.AdBotExceptionSQL("SQLAlchemyError")
+
+
+    async def _write_outbox_acks(self) -> None:
+        """
+            Writes buffered acknowledgements in one transaction: sent entries are marked
+            as sent, failed entries are returned to pending state with the delay
+            (`_OUTBOX_RETRY_MIN_DELAY_SEC` doubled after every attempt, up to
+            `_OUTBOX_RETRY_MAX_DELAY_SEC`) or marked as failed if they shouldn't be
+            retried or the number of attempts reached `_OUTBOX_MAX_ATTEMPTS`.
+            Leases of entries whose sending started are renewed.
+            Acknowledgements stay in buffer on DB error.
+            Raises:
+                SQLAlchemyError on DB error
+        """
+        sent_ids, self._outbox_sent_ids = self._outbox_sent_ids, []
+        failed, self._outbox_failed = self._outbox_failed, {}
+        renewed_ids, self._outbox_renewed_ids = self._outbox_renewed_ids, set()
+        self._outbox_ack_event.clear()
+        if (not sent_ids) and (not failed) and (not renewed_ids):
+            return
+        outbox = models.OutboxMessage
+        now = datetime.now()
         try:
             async with self._db_pool() as session:
                 session: AsyncSession
-                st = select(models.User) \
-                    .where(models.User.forwarding_state == True) \
-                    .options(selectinload(models.User.forward_queue))
-                users = (await session.scalars(st)).all()
-                for user in users:
-                    for msg in list(user.forward_queue):
-                        if user.menu_closed == True:
-                            event = events.AdBotMessageForwardRequest(
-                                user_id=user.id,
-                                telegram_id=user.telegram_id,
-                                message_url=msg.url,
-                                message_text=msg.text
+                renewed_ids = list(renewed_ids)
+                for i in range(0, len(renewed_ids), INSERT_BATCH_SIZE):
+                    st = update(outbox) \
+                        .where(outbox.id.in_(renewed_ids[i:i + INSERT_BATCH_SIZE])) \
+                        .where(outbox.state == models.OUTBOX_IN_FLIGHT) \
+                        .values(due_dt=now + timedelta(seconds=self._OUTBOX_LEASE_SEC)) \
+                        .execution_options(synchronize_session=False)
+                    await session.execute(st)
+                for i in range(0, len(sent_ids), INSERT_BATCH_SIZE):
+                    st = update(outbox) \
+                        .where(outbox.id.in_(sent_ids[i:i + INSERT_BATCH_SIZE])) \
+                        .values(state=models.OUTBOX_SENT, done_dt=now) \
+                        .execution_options(synchronize_session=False)
+                    await session.execute(st)
+                failed_ids = list(failed.keys())
+                updates = []
+                for i in range(0, len(failed_ids), INSERT_BATCH_SIZE):
+                    st = select(outbox.id, outbox.attempts) \
+                        .where(outbox.id.in_(failed_ids[i:i + INSERT_BATCH_SIZE])) \
+                        .where(outbox.state == models.OUTBOX_IN_FLIGHT)
+                    for row in (await session.execute(st)).all():
+                        if failed[row.id] and (row.attempts < self._OUTBOX_MAX_ATTEMPTS):
+                            delay = min(
+                                self._OUTBOX_RETRY_MIN_DELAY_SEC * 2 ** (row.attempts - 1),
+                                self._OUTBOX_RETRY_MAX_DELAY_SEC
                             )
-                            self.messagebus.post_event(event)
-                            user.forward_queue.remove(msg)
+                            updates.append({
+                                'id': row.id,
+                                'state': models.OUTBOX_PENDING,
+                                'due_dt': now + timedelta(seconds=delay),
+                            })
+                        else:
+                            updates.append({
+                                'id': row.id, 'state': models.OUTBOX_FAILED, 'done_dt': now
+                            })
+                for state in (models.OUTBOX_PENDING, models.OUTBOX_FAILED):
+                    state_updates = [u for u in updates if u['state'] == state]
+                    if state_updates:
+                        await session.execute(update(outbox), state_updates)
+                await session.commit()
+        except SQLAlchemyError:
+            self._outbox_sent_ids = sent_ids + self._outbox_sent_ids
+            self._outbox_failed = failed | self._outbox_failed
+            self._outbox_renewed_ids.update(renewed_ids)
+            raise
+        if failed:
+            logger.warning(f'Outbox. {len(failed)} messages were not sent')
+
+
+    async def _purge_outbox(self) -> int:
+        """
+            Deletes sent and failed outbox entries older than `_OUTBOX_KEEP_DONE_HOURS`.
+            Returns the number of deleted entries.
+            Raises:
+                `AdBotExceptionSQL` exception on DB error
+        """
+        cutoff_dt = datetime.now() - timedelta(hours=self._OUTBOX_KEEP_DONE_HOURS)
+        st = delete(models.OutboxMessage) \
+            .where(
+                models.OutboxMessage.state.in_([models.OUTBOX_SENT, models.OUTBOX_FAILED])
+            ) \
+            .where(models.OutboxMessage.done_dt < cutoff_dt)
+        try:
+            async with self._db_pool() as session:
+                session: AsyncSession
+                res = await session.execute(st)
                 await session.commit()
         except SQLAlchemyError as e:
             self._db_error_handle(e)
             raise exc.AdBotExceptionSQL("SQLAlchemyError")
+        return res.rowcount
 
 
     async def _check_idle_timeouts(self) -> None:
@@ -498,9 +1635,10 @@ class AdBotServices(AsyncMixin):
             Uses cached data to determine whether the menu is open and idle timeout is
             riched.
         """
-        for uid in self._menu_activity_cache.keys():
+        # `publish` can wait, users can open or close the menu meanwhile
+        for uid in list(self._menu_activity_cache.keys()):
             if await self.get_is_idle_with_opened_menu(uid):
-                self.messagebus.post_event(events.AdBotInactivityTimeout(uid))
+                await self.messagebus.publish(events.AdBotInactivityTimeout(uid))
         
 
     async def _check_user_data_updated(self) -> None:
@@ -515,7 +1653,7 @@ class AdBotServices(AsyncMixin):
             if uid in self._menu_activity_cache:
                 umad = self._menu_activity_cache[uid]
                 if umad['menu_closed'] == False:
-                    self.messagebus.post_event(events.AdBotUserDataUpdated(uid))
+                    await self.messagebus.publish(events.AdBotUserDataUpdated(uid))
 
 
     async def run(self) -> None:
@@ -532,26 +1670,28 @@ class AdBotServices(AsyncMixin):
         finally:
             self._stop = True
             self._stopped = True
-            self.messagebus.post_event(events.AdBotStop())
+            if self._matching_pool is not None:
+                self._matching_pool.shutdown()
+            await self.messagebus.publish(events.AdBotStop())
             await self.messagebus.wait_for_tasks_done()
+            self.messagebus.stop()
+            try:
+                await self._flush_outbox_acks()
+            except exc.AdBotExceptionSQL:
+                logger.error(f'Database error during writing outbox acknowledgements')
 
 
     async def _loop_iter(self) -> None:
         """
-            One iteration of main loop.
+            One iteration of main loop with sequentially executed stages (`_loop` runs
+            them concurrently).
+            Waits for new messages (see `_wait_for_work`).
             Processes messages (filter by users's keywords).
             Generates `AdBotMessageForwardRequest` events to forward messages to users.
-            Checks users's inactivity state and generates `AdBotInactivityTimeout` to
-            close menus of inactive users.
             Generates `AdBotUserDataUpdated` events for users with opened menu whose data
             was updated.
         """
-        counter = self._CHECK_IDLE_CYCLES
-        while (not self._stop) and (counter > 0):
-            logger.debug(f"Check idle timeouts")
-            await self._check_idle_timeouts()
-            await asyncio.sleep(self._CHECK_IDLE_INTERVAL_SEC)
-            counter -= 1
+        await self._wait_for_work()
 
         if  not self._stop:
             logger.debug(f"Process messages")
@@ -559,6 +1699,7 @@ class AdBotServices(AsyncMixin):
                 await self._process_messages()
             except exc.AdBotExceptionSQL:
                 logger.error(f'Database error during processing messages')
+            self._adapt_loop_wait()
 
             logger.debug(f"Forward messages")
             try:
@@ -566,21 +1707,181 @@ class AdBotServices(AsyncMixin):
             except exc.AdBotExceptionSQL:
                 logger.error(f'Database error during forwarding messages')
             
-            logger.debug(f"Forward messages")
+            logger.debug(f"Check user data updated")
             await self._check_user_data_updated()
 
 
-    async def _loop(self) -> None:
+    async def _wait_for_work(self) -> None:
         """
-            Processes messages (filter by users's keywords).
-            Generates `AdBotMessageForwardRequest` events to forward messages to users.
-            Checks users's inactivity state and generates `AdBotInactivityTimeout`
-            to close menus of inactive users.
-            Generates `AdBotUserDataUpdated` events for users with opened menu whose data
-            was updated.
+            Waits until `_wake_event` is set (new message added, menu closed, etc.) or
+            `_loop_wait_sec` timeout expires (messages could be added by another
+            process).
+            After wake up waits `_WAKE_DEBOUNCE_SEC` more to collect a batch of
+            messages.
+        """
+        try:
+            await asyncio.wait_for(self._wake_event.wait(), self._loop_wait_sec)
+        except asyncio.TimeoutError:
+            return
+        if not self._stop:
+            await asyncio.sleep(self._WAKE_DEBOUNCE_SEC)
+        self._wake_event.clear()
+
+
+    def _adapt_loop_wait(self) -> None:
+        """
+            Adapts wait timeout of main loop: poll often while messages are coming, back
+            off when there is nothing to do.
+        """
+        if self._processed_cnt > 0:
+            self._loop_wait_sec = self._MIN_LOOP_WAIT_SEC
+        else:
+            self._loop_wait_sec = min(self._loop_wait_sec * 2, self._MAX_LOOP_WAIT_SEC)
+
+
+    async def _run_stage(
+        self, name: str, step: Callable[[], Awaitable[None]]
+    ) -> None:
+        """
+            Supervises the stage of main loop: awaits `step` until main loop is stopped.
+            On DB error the step is restarted after delay (delay doubles after every
+            successive error, from `_STAGE_RESTART_MIN_DELAY_SEC` to
+            `_STAGE_RESTART_MAX_DELAY_SEC`).
+            Other exceptions are reraised.
         """
+        delay = self._STAGE_RESTART_MIN_DELAY_SEC
         while not self._stop:
-            await self._loop_iter()
+            try:
+                await step()
+                delay = self._STAGE_RESTART_MIN_DELAY_SEC
+            except exc.AdBotExceptionSQL:
+                logger.error(f'Database error in `{name}` stage. Restart in {delay} s')
+                restart_time = asyncio.get_running_loop().time() + delay
+                while (not self._stop) and \
+                        (asyncio.get_running_loop().time() < restart_time):
+                    await asyncio.sleep(0.1)
+                delay = min(delay * 2, self._STAGE_RESTART_MAX_DELAY_SEC)
+
+
+    async def _process_stage_step(self, forward_jobs: asyncio.Queue) -> None:
+        """
+            Waits for new messages and processes them.
+            Puts a job to `forward_jobs` after every processed chunk (and after every
+            wake up), so that forwarding starts while next chunk is being processed.
+            Waits if `forward_jobs` queue is full.
+        """
+        await self._wait_for_work()
+        if self._stop:
+            return
+        logger.debug(f"Process messages")
+        put_job = lambda: forward_jobs.put(True)
+        try:
+            await self._process_messages(chunk_done=put_job)
+        finally:
+            self._adapt_loop_wait()
+            if self._processed_cnt == 0:
+                await put_job()     # forward messages queued for users who closed menu
+
+
+    async def _forward_stage_step(self, forward_jobs: asyncio.Queue) -> None:
+        """
+            Takes all pending jobs from `forward_jobs`, forwards messages and generates
+            `AdBotUserDataUpdated` events.
+        """
+        await forward_jobs.get()
+        while not forward_jobs.empty():
+            forward_jobs.get_nowait()
+        logger.debug(f"Forward messages")
+        await self._forward_messages()
+        logger.debug(f"Check user data updated")
+        await self._check_user_data_updated()
+
+
+    async def _check_idle_timeouts_step(self) -> None:
+        """
+            Checks users's inactivity state and waits `_CHECK_IDLE_INTERVAL_SEC` seconds.
+        """
+        logger.debug(f"Check idle timeouts")
+        await self._check_idle_timeouts()
+        await asyncio.sleep(self._CHECK_IDLE_INTERVAL_SEC)
+
+
+    async def _retention_step(self) -> None:
+        """
+            Applies retention policy, deletes old outbox entries and waits
+            `_RETENTION_INTERVAL_SEC` seconds.
+        """
+        logger.debug(f"Apply retention policy")
+        await self._apply_retention()
+        await self._purge_outbox()
+        await asyncio.sleep(self._RETENTION_INTERVAL_SEC)
+
+
+    async def _outbox_step(self) -> None:
+        """
+            Waits `_OUTBOX_FLUSH_INTERVAL_SEC` seconds (or until `_OUTBOX_ACK_BATCH_SIZE`
+            acknowledgements are buffered), writes acknowledgements and forwards outbox
+            entries that are due for retry.
+        """
+        try:
+            await asyncio.wait_for(
+                self._outbox_ack_event.wait(), self._OUTBOX_FLUSH_INTERVAL_SEC
+            )
+        except asyncio.TimeoutError:
+            pass
+        if not self._stop:
+            await self._dispatch_outbox()
+
+
+    async def _loop(self) -> None:
+        """
+            Runs stages of main loop concurrently:
+             - processing of messages (filter by users's keywords),
+             - forwarding (generates `AdBotMessageForwardRequest` events to forward
+                messages to users and `AdBotUserDataUpdated` events for users with
+                opened menu whose data was updated),
+             - checking users's inactivity state (generates `AdBotInactivityTimeout`
+                to close menus of inactive users),
+             - deleting of expired messages (see `_apply_retention`),
+             - writing of acknowledgements and retries of outbox entries (see
+                `_dispatch_outbox`).
+            Processing and forwarding stages are joined by bounded queue, so that
+            forwarding of processed chunk is overlapped with processing of next chunk.
+            Every stage is supervised by `_run_stage`, DB errors in one stage don't stop
+            other stages.
+            After stop command forwarding stage finishes current job.
+        """
+        forward_jobs = asyncio.Queue(maxsize=self._STAGE_QUEUE_SIZE)
+        process_task = asyncio.create_task(self._run_stage(
+            'process', lambda: self._process_stage_step(forward_jobs)
+        ))
+        forward_task = asyncio.create_task(self._run_stage(
+            'forward', lambda: self._forward_stage_step(forward_jobs)
+        ))
+        idle_task = asyncio.create_task(self._run_stage(
+            'idle', self._check_idle_timeouts_step
+        ))
+        retention_task = asyncio.create_task(self._run_stage(
+            'retention', self._retention_step
+        ))
+        outbox_task = asyncio.create_task(self._run_stage(
+            'outbox', self._outbox_step
+        ))
+        stages = (process_task, forward_task, idle_task, retention_task, outbox_task)
+        try:
+            done, _ = await asyncio.wait(stages, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()       # reraise exception
+            if not forward_task.done():
+                try:
+                    forward_jobs.put_nowait(True)   # wake up forwarding stage
+                except asyncio.QueueFull:
+                    pass
+                await forward_task
+        finally:
+            for task in stages:
+                task.cancel()
+            await asyncio.gather(*stages, return_exceptions=True)
 
 
     async def stop(self) -> None:
@@ -591,6 +1892,7 @@ class AdBotServices(AsyncMixin):
         """
         logger.debug(f"Stopping main cycle at {datetime.now()}")
         self._stop = True
+        self._wake_event.set()
         while not self._stopped:
             await asyncio.sleep(0.5)
         logger.debug(f"Main cycle stopped at {datetime.now()}")
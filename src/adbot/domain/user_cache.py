@@ -0,0 +1,84 @@
+from collections import OrderedDict
+import time
+from typing import Optional
+
+from . import models
+
+USER_CACHE_SIZE = 10000
+USER_CACHE_TTL_SEC = 60
+
+
+class UserCache:
+    """
+        LRU cache of user snapshots (`models.User` objects detached from session) with
+        time to live `ttl_sec`, up to `max_size` users. Users can be got by `id` or by
+        `telegram_id`.
+        `generation` is incremented by every invalidation: snapshot read from DB is
+        cached only if no user was invalidated while it was being read (see `put`).
+    """
+
+    def __init__(
+        self, max_size: int = USER_CACHE_SIZE, ttl_sec: float = USER_CACHE_TTL_SEC
+    ):
+        self._max_size = max_size
+        self._ttl_sec = ttl_sec
+        self._users: OrderedDict[int, tuple[models.User, float]] = OrderedDict()
+        self._telegram_ids: dict[int, int] = {}     # telegram_id -> id
+        self.generation = 0
+
+
+    def get_by_id(self, user_id: int) -> Optional[models.User]:
+        item = self._users.get(user_id)
+        if item is None:
+            return None
+        user, expire_time = item
+        if expire_time <= time.monotonic():
+            self._remove(user_id)
+            return None
+        self._users.move_to_end(user_id)
+        return user
+
+
+    def get_by_telegram_id(self, telegram_id: int) -> Optional[models.User]:
+        user_id = self._telegram_ids.get(telegram_id)
+        if user_id is None:
+            return None
+        return self.get_by_id(user_id)
+
+
+    def put(self, user: models.User, generation: int) -> None:
+        """
+            Caches user snapshot that was read from DB when cache generation was
+            `generation`. Does nothing if any user was invalidated since then.
+        """
+        if generation != self.generation:
+            return
+        self._remove(user.id)
+        self._users[user.id] = (user, time.monotonic() + self._ttl_sec)
+        if user.telegram_id is not None:
+            self._telegram_ids[user.telegram_id] = user.id
+        while len(self._users) > self._max_size:
+            self._remove(next(iter(self._users)))
+
+
+    def invalidate(self, user_id: int) -> None:
+        self.generation += 1
+        self._remove(user_id)
+
+
+    def clear(self) -> None:
+        self.generation += 1
+        self._users.clear()
+        self._telegram_ids.clear()
+
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+
+    def _remove(self, user_id: int) -> None:
+        item = self._users.pop(user_id, None)
+        if item is not None:
+            telegram_id = item[0].telegram_id
+            if self._telegram_ids.get(telegram_id) == user_id:
+                del self._telegram_ids[telegram_id]
@@ -1,8 +1,12 @@
 from abc import ABC, abstractmethod
 from collections.abc import Callable, Awaitable
-from typing import TypeAlias
+from datetime import datetime
+from typing import Optional, TypeAlias
 
-AddMessageHandler: TypeAlias = Callable[[int, int, str, str], Awaitable[bool]]
+# (cat_id, source_id, msg_text, url, fetched_dt) -> success
+AddMessageHandler: TypeAlias = Callable[
+    [int, int, str, str, Optional[datetime]], Awaitable[bool]
+]
 
 class MessageFetcher(ABC):
     def __init__(self, add_message_handler: AddMessageHandler):
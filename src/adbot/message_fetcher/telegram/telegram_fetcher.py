@@ -1,4 +1,5 @@
 import asyncio
+from datetime import datetime
 import logging
 from typing import Optional
 
@@ -95,6 +96,7 @@ class TelegramMessageFetcher(MessageFetcher):
         message: Message
         async for message in messages:
             try:
+                fetched_dt = datetime.now()
                 if hasattr(message, 'from_id') and message.from_id:
                     if message.message:
                         sender = await self._client.get_entity(message.from_id)
@@ -102,7 +104,9 @@ class TelegramMessageFetcher(MessageFetcher):
                         is_not_bot = hasattr(sender, 'bot') and (not sender.bot)
                         if (not self._ignore_bots) or is_not_bot:
                             url = _get_msg_url(chat_entity, message)
-                            await self._add_message_handler(0, 0, message.message, url)
+                            await self._add_message_handler(
+                                0, 0, message.message, url, fetched_dt
+                            )
                             max_msg_id = max(max_msg_id, message.id)
             except Exception as e:
                 logger.error(f"Telegram message fetcher. Exception: {e}")
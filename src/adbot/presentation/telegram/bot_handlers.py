@@ -1,12 +1,15 @@
 import logging
+from typing import Optional
 
 from aiogram.types import Message
 from aiogram_dialog import DialogManager, StartMode, ShowMode
 from aiogram_dialog.api.exceptions import NoContextError
 
 from adbot.domain import exceptions as exc
+from adbot.domain import models
 from adbot.domain.services import AdBotServices
 from . import dialogs
+from .middlewares import USER_DATA_KEY
 
 logger = logging.getLogger(__name__)
 
@@ -19,41 +22,51 @@ async def _send_service_unavailable_error_msg(dialog_manager: DialogManager):
     )
 
 
-async def start_cmd_handler(
+async def _create_user(
     message: Message, dialog_manager: DialogManager, ad_bot_srv: AdBotServices
+) -> models.User:
+    """
+        Creates user who sent the message and puts it to handler data for dialogs
+        (see `UserMiddleware`).
+    """
+    user = await ad_bot_srv.create_user_by_telegram_data(
+        message.from_user.id, message.from_user.username
+    )
+    dialog_manager.middleware_data[USER_DATA_KEY] = user
+    return user
+
+
+async def start_cmd_handler(
+    message: Message, dialog_manager: DialogManager, ad_bot_srv: AdBotServices,
+    ad_bot_user: Optional[models.User] = None
 ):
     logger.debug(f'`start` command, user={message.from_user.id}')
     await message.delete()
-    user_telegram_id = message.from_user.id
-    user_telegram_name = message.from_user.username
     try:
-        user_data = await ad_bot_srv.get_or_create_user_by_telegram_data(
-            user_telegram_id, user_telegram_name
-        )
+        if ad_bot_user is None:
+            ad_bot_user = await _create_user(message, dialog_manager, ad_bot_srv)
         await dialog_close_cmd_handler(message, dialog_manager=dialog_manager)
         await dialog_manager.start(
             dialogs.settings.SettingsSG.main, mode=StartMode.RESET_STACK
         )
-        await ad_bot_srv.set_menu_closed_state(user_data.id, False)
+        await ad_bot_srv.set_menu_closed_state(ad_bot_user.id, False)
     except exc.AdBotException:
         logger.error(f'DB error in `start` command handler')
         raise
 
 
 async def show_help(
-    message: Message, dialog_manager: DialogManager, ad_bot_srv: AdBotServices
+    message: Message, dialog_manager: DialogManager, ad_bot_srv: AdBotServices,
+    ad_bot_user: Optional[models.User] = None
 ):
     logger.debug(f'`help` command, user={message.from_user.id}')
     await message.delete()
-    user_telegram_id = message.from_user.id
-    user_telegram_name = message.from_user.username
     try:
-        user_data = await ad_bot_srv.get_or_create_user_by_telegram_data(
-            user_telegram_id, user_telegram_name
-        )
+        if ad_bot_user is None:
+            ad_bot_user = await _create_user(message, dialog_manager, ad_bot_srv)
         await dialog_close_cmd_handler(message, dialog_manager=dialog_manager)
         await dialog_manager.start(dialogs.help.HelpSG.main, mode=StartMode.RESET_STACK)
-        await ad_bot_srv.set_menu_closed_state(user_data.id, False)
+        await ad_bot_srv.set_menu_closed_state(ad_bot_user.id, False)
     except exc.AdBotException:
         logger.error(f'DB error in `help` command handler')
         raise
@@ -1,5 +1,4 @@
 import logging
-from typing import Optional
 
 from aiogram.types import Message, CallbackQuery
 from aiogram_dialog import (
@@ -10,24 +9,41 @@ from aiogram_dialog import (
 from aiogram_dialog.widgets.kbd import Button
 
 from adbot.domain.services import AdBotServices
+from adbot.domain import exceptions as exc
 from adbot.domain import models
+from ..middlewares import USER_DATA_KEY
 
 logger = logging.getLogger(__name__)
 
 ERROR_MSG_FORMAT = '\n ⚠ Error occurred. {dialog_data[error_msg]} Try again later.'
 
 
+def get_event_user(manager: DialogManager) -> models.User:
+    """
+        Returns user of the current update resolved by `UserMiddleware` (the snapshot
+        taken before handler).
+        Raises:
+            `AdBotExceptionUserNotExist` if user doesn't exist
+    """
+    user = manager.middleware_data.get(USER_DATA_KEY)
+    if user is None:
+        raise exc.AdBotExceptionUserNotExist(
+            f'User of event {manager.event.__class__} doesn`t exist'
+        )
+    return user
+
+
 async def get_user_data(
         manager: DialogManager, ad_bot_srv: AdBotServices
-    ) -> Optional[models.User]:
-    event = manager.event
-    if hasattr(event, "from_user"):
-        return await ad_bot_srv.get_user_by_telegram_id(int(manager.event.from_user.id))
-    else:
-        logger.error(
-            f'get_user_data, event class {event.__class__} ' \
-            'doesn`t have attr "from_user"'
-        )
+    ) -> models.User:
+    """
+        Returns actual data of the user of the current update, including changes made
+        by handler (it's read from the user cache of services if there were no changes).
+        Raises:
+            `AdBotExceptionUserNotExist` if user doesn't exist
+            `AdBotExceptionSQL` exception on DB error
+    """
+    return await ad_bot_srv.get_user_by_id(get_event_user(manager).id)
 
 
 async def data_getter(dialog_manager: DialogManager, ad_bot_srv: AdBotServices, **kwargs):
@@ -81,7 +97,7 @@ async def on_menu_navigate_click(
         callback: CallbackQuery, button: Button, manager: DialogManager
 ):
     ad_bot_srv: AdBotServices = manager.middleware_data.get('ad_bot_srv')
-    user = await ad_bot_srv.get_user_by_telegram_id(callback.from_user.id)
+    user = get_event_user(manager)
     logger.debug(f'on_menu_navigate_click, user={user.id}, button={button.widget_id}')
     await ad_bot_srv.reset_inactivity_timer(user.id)
 
@@ -14,7 +14,7 @@ from aiogram_dialog import Dialog
 from aiogram_dialog.widgets.input import MessageInput
 
 from adbot.domain.services import AdBotServices
-from .common import (on_unexpected_input)
+from .common import (get_event_user, on_unexpected_input)
 
 logger = logging.getLogger(__name__)
 
@@ -139,16 +139,9 @@ async def on_dialog_close(result: Any, manager: DialogManager):
     ad_bot_srv: AdBotServices = manager.middleware_data.get('ad_bot_srv')
     event = manager.event
 
-    if hasattr(event, "from_user"):
-        logger.debug(f'on_dialog_close, user={event.from_user.id}')
-        user = await ad_bot_srv.get_user_by_telegram_id(event.from_user.id)
-
-        await ad_bot_srv.set_menu_closed_state(user.id, True)
-    else:
-        logger.error(
-            f'on_dialog_close. Event object class {event.__class__} doesn`t have attr ' \
-                '"from_user"'
-        )
+    user = get_event_user(manager)
+    logger.debug(f'on_dialog_close, user={user.telegram_id}')
+    await ad_bot_srv.set_menu_closed_state(user.id, True)
 
     if isinstance(event, CallbackQuery):
         await event.message.delete()
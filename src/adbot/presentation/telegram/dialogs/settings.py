@@ -24,7 +24,7 @@ from aiogram_dialog.widgets.input import MessageInput
 from adbot.domain.services import AdBotServices
 from adbot.domain import models
 from .common import (
-    data_getter, get_user_data, on_unexpected_input, on_menu_navigate_click,
+    data_getter, get_event_user, on_unexpected_input, on_menu_navigate_click,
     ERROR_MSG_FORMAT
 )
 
@@ -50,13 +50,27 @@ async def on_subscription_toggle_click(
     logger.debug(f'on_subscription_toggle_click, user={callback.from_user.id}')
 
     try:
-        user: models.User = await get_user_data(manager, ad_bot_srv)
+        user: models.User = get_event_user(manager)
         await ad_bot_srv.set_subscription_state(user.id, not user.subscription_state)
     except:
         logger.error(f'Exception in `on_subscription_toggle_click`')
         raise
 
 
+async def on_digest_mode_toggle_click(
+        callback: CallbackQuery, button: Button, manager: DialogManager
+):
+    ad_bot_srv: AdBotServices = manager.middleware_data.get('ad_bot_srv')
+    logger.debug(f'on_digest_mode_toggle_click, user={callback.from_user.id}')
+
+    try:
+        user: models.User = get_event_user(manager)
+        await ad_bot_srv.set_digest_mode(user.id, not user.digest_mode)
+    except:
+        logger.error(f'Exception in `on_digest_mode_toggle_click`')
+        raise
+
+
 settings_window = Window(
     # Subscription state
     Multi(
@@ -67,6 +81,15 @@ settings_window = Window(
         ),
         sep=" ",
     ),
+    # Digest mode
+    Multi(
+        Const("<b>Digest mode:</b>"),
+        Case(
+            {True: Const("✅ enabled"), False: Const("☑ disabled")},
+            selector=F["user"].digest_mode.is_(True)
+        ),
+        sep=" ",
+    ),
     # List of keywords
     Const(
         "<b>Your list of keywords is empty.</b>",
@@ -107,6 +130,17 @@ settings_window = Window(
         on_click=on_subscription_toggle_click,
         id="subscription_toggle",
     ),
+    Button(
+        text=Case(
+                {
+                    True: Const("Disable digest mode"),
+                    False: Const("Enable digest mode")
+                },
+                selector=F["user"].digest_mode.is_(True)
+        ),
+        on_click=on_digest_mode_toggle_click,
+        id="digest_mode_toggle",
+    ),
     SwitchTo(
         text=Const("Manage keywords"),
         id="manage_keywords_btn",
@@ -128,7 +162,7 @@ async def on_keyword_add_input(
 ):
     """ """
     ad_bot_srv: AdBotServices = manager.middleware_data.get('ad_bot_srv')
-    user = await ad_bot_srv.get_user_by_telegram_id(message.from_user.id)
+    user = get_event_user(manager)
     keyword = message.text
     await message.delete()
     logger.debug(f'on_keyword_add_input, user={user.id}, keyword="{keyword}"')
@@ -195,7 +229,7 @@ async def on_remove_kw_selected(
     callback: CallbackQuery, widget: Any, manager: DialogManager, item_id: str
 ):
     ad_bot_srv: AdBotServices = manager.middleware_data.get('ad_bot_srv')
-    user = await ad_bot_srv.get_user_by_telegram_id(callback.from_user.id)
+    user = get_event_user(manager)
     logger.debug(f'on_remove_kw_selected, user={user.id}, keyword={item_id}')
 
     try:
@@ -284,16 +318,9 @@ async def on_dialog_close(result: Any, manager: DialogManager):
 
     ad_bot_srv: AdBotServices = manager.middleware_data.get('ad_bot_srv')
 
-    event = manager.event
-    if hasattr(event, "from_user"):
-        logger.debug(f'on_dialog_close, user={event.from_user.id}')
-        user = await ad_bot_srv.get_user_by_telegram_id(event.from_user.id)
-        await ad_bot_srv.set_menu_closed_state(user.id, True)
-    else:
-        logger.error(
-            f'on_dialog_close. Event object class {event.__class__} doesn`t have attr ' \
-                '"from_user"'
-        )
+    user = get_event_user(manager)
+    logger.debug(f'on_dialog_close, user={user.telegram_id}')
+    await ad_bot_srv.set_menu_closed_state(user.id, True)
 
     manager.show_mode = ShowMode.EDIT
     await manager.switch_to(SettingsSG.dialog_closed)
@@ -0,0 +1,52 @@
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.enums import ChatType
+from aiogram.types import TelegramObject, Update, User
+
+from adbot.domain import exceptions as exc
+from adbot.domain.services import AdBotServices
+
+USER_DATA_KEY = 'ad_bot_user'
+
+
+class UserMiddleware(BaseMiddleware):
+    """
+        Outer middleware of dispatcher's updates. Looks up the user who sent the update
+        once per update and puts it to handler data (`USER_DATA_KEY`, None if user
+        doesn't exist), so that command handlers and dialogs don't look it up again.
+        Users are not created here (see `start_cmd_handler`).
+        Only private chat messages and callback queries are handled, other updates are
+        passed through.
+        User object is the snapshot taken before handler, it isn't updated by
+        handler's changes.
+        Raises:
+            `AdBotExceptionSQL` exception on DB error
+    """
+
+    def __init__(self, ad_bot_srv: AdBotServices):
+        self._ad_bot_srv = ad_bot_srv
+
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        tg_user: User = data.get('event_from_user')
+        if (tg_user is not None) and (not tg_user.is_bot) and self._is_user_update(event):
+            try:
+                data[USER_DATA_KEY] = \
+                    await self._ad_bot_srv.get_user_by_telegram_id(tg_user.id)
+            except exc.AdBotExceptionUserNotExist:
+                data[USER_DATA_KEY] = None
+        return await handler(event, data)
+
+
+    def _is_user_update(self, event: TelegramObject) -> bool:
+        if not isinstance(event, Update):
+            return False
+        if event.message is not None:
+            return event.message.chat.type == ChatType.PRIVATE
+        return event.callback_query is not None
@@ -0,0 +1,313 @@
+import asyncio
+from contextvars import ContextVar
+from dataclasses import dataclass
+import itertools
+import logging
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import (
+    BaseRequestMiddleware, NextRequestMiddlewareType
+)
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import Response, TelegramMethod
+from aiogram.methods.base import TelegramType
+
+logger = logging.getLogger(__name__)
+
+# Telegram Bot API limits: ~30 messages per second in total and ~1 message per second
+# to the same chat
+GLOBAL_RATE = 30
+GLOBAL_BURST = 30
+CHAT_RATE = 1
+CHAT_BURST = 1
+SENDER_WORKERS = 8
+MAX_PENDING = 1000      # max number of messages waiting for sending
+MAX_RETRIES = 5         # max number of retries after `TelegramRetryAfter`
+MAX_CHAT_BUCKETS = 10000    # idle chat buckets are dropped when this number is reached
+
+# Priority lanes: requests of interactive lane (dialogs) are sent before requests of
+# bulk lane (forwarded messages). Every lane has its own share of the global rate limit
+# (rate, burst). Per chat limit is applied to bulk lane only, so that dialogs are
+# not slowed down.
+LANE_INTERACTIVE = 'interactive'
+LANE_BULK = 'bulk'
+LANES = (LANE_INTERACTIVE, LANE_BULK)   # in order of priority
+LANE_LIMITS = {
+    LANE_INTERACTIVE: (10, 10),
+    LANE_BULK: (25, 25),
+}
+
+# Set in sender's workers (requests made by workers are not routed through lanes again)
+_in_sender_worker: ContextVar[bool] = ContextVar('_in_sender_worker', default=False)
+
+
+class TokenBucket:
+    """
+        Token bucket rate limiter: `rate` tokens per second, up to `capacity` tokens.
+        Tokens can be reserved in advance (the number of tokens becomes negative),
+        `reserve` returns the time to wait before the reserved token can be used.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+
+    def reserve(self) -> float:
+        """
+            Reserves one token. Returns delay (seconds) before it can be used.
+        """
+        self._refill()
+        self._tokens -= 1
+        return max(0.0, -self._tokens / self._rate)
+
+
+    async def acquire(self) -> None:
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+    def pause(self, seconds: float) -> None:
+        """
+            Pauses bucket: tokens won't be available during `seconds` from now.
+        """
+        self._refill()
+        self._tokens = min(self._tokens, 0.0) - seconds * self._rate
+
+
+    def is_idle(self) -> bool:
+        self._refill()
+        return self._tokens >= self._capacity
+
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(
+            self._capacity, self._tokens + (now - self._updated) * self._rate
+        )
+        self._updated = now
+
+
+@dataclass(eq=False)
+class _SendJob:
+    chat_id: int | str
+    request: Callable[[], Awaitable[Any]]
+    lane: str
+    future: asyncio.Future
+    seq: int
+    lane_token_reserved: bool = False
+    chat_token_reserved: bool = False
+    retries: int = 0
+
+    def __lt__(self, other: '_SendJob') -> bool:
+        return self.seq < other.seq
+
+
+class RateLimitedSender:
+    """
+        Sends messages through the bounded pool of workers respecting Telegram Bot API
+        limits: global token bucket (`global_rate` messages per second) and token
+        bucket per chat (`chat_rate` messages per second).
+        Requests are queued in priority lanes (`LANES`): requests of interactive lane
+        are taken before queued requests of bulk lane, every lane is limited by its
+        own token bucket (`lane_limits`).
+        Messages to the chat (or lane) that exceeded its limit are postponed, so they
+        don't block workers.
+        On `TelegramRetryAfter` the bucket of the chat is paused for `retry_after`
+        seconds and the message is resent (up to `max_retries` times).
+        Workers are started on the first request.
+    """
+
+    def __init__(
+        self, bot: Bot, workers: int = SENDER_WORKERS,
+        global_rate: float = GLOBAL_RATE, chat_rate: float = CHAT_RATE,
+        max_pending: int = MAX_PENDING, max_retries: int = MAX_RETRIES,
+        lane_limits: dict[str, tuple[float, float]] = LANE_LIMITS
+    ):
+        self._bot = bot
+        self._workers_cnt = workers
+        self._global_bucket = TokenBucket(global_rate, GLOBAL_BURST)
+        self._lane_buckets = {
+            lane: TokenBucket(*lane_limits[lane]) for lane in LANES
+        }
+        self._lane_priority = {lane: priority for priority, lane in enumerate(LANES)}
+        self._lane_depth = {lane: 0 for lane in LANES}
+        self._chat_rate = chat_rate
+        self._chat_buckets: dict[int | str, TokenBucket] = {}
+        self._max_retries = max_retries
+        self._pending = {lane: asyncio.Semaphore(max_pending) for lane in LANES}
+        self._seq = itertools.count()
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._workers: list[asyncio.Task] = []
+        self._delayed: dict[_SendJob, asyncio.TimerHandle] = {}
+
+
+    async def send_message(
+        self, chat_id: int, text: str, lane: str = LANE_BULK,
+        on_start: Optional[Callable[[], None]] = None, **kwargs
+    ) -> Any:
+        """
+            Puts message to sending queue of `lane` and waits until it's sent.
+            `on_start` is called when the worker takes the message for sending (before
+            every attempt).
+            Returns result of `Bot.send_message`, reraises its exceptions.
+        """
+        async def request():
+            if on_start is not None:
+                on_start()
+            return await self._bot.send_message(chat_id, text, **kwargs)
+
+        return await self.submit(chat_id, request, lane)
+
+
+    async def submit(
+        self, chat_id: int | str, request: Callable[[], Awaitable[Any]],
+        lane: str = LANE_BULK
+    ) -> Any:
+        """
+            Puts Bot API request to the chat (`request` is called to make it) to the
+            queue of `lane` and waits until it's done.
+            Waits if there are `max_pending` requests in the queue of `lane`.
+            Returns result of request, reraises its exceptions.
+        """
+        self._start()
+        async with self._pending[lane]:
+            self._lane_depth[lane] += 1
+            try:
+                future = asyncio.get_running_loop().create_future()
+                self._put(_SendJob(chat_id, request, lane, future, next(self._seq)))
+                return await future
+            finally:
+                self._lane_depth[lane] -= 1
+
+
+    def get_queue_depth(self) -> dict[str, int]:
+        """
+            Returns the number of requests (queued, postponed and being sent) per lane.
+        """
+        return dict(self._lane_depth)
+
+
+    def stop(self) -> None:
+        """
+            Stops workers. Cancels messages that were not sent.
+        """
+        for task in self._workers:
+            task.cancel()
+        self._workers = []
+        for job, handle in self._delayed.items():
+            handle.cancel()
+            job.future.cancel()
+        self._delayed = {}
+        while (self._queue is not None) and (not self._queue.empty()):
+            _, job = self._queue.get_nowait()
+            job.future.cancel()
+
+
+    def _start(self) -> None:
+        if self._workers:
+            return
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+        self._workers = [
+            asyncio.create_task(self._worker()) for _ in range(self._workers_cnt)
+        ]
+
+
+    async def _worker(self) -> None:
+        _in_sender_worker.set(True)
+        while True:
+            _, job = await self._queue.get()
+            job: _SendJob
+            if job.future.done():
+                continue    # cancelled by sender
+            if not job.lane_token_reserved:
+                delay = self._lane_buckets[job.lane].reserve()
+                job.lane_token_reserved = True
+                if delay > 0:
+                    self._postpone(job, delay)
+                    continue
+            if (job.lane == LANE_BULK) and (not job.chat_token_reserved):
+                delay = self._get_chat_bucket(job.chat_id).reserve()
+                job.chat_token_reserved = True
+                if delay > 0:
+                    self._postpone(job, delay)
+                    continue
+            await self._global_bucket.acquire()
+            try:
+                res = await job.request()
+            except TelegramRetryAfter as e:
+                job.retries += 1
+                if job.retries > self._max_retries:
+                    if not job.future.done():
+                        job.future.set_exception(e)
+                    continue
+                logger.warning(
+                    f'Sender. Flood limit for chat {job.chat_id}, ' \
+                        f'retry after {e.retry_after} s'
+                )
+                self._get_chat_bucket(job.chat_id).pause(e.retry_after)
+                job.lane_token_reserved = False
+                job.chat_token_reserved = False
+                self._postpone(job, e.retry_after)
+            except Exception as e:
+                if not job.future.done():
+                    job.future.set_exception(e)
+            else:
+                if not job.future.done():
+                    job.future.set_result(res)
+
+
+    def _put(self, job: _SendJob) -> None:
+        self._queue.put_nowait((self._lane_priority[job.lane], job))
+
+
+    def _postpone(self, job: _SendJob, delay: float) -> None:
+        def put_job():
+            self._delayed.pop(job, None)
+            self._put(job)
+        self._delayed[job] = asyncio.get_running_loop().call_later(delay, put_job)
+
+
+    def _get_chat_bucket(self, chat_id: int | str) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= MAX_CHAT_BUCKETS:
+                self._chat_buckets = {
+                    cid: b for cid, b in self._chat_buckets.items() if not b.is_idle()
+                }
+            bucket = self._chat_buckets[chat_id] = TokenBucket(
+                self._chat_rate, CHAT_BURST
+            )
+        return bucket
+
+
+class LaneRequestMiddleware(BaseRequestMiddleware):
+    """
+        Bot session middleware that routes Bot API requests to chats (made by dialogs
+        and command handlers) through the interactive lane of `sender`.
+        Requests made by sender's workers and requests that are not addressed to chat
+        (getUpdates, answerCallbackQuery, etc.) are passed through.
+    """
+
+    def __init__(self, sender: RateLimitedSender):
+        self._sender = sender
+
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        chat_id = getattr(method, 'chat_id', None)
+        if (chat_id is None) or _in_sender_worker.get():
+            return await make_request(bot, method)
+        return await self._sender.submit(
+            chat_id, lambda: make_request(bot, method), LANE_INTERACTIVE
+        )
@@ -3,7 +3,7 @@ from datetime import datetime
 import logging
 
 from aiogram import Bot, Dispatcher
-from aiogram.exceptions import TelegramForbiddenError
+from aiogram.exceptions import TelegramAPIError, TelegramForbiddenError
 from aiogram.filters import and_f, Command, ExceptionTypeFilter
 from aiogram.fsm.storage.redis import RedisStorage, DefaultKeyBuilder
 from aiogram.types import (
@@ -19,6 +19,8 @@ from adbot.domain import exceptions as exc
 from . import bot_handlers
 from .dialogs import settings, help, errors
 from .filters import ChatId
+from .middlewares import UserMiddleware
+from .sender import LaneRequestMiddleware, RateLimitedSender
 from ..presentation_interface import PresentationInterface
 
 logger = logging.getLogger(__name__)
@@ -33,8 +35,13 @@ class TGBot(PresentationInterface):
         super().__init__(ad_bot_srv)
         
         self._bot = self._create_bot(bot_token)
+        self._sender = RateLimitedSender(self._bot)
+        self._setup_request_lanes()
         self._dp = self._create_dp(redis_host, redis_port, redis_db)
 
+        # Resolve user once per update (see `UserMiddleware`)
+        self._dp.update.outer_middleware(UserMiddleware(self._ad_bot_srv))
+
         # Register command handlers
         self._dp.message.register(
             bot_handlers.start_cmd_handler,
@@ -84,6 +91,9 @@ class TGBot(PresentationInterface):
         self._ad_bot_srv.messagebus.subscribe(
             [events.AdBotMessageForwardRequest], self.user_message_forward_request_handler
         )
+        self._ad_bot_srv.messagebus.subscribe(
+            [events.AdBotDigestForwardRequest], self.user_digest_forward_request_handler
+        )
         self._ad_bot_srv.messagebus.subscribe(
             [events.AdBotUserDataUpdated], self.user_data_updated_handler
         )
@@ -96,6 +106,14 @@ class TGBot(PresentationInterface):
         return Bot(token=bot_token, parse_mode='HTML')
 
 
+    def _setup_request_lanes(self) -> None:
+        """
+            Routes Bot API requests of dialogs through the interactive lane of sender,
+            so that they are sent before queued forwarded messages.
+        """
+        self._bot.session.middleware(LaneRequestMiddleware(self._sender))
+
+
     def _create_dp(self, redis_host: str, redis_port: int, redis_db: int) -> Dispatcher:
         storage = RedisStorage(
             redis=Redis(host=redis_host, port=redis_port, db=redis_db),
@@ -131,6 +149,7 @@ class TGBot(PresentationInterface):
     async def stop_event_handler(self, event: events.AdBotStop):
         if self._dp._running_lock.locked():
             await self._dp.stop_polling()
+        self._sender.stop()
 
 
     async def user_inactivity_timeout_handler(self, event: events.AdBotInactivityTimeout):
@@ -152,15 +171,49 @@ class TGBot(PresentationInterface):
     async def user_message_forward_request_handler(
         self, event: events.AdBotMessageForwardRequest
     ):
+        await self._forward_to_user(event, event.message_url)
+
+
+    async def user_digest_forward_request_handler(
+        self, event: events.AdBotDigestForwardRequest
+    ):
+        text = f'✉ {len(event.message_urls)} new messages:\n' + \
+            '\n'.join(event.message_urls)
+        await self._forward_to_user(event, text, disable_web_page_preview=True)
+
+
+    async def _forward_to_user(
+        self,
+        event: events.AdBotMessageForwardRequest | events.AdBotDigestForwardRequest,
+        text: str, **kwargs
+    ):
+        """
+            Sends forwarded message(s) to user and acknowledges the delivery (or
+            failure, the message will be forwarded again later). The start of sending
+            is recorded to renew the lease of outbox entry.
+            Unsubscribes user if bot was blocked by this user.
+        """
         try:
-            await self._bot.send_message(event.telegram_id, event.message_url)
+            await self._sender.send_message(
+                event.telegram_id, text,
+                on_start=lambda: self._ad_bot_srv.record_message_sending(event), **kwargs
+            )
         except TelegramForbiddenError as e:
+            self._ad_bot_srv.record_message_failed(event, retry=False)
             if e.message.find('bot was blocked by the user') >= 0:
                 logger.warning(f'Bot was blocked by user {event.telegram_id}. Unsubscribe user')
                 await self._ad_bot_srv.set_subscription_state(event.user_id, False)
                 await self._ad_bot_srv.set_menu_closed_state(event.user_id, True)
             else:
                 raise
+        except TelegramAPIError as e:
+            logger.error(f'Failed to forward message to user {event.telegram_id}: {e}')
+            self._ad_bot_srv.record_message_failed(event)
+        except Exception:
+            self._ad_bot_srv.record_message_failed(event)
+            raise
+        else:
+            self._ad_bot_srv.record_message_sent(event)
 
 
     async def _send_bot_cmd(self, cmd: str, user_tg_id: int):
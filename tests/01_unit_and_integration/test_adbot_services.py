@@ -2,10 +2,11 @@ import asyncio
 from datetime import datetime, timedelta
 import pytest
 
-from sqlalchemy import select, text
+from sqlalchemy import event, select, text
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from adbot.domain.services import AdBotServices, exc, IDLE_TIMEOUT_MINUTES
+from adbot.domain import services
 from adbot.domain import models
 from adbot.domain import messagebus as mb
 from adbot.domain import events
@@ -127,6 +128,67 @@ async def test_get_user_by_user_id_returns_correct_user(
     assert selected_user.telegram_name == 'dsa'
 
 
+@pytest.mark.asyncio
+async def test_get_user_reads_user_from_cache(in_memory_adbot_srv: AdBotServices):
+    adbot_srv = in_memory_adbot_srv
+
+    user = await adbot_srv.create_user_by_telegram_data(
+        telegram_id=123456789, telegram_name='asd'
+    )
+
+    # DB is not queried while user is in cache
+    db_pool = adbot_srv._db_pool
+    adbot_srv._db_pool = brake_sessionmaker(db_pool)
+    assert (await adbot_srv.get_user_by_id(user.id)) is user
+    assert (await adbot_srv.get_user_by_telegram_id(123456789)) is user
+    adbot_srv._db_pool = db_pool
+
+
+@pytest.mark.asyncio
+async def test_user_cache_is_invalidated_on_user_update(
+    in_memory_adbot_srv: AdBotServices
+):
+    adbot_srv = in_memory_adbot_srv
+
+    user = await adbot_srv.create_user_by_telegram_data(
+        telegram_id=123456789, telegram_name='asd'
+    )
+    await adbot_srv.set_forwarding_state(user.id, False)
+    assert (await adbot_srv.get_user_by_telegram_id(123456789)).forwarding_state is False
+
+    await adbot_srv.add_keyword(user.id, 'kw')
+    user = await adbot_srv.get_user_by_id(user.id)
+    assert [kw.word for kw in user.keywords] == ['kw']
+
+    await adbot_srv.set_forwarding_state(user.id, True)
+    await adbot_srv.set_subscription_state(user.id, True)
+    await adbot_srv.add_message(0, 0, 'message with kw', 'url')
+    await adbot_srv._process_messages()
+    assert (await adbot_srv.get_user_by_id(user.id)).forward_queue_len == 1
+
+
+@pytest.mark.asyncio
+async def test_forward_queue_len_is_maintained(in_memory_adbot_srv: AdBotServices):
+    adbot_srv = in_memory_adbot_srv
+
+    user = await adbot_srv.create_user_by_telegram_data(
+        telegram_id=123456789, telegram_name='asd'
+    )
+    await adbot_srv.add_keyword(user.id, 'kw')
+    await adbot_srv.set_subscription_state(user.id, True)
+    await adbot_srv.add_message(0, 0, 'message 1 with kw', 'url1')
+    await adbot_srv.add_message(0, 0, 'message 2 with kw', 'url2')
+    await adbot_srv._process_messages()
+    assert (await adbot_srv.get_user_by_id(user.id)).forward_queue_len == 2
+
+    # counters are loaded from DB on start
+    adbot_srv_2 = await AdBotServices(adbot_srv._db_pool)
+    assert (await adbot_srv_2.get_user_by_id(user.id)).forward_queue_len == 2
+
+    await adbot_srv._forward_messages()
+    assert (await adbot_srv.get_user_by_id(user.id)).forward_queue_len == 0
+
+
 # ========================================================================================
 # user subscription state management
 
@@ -351,6 +413,31 @@ async def test_set_menu_closed_state_raises_exception_when_user_doesnt_exist(
         await adbot_srv.set_menu_closed_state(123, True)
 
 
+@pytest.mark.asyncio
+async def test_set_menu_closed_state_executes_one_statement(
+    in_memory_adbot_srv: AdBotServices
+):
+    adbot_srv = in_memory_adbot_srv
+
+    user = await adbot_srv.create_user_by_telegram_data(
+        telegram_id=123456789, telegram_name='asd'
+    )
+    statements = []
+    engine = adbot_srv._db_pool.kw['bind'].sync_engine
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        await adbot_srv.set_menu_closed_state(user.id, False)
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+    assert len(statements) == 1
+    assert statements[0].startswith('UPDATE user_account')
+    assert (await adbot_srv.get_user_by_id(user.id)).menu_closed is False
+    assert await adbot_srv.get_is_idle_with_opened_menu(user.id) is False
+
+
 @pytest.mark.asyncio
 async def test_set_menu_closed_state_raises_exception_on_sql_error(
     in_memory_adbot_srv: AdBotServices
@@ -804,6 +891,55 @@ async def test_get_all_keywords_subscription_on_off(in_memory_adbot_srv: AdBotSe
         assert len(users) == kw_users[kw]
 
 
+@pytest.mark.asyncio
+async def test_get_all_keywords_index_updated_without_reload(
+    in_memory_adbot_srv: AdBotServices
+):
+    adbot_srv = in_memory_adbot_srv
+
+    user = await adbot_srv.create_user_by_telegram_data(11111, 'asd')
+    await adbot_srv.set_subscription_state(user.id, True)
+    await adbot_srv.add_keyword(user.id, 'apple')
+    await adbot_srv.add_keyword(user.id, 'scooter')
+    await adbot_srv.remove_keyword(user.id, 'scooter')
+
+    reload_cnt = 0
+    reload_keywords_index = adbot_srv._reload_keywords_index
+    async def reload_keywords_index_local(session: AsyncSession):
+        nonlocal reload_cnt
+        reload_cnt += 1
+        await reload_keywords_index(session)
+    adbot_srv._reload_keywords_index = reload_keywords_index_local
+
+    async with adbot_srv._db_pool() as session:
+        session: AsyncSession
+        keywords = await adbot_srv._get_all_keywords(session)
+
+    assert reload_cnt == 0
+    assert keywords == {'apple': {user.id}}
+
+
+@pytest.mark.asyncio
+async def test_get_all_keywords_reloads_index_if_changed_by_other_writer(
+    in_memory_adbot_srv: AdBotServices
+):
+    adbot_srv = in_memory_adbot_srv
+
+    user = await adbot_srv.create_user_by_telegram_data(11111, 'asd')
+    await adbot_srv.set_subscription_state(user.id, True)
+    await adbot_srv.add_keyword(user.id, 'apple')
+
+    # Another instance of services changes data
+    other_adbot_srv = await AdBotServices(adbot_srv._db_pool)
+    await other_adbot_srv.add_keyword(user.id, 'sofa')
+
+    async with adbot_srv._db_pool() as session:
+        session: AsyncSession
+        keywords = await adbot_srv._get_all_keywords(session)
+
+    assert keywords == {'apple': {user.id}, 'sofa': {user.id}}
+
+
 # ========================================================================================
 # message management
 
@@ -938,177 +1074,934 @@ async def test_process_messages_one_user(in_memory_adbot_srv: AdBotServices):
 
 
 @pytest.mark.asyncio
-async def test_process_messages_raises_exception_on_sql_error(
+async def test_process_messages_in_chunks(in_memory_adbot_srv: AdBotServices):
+    adbot_srv = in_memory_adbot_srv
+    adbot_srv._PROCESS_MESSAGES_CHUNK_SIZE = 2
+
+    for i in range(5):
+        await adbot_srv.add_message(11, 22, f'apple {i}', f'https://t.me/c/123/{i}')
+
+    user = await adbot_srv.create_user_by_telegram_data(11111, 'asd')
+    await adbot_srv.set_subscription_state(user.id, True)
+    await adbot_srv.add_keyword(user.id, 'apple')
+
+    sessions_cnt = 0
+    db_pool = adbot_srv._db_pool
+    def counting_session_maker():
+        nonlocal sessions_cnt
+        sessions_cnt += 1
+        return db_pool()
+    adbot_srv._db_pool = counting_session_maker
+
+    await adbot_srv._process_messages()
+
+    assert sessions_cnt == 4    # 3 chunks + 1 empty chunk
+
+    async with db_pool() as session:
+        session: AsyncSession
+        res = (await session.execute(text(f"SELECT processed FROM chat_message"))).all()
+        assert [row[0] for row in res] == [1, 1, 1, 1, 1]
+        st = text(f"SELECT message_id FROM user_message_link ORDER BY message_id")
+        res = (await session.execute(st)).all()
+        assert [row[0] for row in res] == [1, 2, 3, 4, 5]
+
+
+@pytest.mark.asyncio
+async def test_process_messages_keeps_commited_chunks_on_sql_error(
     in_memory_adbot_srv: AdBotServices
 ):
     adbot_srv = in_memory_adbot_srv
+    adbot_srv._PROCESS_MESSAGES_CHUNK_SIZE = 2
 
-    await adbot_srv.add_message(11, 22, 'apple banana orange', 'https://t.me/c/123/456')
+    for i in range(5):
+        await adbot_srv.add_message(11, 22, f'apple {i}', f'https://t.me/c/123/{i}')
 
     user = await adbot_srv.create_user_by_telegram_data(11111, 'asd')
     await adbot_srv.set_subscription_state(user.id, True)
-
     await adbot_srv.add_keyword(user.id, 'apple')
 
-    # broken DB returns SQLAlchemyError on every query and commit
-    adbot_srv._db_pool = brake_sessionmaker(adbot_srv._db_pool)
+    # Second session is broken
+    sessions_cnt = 0
+    db_pool = adbot_srv._db_pool
+    broken_db_pool = brake_sessionmaker(db_pool)
+    def session_maker():
+        nonlocal sessions_cnt
+        sessions_cnt += 1
+        return broken_db_pool() if sessions_cnt == 2 else db_pool()
+    adbot_srv._db_pool = session_maker
 
     with pytest.raises(exc.AdBotExceptionSQL):
         await adbot_srv._process_messages()
 
+    async with db_pool() as session:
+        session: AsyncSession
+        res = (await session.execute(text(f"SELECT processed FROM chat_message"))).all()
+        assert [row[0] for row in res] == [1, 1, 0, 0, 0]
 
-# ========================================================================================
-# Message forwarding
+    # Next call processes the rest of messages
+    adbot_srv._db_pool = db_pool
+    await adbot_srv._process_messages()
 
-@pytest.mark.asyncio
-async def test_forward_messages(in_memory_adbot_srv: AdBotServices):
-    adbot_srv = in_memory_adbot_srv
+    async with db_pool() as session:
+        session: AsyncSession
+        res = (await session.execute(text(f"SELECT processed FROM chat_message"))).all()
+        assert [row[0] for row in res] == [1, 1, 1, 1, 1]
 
-    catched_events = []
-    async def fake_subscriber_func_local(event: mb.AdBotEvent):
-        catched_events.append(event)
 
-    adbot_srv.messagebus.subscribe(
-        [events.AdBotMessageForwardRequest], fake_subscriber_func_local
-    )
+@pytest.mark.asyncio
+async def test_process_messages_ignores_existing_links(
+    in_memory_adbot_srv: AdBotServices
+):
+    adbot_srv = in_memory_adbot_srv
 
     await adbot_srv.add_message(11, 22, 'apple banana orange', 'https://t.me/c/123/456')
-    await adbot_srv.add_message(12, 23, 'car bicycle', 'https://t.me/c/234/567')
+    await adbot_srv.add_message(12, 23, 'apple pen', 'https://t.me/c/456/789')
 
     user = await adbot_srv.create_user_by_telegram_data(11111, 'asd')
     await adbot_srv.set_subscription_state(user.id, True)
     await adbot_srv.add_keyword(user.id, 'apple')
-    await adbot_srv.add_keyword(user.id, 'bicycle')
-    await adbot_srv._process_messages()
+    await adbot_srv.add_keyword(user.id, 'pen')
 
-    await adbot_srv._forward_messages()
-    await asyncio.sleep(0.00000001)     # Give time to process asyncio tasks
+    async with adbot_srv._db_pool() as session:
+        session: AsyncSession
+        await session.execute(
+            text(f"INSERT INTO user_message_link VALUES ({user.id}, 1)")
+        )
+        await session.commit()
+        await adbot_srv._load_forward_queue_lens(session)
+    assert (await adbot_srv.get_user_by_id(user.id)).forward_queue_len == 1
 
-    expected_messages = {
-        'apple banana orange',
-        'car bicycle'
-    }
+    await adbot_srv._process_messages()
+    # existing link is not counted again
+    assert (await adbot_srv.get_user_by_id(user.id)).forward_queue_len == 2
 
-    assert len(catched_events) == 2
-    assert catched_events[0].message_text in expected_messages
-    expected_messages.remove(catched_events[0].message_text)
-    assert catched_events[1].message_text in expected_messages
-    expected_messages.remove(catched_events[1].message_text)
-    assert len(expected_messages) == 0
+    async with adbot_srv._db_pool() as session:
+        session: AsyncSession
+        st = text(f"SELECT user_id, message_id FROM user_message_link ORDER BY message_id")
+        res = (await session.execute(st)).all()
+    assert [tuple(row) for row in res] == [(user.id, 1), (user.id, 2)]
 
 
 @pytest.mark.asyncio
-async def test_forward_messages_case_insensitive(in_memory_adbot_srv: AdBotServices):
-    adbot_srv = in_memory_adbot_srv
+async def test_process_messages_in_matching_pool(in_memory_db_sessionmaker):
+    adbot_srv = await AdBotServices(in_memory_db_sessionmaker, matching_workers=2)
+    adbot_srv._MATCHING_POOL_MIN_MESSAGES = 1
 
-    catched_events = []
-    async def fake_subscriber_func_local(event: mb.AdBotEvent):
-        catched_events.append(event)
+    try:
+        await adbot_srv.add_message(11, 22, 'apple banana', 'https://t.me/c/123/456')
+        await adbot_srv.add_message(12, 23, 'car bicycle', 'https://t.me/c/456/789')
+        await adbot_srv.add_message(13, 24, 'Sofa', 'https://t.me/c/789/012')
 
-    adbot_srv.messagebus.subscribe(
-        [events.AdBotMessageForwardRequest], fake_subscriber_func_local
-    )
+        user = await adbot_srv.create_user_by_telegram_data(11111, 'asd')
+        await adbot_srv.set_subscription_state(user.id, True)
+        await adbot_srv.add_keyword(user.id, 'apple')
+        await adbot_srv.add_keyword(user.id, 'sofa')
 
-    await adbot_srv.add_message(11, 22, 'Apple Banana Orange', 'https://t.me/c/123/456')
+        await adbot_srv._process_messages()
+    finally:
+        adbot_srv._matching_pool.shutdown()
+
+    async with adbot_srv._db_pool() as session:
+        session: AsyncSession
+        st = text(f"SELECT user_id, message_id FROM user_message_link ORDER BY message_id")
+        res = (await session.execute(st)).all()
+    assert [tuple(row) for row in res] == [(user.id, 1), (user.id, 3)]
+
+
+@pytest.mark.asyncio
+async def test_process_messages_skips_duplicates(in_memory_adbot_srv: AdBotServices):
+    adbot_srv = in_memory_adbot_srv
 
     user = await adbot_srv.create_user_by_telegram_data(11111, 'asd')
     await adbot_srv.set_subscription_state(user.id, True)
     await adbot_srv.add_keyword(user.id, 'apple')
-    await adbot_srv.add_keyword(user.id, 'bicycle')
-    await adbot_srv._process_messages()
 
-    await adbot_srv._forward_messages()
-    await asyncio.sleep(0.00000001)     # Give time to process asyncio tasks
+    # Duplicates in one chunk
+    await adbot_srv.add_message(11, 22, 'apple banana', 'https://t.me/c/123/456')
+    await adbot_srv.add_message(12, 23, 'apple banana', 'https://t.me/c/456/789')
+    await adbot_srv._process_messages()
 
-    expected_messages = {
-        'Apple Banana Orange'
-    }
+    # Duplicate of processed message
+    await adbot_srv.add_message(13, 24, 'apple banana', 'https://t.me/c/789/012')
+    await adbot_srv.add_message(14, 25, 'apple pie', 'https://t.me/c/012/345')
+    await adbot_srv._process_messages()
 
-    assert len(catched_events) == 1
-    assert catched_events[0].message_text in expected_messages
-    expected_messages.remove(catched_events[0].message_text)
-    assert len(expected_messages) == 0
+    async with adbot_srv._db_pool() as session:
+        session: AsyncSession
+        res = (await session.execute(text(f"SELECT processed FROM chat_message"))).all()
+        assert [row[0] for row in res] == [1, 1, 1, 1]
+        st = text(f"SELECT message_id FROM user_message_link ORDER BY message_id")
+        res = (await session.execute(st)).all()
+        assert [row[0] for row in res] == [1, 4]
 
 
 @pytest.mark.asyncio
-async def test_forward_messages_does_nothing_if_forwarding_disabled(
+async def test_process_messages_doesnt_skip_duplicates_out_of_window(
     in_memory_adbot_srv: AdBotServices
 ):
     adbot_srv = in_memory_adbot_srv
 
-    catched_events = []
-    async def fake_subscriber_func_local(event: mb.AdBotEvent):
-        catched_events.append(event)
-
-    adbot_srv.messagebus.subscribe(
-        [events.AdBotMessageForwardRequest], fake_subscriber_func_local
-    )
-
-    await adbot_srv.add_message(11, 22, 'apple banana orange', 'https://t.me/c/123/456')
-    await adbot_srv.add_message(12, 23, 'car bicycle', 'https://t.me/c/234/567')
-
     user = await adbot_srv.create_user_by_telegram_data(11111, 'asd')
     await adbot_srv.set_subscription_state(user.id, True)
-    await adbot_srv.set_forwarding_state(user.id, False)
     await adbot_srv.add_keyword(user.id, 'apple')
-    await adbot_srv.add_keyword(user.id, 'bicycle')
+
+    await adbot_srv.add_message(11, 22, 'apple banana', 'https://t.me/c/123/456')
     await adbot_srv._process_messages()
 
-    await adbot_srv._forward_messages()
-    await asyncio.sleep(0.00000001)     # Give time to process asyncio tasks
+    old_dt = datetime.now() - adbot_srv._duplicates_window - timedelta(minutes=1)
+    async with adbot_srv._db_pool() as session:
+        session: AsyncSession
+        await session.execute(
+            text("UPDATE chat_message SET added_dt = :dt"), {'dt': old_dt}
+        )
+        await session.commit()
 
-    assert len(catched_events) == 0
+    await adbot_srv.add_message(12, 23, 'apple banana', 'https://t.me/c/456/789')
+    await adbot_srv._process_messages()
+
+    async with adbot_srv._db_pool() as session:
+        session: AsyncSession
+        st = text(f"SELECT message_id FROM user_message_link ORDER BY message_id")
+        res = (await session.execute(st)).all()
+        assert [row[0] for row in res] == [1, 2]
 
 
 @pytest.mark.asyncio
-async def test_forward_messages_two_users(in_memory_adbot_srv: AdBotServices):
+async def test_process_messages_near_duplicates_not_forwarded_to_same_users(
+    in_memory_adbot_srv: AdBotServices
+):
     adbot_srv = in_memory_adbot_srv
 
-    catched_events = []
-    async def fake_subscriber_func_local(event: mb.AdBotEvent):
-        catched_events.append(event)
-
-    adbot_srv.messagebus.subscribe(
-        [events.AdBotMessageForwardRequest], fake_subscriber_func_local
-    )
-
-    await adbot_srv.add_message(11, 22, 'apple banana orange', 'https://t.me/c/123/456')
-    await adbot_srv.add_message(12, 23, 'car bicycle', 'https://t.me/c/234/567')
-    await adbot_srv.add_message(13, 24, 'sofa', 'https://t.me/c/345/678')
-
     user1 = await adbot_srv.create_user_by_telegram_data(11111, 'asd')
     await adbot_srv.set_subscription_state(user1.id, True)
-    await adbot_srv.add_keyword(user1.id, 'apple')
     await adbot_srv.add_keyword(user1.id, 'bicycle')
 
     user2 = await adbot_srv.create_user_by_telegram_data(22222, 'dsa')
     await adbot_srv.set_subscription_state(user2.id, True)
-    await adbot_srv.add_keyword(user2.id, 'bicycle')
-    await adbot_srv.add_keyword(user2.id, 'sofa')
+    await adbot_srv.add_keyword(user2.id, 'helmet')
 
+    ad_text = 'Selling bicycle Trek Marlin 7, frame size L, good condition, new ' \
+        'tyres, serviced last month, price 450 euro, pickup in Budva, write in ' \
+        'private messages'
+    await adbot_srv.add_message(11, 22, ad_text, 'https://t.me/c/123/456')
     await adbot_srv._process_messages()
-    await adbot_srv._forward_messages()
-    await asyncio.sleep(0.00000001)     # Give time to process asyncio tasks
-
-    messages_to_users = {
-        'apple banana orange': {user1.id},
-        'car bicycle': {user1.id, user2.id},
-        'sofa': {user2.id},
-    }
 
-    assert len(catched_events) == 4
+    # Reposted with other price and helmet
+    await adbot_srv.add_message(
+        12, 23, ad_text.replace('450', '400') + ' + helmet 🔥', 'https://t.me/c/456/789'
+    )
+    await adbot_srv._process_messages()
 
-    assert catched_events[0].user_id in messages_to_users[catched_events[0].message_text]
-    messages_to_users[catched_events[0].message_text].remove(catched_events[0].user_id)
+    async with adbot_srv._db_pool() as session:
+        session: AsyncSession
+        st = text(f"SELECT user_id, message_id FROM user_message_link ORDER BY message_id")
+        res = (await session.execute(st)).all()
+    assert [tuple(row) for row in res] == [(user1.id, 1), (user2.id, 2)]
 
-    assert catched_events[1].user_id in messages_to_users[catched_events[1].message_text]
-    messages_to_users[catched_events[1].message_text].remove(catched_events[1].user_id)
 
-    assert catched_events[2].user_id in messages_to_users[catched_events[2].message_text]
-    messages_to_users[catched_events[2].message_text].remove(catched_events[2].user_id)
+@pytest.mark.asyncio
+async def test_near_duplicates_index_loaded_on_start_by_chunks(
+    in_memory_adbot_srv: AdBotServices, monkeypatch
+):
+    adbot_srv = in_memory_adbot_srv
 
-    assert catched_events[3].user_id in messages_to_users[catched_events[3].message_text]
-    messages_to_users[catched_events[3].message_text].remove(catched_events[3].user_id)
+    user = await adbot_srv.create_user_by_telegram_data(11111, 'asd')
+    await adbot_srv.set_subscription_state(user.id, True)
+    await adbot_srv.add_keyword(user.id, 'bicycle')
+    for i in range(5):
+        await adbot_srv.add_message(
+            i, i, f'Selling bicycle number {i} of model {i * 7}, size {i * 3}, ' \
+                f'price {i * 100} euro', f'https://t.me/c/123/{i}'
+        )
+    await adbot_srv._process_messages()
+    assert len(adbot_srv._near_duplicates) == 5
+
+    monkeypatch.setattr(services, 'NEAR_DUPLICATES_LOAD_CHUNK_SIZE', 2)
+    adbot_srv_2 = await AdBotServices(adbot_srv._db_pool)
+    assert len(adbot_srv_2._near_duplicates) == 5
+
+
+@pytest.mark.asyncio
+async def test_process_messages_raises_exception_on_sql_error(
+    in_memory_adbot_srv: AdBotServices
+):
+    adbot_srv = in_memory_adbot_srv
+
+    await adbot_srv.add_message(11, 22, 'apple banana orange', 'https://t.me/c/123/456')
+
+    user = await adbot_srv.create_user_by_telegram_data(11111, 'asd')
+    await adbot_srv.set_subscription_state(user.id, True)
+
+    await adbot_srv.add_keyword(user.id, 'apple')
+
+    # broken DB returns SQLAlchemyError on every query and commit
+    adbot_srv._db_pool = brake_sessionmaker(adbot_srv._db_pool)
+
+    with pytest.raises(exc.AdBotExceptionSQL):
+        await adbot_srv._process_messages()
+
+
+# ========================================================================================
+# Message forwarding
+
+@pytest.mark.asyncio
+async def test_apply_retention_by_age(in_memory_db_sessionmaker):
+    adbot_srv = await AdBotServices(in_memory_db_sessionmaker, retention_days=10)
+    adbot_srv._RETENTION_BATCH_SIZE = 2
+
+    user = await adbot_srv.create_user_by_telegram_data(11111, 'asd')
+    await adbot_srv.set_subscription_state(user.id, True)
+    await adbot_srv.add_keyword(user.id, 'apple')
+    for i in range(6):
+        await adbot_srv.add_message(i, i, f'apple {i}', f'https://t.me/c/123/{i}')
+    await adbot_srv._process_messages()
+    await adbot_srv.add_message(7, 7, 'apple 7', 'https://t.me/c/123/7')  # unprocessed
+
+    async with adbot_srv._db_pool() as session:
+        session: AsyncSession
+        old_dt = datetime.now() - timedelta(days=11)
+        await session.execute(
+            text(f"UPDATE chat_message SET added_dt = :dt WHERE id != 6"), {'dt': old_dt}
+        )
+        await session.commit()
+
+    assert await adbot_srv._apply_retention() == 5
+
+    async with adbot_srv._db_pool() as session:
+        session: AsyncSession
+        st = text(f"SELECT id FROM chat_message ORDER BY id")
+        res = (await session.execute(st)).all()
+        assert [row[0] for row in res] == [6, 7]
+        st = text(f"SELECT message_id FROM user_message_link")
+        res = (await session.execute(st)).all()
+        assert [row[0] for row in res] == [6]
+
+
+@pytest.mark.asyncio
+async def test_apply_retention_by_count_with_archive(in_memory_db_sessionmaker, tmp_path):
+    adbot_srv = await AdBotServices(
+        in_memory_db_sessionmaker, retention_max_messages=2, archive_dir=str(tmp_path)
+    )
+    for i in range(5):
+        await adbot_srv.add_message(i, i, f'message {i}', f'https://t.me/c/123/{i}')
+    await adbot_srv._process_messages()
+
+    assert await adbot_srv._apply_retention() == 3
+    assert await adbot_srv._apply_retention() == 0
+
+    async with adbot_srv._db_pool() as session:
+        session: AsyncSession
+        st = text(f"SELECT id FROM chat_message ORDER BY id")
+        res = (await session.execute(st)).all()
+        assert [row[0] for row in res] == [4, 5]
+
+    archived = list(adbot_srv._archive.iter_messages())
+    assert [msg['id'] for msg in archived] == [1, 2, 3]
+    assert archived[0]['text'] == 'message 0'
+    assert archived[0]['url'] == 'https://t.me/c/123/0'
+
+
+@pytest.mark.asyncio
+async def test_apply_retention_disabled(in_memory_adbot_srv: AdBotServices):
+    adbot_srv = in_memory_adbot_srv
+    await adbot_srv.add_message(1, 1, 'message', 'https://t.me/c/123/1')
+    await adbot_srv._process_messages()
+
+    assert await adbot_srv._apply_retention() == 0
+
+
+@pytest.mark.asyncio
+async def test_forward_messages(in_memory_adbot_srv: AdBotServices):
+    adbot_srv = in_memory_adbot_srv
+
+    catched_events = []
+    async def fake_subscriber_func_local(event: mb.AdBotEvent):
+        catched_events.append(event)
+
+    adbot_srv.messagebus.subscribe(
+        [events.AdBotMessageForwardRequest], fake_subscriber_func_local
+    )
+
+    await adbot_srv.add_message(11, 22, 'apple banana orange', 'https://t.me/c/123/456')
+    await adbot_srv.add_message(12, 23, 'car bicycle', 'https://t.me/c/234/567')
+
+    user = await adbot_srv.create_user_by_telegram_data(11111, 'asd')
+    await adbot_srv.set_subscription_state(user.id, True)
+    await adbot_srv.add_keyword(user.id, 'apple')
+    await adbot_srv.add_keyword(user.id, 'bicycle')
+    await adbot_srv._process_messages()
+
+    await adbot_srv._forward_messages()
+    await asyncio.sleep(0.00000001)     # Give time to process asyncio tasks
+
+    expected_messages = {
+        'apple banana orange',
+        'car bicycle'
+    }
+
+    assert len(catched_events) == 2
+    assert catched_events[0].message_text in expected_messages
+    expected_messages.remove(catched_events[0].message_text)
+    assert catched_events[1].message_text in expected_messages
+    expected_messages.remove(catched_events[1].message_text)
+    assert len(expected_messages) == 0
+
+
+@pytest.mark.asyncio
+async def test_forward_messages_records_latency(in_memory_adbot_srv: AdBotServices):
+    adbot_srv = in_memory_adbot_srv
+
+    catched_events = []
+    async def fake_subscriber_func_local(event: mb.AdBotEvent):
+        catched_events.append(event)
+
+    adbot_srv.messagebus.subscribe(
+        [events.AdBotMessageForwardRequest], fake_subscriber_func_local
+    )
+
+    user = await adbot_srv.create_user_by_telegram_data(11111, 'asd')
+    await adbot_srv.set_subscription_state(user.id, True)
+    await adbot_srv.add_keyword(user.id, 'apple')
+    fetched_dt = datetime.now() - timedelta(seconds=5)
+    await adbot_srv.add_message(11, 22, 'apple', 'https://t.me/c/123/456', fetched_dt)
+    await adbot_srv._process_messages()
+    await adbot_srv._forward_messages()
+    await asyncio.sleep(0.00000001)     # Give time to process asyncio tasks
+
+    assert len(catched_events) == 1
+    event: events.AdBotMessageForwardRequest = catched_events[0]
+    assert event.fetched_dt == fetched_dt
+    assert event.fetched_dt < event.added_dt <= event.processed_dt <= event.requested_dt
+
+    adbot_srv.record_message_sent(event)
+    stats = adbot_srv.get_latency_stats()
+    for stage in (
+        'fetch_to_add', 'add_to_process', 'process_to_forward', 'forward_to_send',
+        'total'
+    ):
+        assert stats[stage]['count'] == 1
+    assert 5 <= stats['fetch_to_add']['max'] < 6
+    assert 5 <= stats['total']['p99'] < 6
+
+    adbot_srv.reset_latency_stats()
+    assert adbot_srv.get_latency_stats() == {}
+
+
+@pytest.mark.asyncio
+async def test_forward_messages_in_chunks_only_for_users_with_closed_menu(
+    in_memory_adbot_srv: AdBotServices
+):
+    adbot_srv = in_memory_adbot_srv
+    adbot_srv._FORWARD_MESSAGES_CHUNK_SIZE = 2
+
+    catched_events = []
+    async def fake_subscriber_func_local(event: mb.AdBotEvent):
+        catched_events.append(event)
+
+    adbot_srv.messagebus.subscribe(
+        [events.AdBotMessageForwardRequest], fake_subscriber_func_local
+    )
+
+    user_ids = []
+    for tg_id in (11111, 22222, 33333):
+        user = await adbot_srv.create_user_by_telegram_data(tg_id, 'asd')
+        await adbot_srv.set_subscription_state(user.id, True)
+        await adbot_srv.set_forwarding_state(user.id, True)
+        await adbot_srv.add_keyword(user.id, 'apple')
+        user_ids.append(user.id)
+    await adbot_srv.set_menu_closed_state(user_ids[2], False)
+    for i in range(3):
+        await adbot_srv.add_message(i, i, f'apple {i}', f'https://t.me/c/123/{i}')
+    await adbot_srv._process_messages()
+
+    await adbot_srv._forward_messages()
+    await asyncio.sleep(0.00000001)     # Give time to process asyncio tasks
+
+    assert sorted((e.telegram_id, e.message_url) for e in catched_events) == [
+        (tg_id, f'https://t.me/c/123/{i}') for tg_id in (11111, 22222) for i in range(3)
+    ]
+    async with adbot_srv._db_pool() as session:
+        session: AsyncSession
+        st = text(f"SELECT user_id, message_id FROM user_message_link")
+        res = (await session.execute(st)).all()
+        assert sorted(res) == [(user_ids[2], i) for i in range(1, 4)]
+
+
+@pytest.mark.asyncio
+async def test_forward_messages_digest_mode(in_memory_adbot_srv: AdBotServices):
+    adbot_srv = in_memory_adbot_srv
+    adbot_srv._digest_max_messages = 2
+
+    catched_events = []
+    async def fake_subscriber_func_local(event: mb.AdBotEvent):
+        catched_events.append(event)
+
+    adbot_srv.messagebus.subscribe(
+        [events.AdBotMessageForwardRequest, events.AdBotDigestForwardRequest],
+        fake_subscriber_func_local
+    )
+
+    digest_user = await adbot_srv.create_user_by_telegram_data(11111, 'asd')
+    user = await adbot_srv.create_user_by_telegram_data(22222, 'asd')
+    for u in (digest_user, user):
+        await adbot_srv.set_subscription_state(u.id, True)
+        await adbot_srv.set_forwarding_state(u.id, True)
+        await adbot_srv.add_keyword(u.id, 'apple')
+    await adbot_srv.set_digest_mode(digest_user.id, True)
+    for i in range(3):
+        await adbot_srv.add_message(i, i, f'apple {i}', f'https://t.me/c/123/{i}')
+    await adbot_srv._process_messages()
+
+    # Full digest is sent, the rest waits for digest interval
+    await adbot_srv._forward_messages()
+    await asyncio.sleep(0.00000001)     # Give time to process asyncio tasks
+    digests = [
+        e for e in catched_events if isinstance(e, events.AdBotDigestForwardRequest)
+    ]
+    assert len(digests) == 1
+    assert digests[0].telegram_id == 11111
+    assert digests[0].message_urls == ['https://t.me/c/123/0', 'https://t.me/c/123/1']
+    assert len(catched_events) == 4     # + 3 messages to user without digest mode
+    assert all(e.telegram_id == 22222 for e in catched_events if e is not digests[0])
+
+    catched_events.clear()
+    await adbot_srv._forward_messages()
+    await asyncio.sleep(0.00000001)     # Give time to process asyncio tasks
+    assert len(catched_events) == 0
+
+    # Digest interval passed
+    async with adbot_srv._db_pool() as session:
+        session: AsyncSession
+        old_dt = datetime.now() - adbot_srv._digest_interval
+        await session.execute(
+            text(f"UPDATE user_account SET digest_sent_dt = :dt"), {'dt': old_dt}
+        )
+        await session.commit()
+    await adbot_srv._forward_messages()
+    await asyncio.sleep(0.00000001)     # Give time to process asyncio tasks
+    assert len(catched_events) == 1
+    assert catched_events[0].message_urls == ['https://t.me/c/123/2']
+
+
+@pytest.mark.asyncio
+async def test_forward_messages_case_insensitive(in_memory_adbot_srv: AdBotServices):
+    adbot_srv = in_memory_adbot_srv
+
+    catched_events = []
+    async def fake_subscriber_func_local(event: mb.AdBotEvent):
+        catched_events.append(event)
+
+    adbot_srv.messagebus.subscribe(
+        [events.AdBotMessageForwardRequest], fake_subscriber_func_local
+    )
+
+    await adbot_srv.add_message(11, 22, 'Apple Banana Orange', 'https://t.me/c/123/456')
+
+    user = await adbot_srv.create_user_by_telegram_data(11111, 'asd')
+    await adbot_srv.set_subscription_state(user.id, True)
+    await adbot_srv.add_keyword(user.id, 'apple')
+    await adbot_srv.add_keyword(user.id, 'bicycle')
+    await adbot_srv._process_messages()
+
+    await adbot_srv._forward_messages()
+    await asyncio.sleep(0.00000001)     # Give time to process asyncio tasks
+
+    expected_messages = {
+        'Apple Banana Orange'
+    }
+
+    assert len(catched_events) == 1
+    assert catched_events[0].message_text in expected_messages
+    expected_messages.remove(catched_events[0].message_text)
+    assert len(expected_messages) == 0
+
+
+@pytest.mark.asyncio
+async def test_forward_messages_does_nothing_if_forwarding_disabled(
+    in_memory_adbot_srv: AdBotServices
+):
+    adbot_srv = in_memory_adbot_srv
+
+    catched_events = []
+    async def fake_subscriber_func_local(event: mb.AdBotEvent):
+        catched_events.append(event)
+
+    adbot_srv.messagebus.subscribe(
+        [events.AdBotMessageForwardRequest], fake_subscriber_func_local
+    )
+
+    await adbot_srv.add_message(11, 22, 'apple banana orange', 'https://t.me/c/123/456')
+    await adbot_srv.add_message(12, 23, 'car bicycle', 'https://t.me/c/234/567')
+
+    user = await adbot_srv.create_user_by_telegram_data(11111, 'asd')
+    await adbot_srv.set_subscription_state(user.id, True)
+    await adbot_srv.set_forwarding_state(user.id, False)
+    await adbot_srv.add_keyword(user.id, 'apple')
+    await adbot_srv.add_keyword(user.id, 'bicycle')
+    await adbot_srv._process_messages()
+
+    await adbot_srv._forward_messages()
+    await asyncio.sleep(0.00000001)     # Give time to process asyncio tasks
+
+    assert len(catched_events) == 0
+
+
+@pytest.mark.asyncio
+async def test_forward_messages_two_users(in_memory_adbot_srv: AdBotServices):
+    adbot_srv = in_memory_adbot_srv
+
+    catched_events = []
+    async def fake_subscriber_func_local(event: mb.AdBotEvent):
+        catched_events.append(event)
+
+    adbot_srv.messagebus.subscribe(
+        [events.AdBotMessageForwardRequest], fake_subscriber_func_local
+    )
+
+    await adbot_srv.add_message(11, 22, 'apple banana orange', 'https://t.me/c/123/456')
+    await adbot_srv.add_message(12, 23, 'car bicycle', 'https://t.me/c/234/567')
+    await adbot_srv.add_message(13, 24, 'sofa', 'https://t.me/c/345/678')
+
+    user1 = await adbot_srv.create_user_by_telegram_data(11111, 'asd')
+    await adbot_srv.set_subscription_state(user1.id, True)
+    await adbot_srv.add_keyword(user1.id, 'apple')
+    await adbot_srv.add_keyword(user1.id, 'bicycle')
+
+    user2 = await adbot_srv.create_user_by_telegram_data(22222, 'dsa')
+    await adbot_srv.set_subscription_state(user2.id, True)
+    await adbot_srv.add_keyword(user2.id, 'bicycle')
+    await adbot_srv.add_keyword(user2.id, 'sofa')
+
+    await adbot_srv._process_messages()
+    await adbot_srv._forward_messages()
+    await asyncio.sleep(0.00000001)     # Give time to process asyncio tasks
+
+    messages_to_users = {
+        'apple banana orange': {user1.id},
+        'car bicycle': {user1.id, user2.id},
+        'sofa': {user2.id},
+    }
+
+    assert len(catched_events) == 4
+
+    assert catched_events[0].user_id in messages_to_users[catched_events[0].message_text]
+    messages_to_users[catched_events[0].message_text].remove(catched_events[0].user_id)
+
+    assert catched_events[1].user_id in messages_to_users[catched_events[1].message_text]
+    messages_to_users[catched_events[1].message_text].remove(catched_events[1].user_id)
+
+    assert catched_events[2].user_id in messages_to_users[catched_events[2].message_text]
+    messages_to_users[catched_events[2].message_text].remove(catched_events[2].user_id)
+
+    assert catched_events[3].user_id in messages_to_users[catched_events[3].message_text]
+    messages_to_users[catched_events[3].message_text].remove(catched_events[3].user_id)
+
+
+@pytest.mark.asyncio
+async def test_forward_messages_with_bounded_messagebus(in_memory_db_sessionmaker):
+    adbot_srv = await AdBotServices(
+        in_memory_db_sessionmaker, messagebus_workers=1, messagebus_queue_size=1
+    )
+    release = asyncio.Event()
+    catched_events = []
+    async def fake_subscriber_func_local(event: mb.AdBotEvent):
+        await release.wait()
+        catched_events.append(event)
+
+    adbot_srv.messagebus.subscribe(
+        [events.AdBotMessageForwardRequest], fake_subscriber_func_local
+    )
+    user = await adbot_srv.create_user_by_telegram_data(11111, 'asd')
+    await adbot_srv.set_subscription_state(user.id, True)
+    await adbot_srv.add_keyword(user.id, 'apple')
+    for i in range(5):
+        await adbot_srv.add_message(i, i, f'apple {i}', f'https://t.me/c/123/{i}')
+    await adbot_srv._process_messages()
+
+    try:
+        forward_task = asyncio.create_task(adbot_srv._forward_messages())
+        await asyncio.sleep(0.1)
+        assert not forward_task.done()      # waits while events queue is full
+        release.set()
+        await asyncio.wait_for(forward_task, 1)
+        await adbot_srv.messagebus.wait_for_tasks_done()
+    finally:
+        adbot_srv.messagebus.stop()
+    assert len(catched_events) == 5
+
+
+# ========================================================================================
+# Outbox (acknowledged delivery of forwarded messages)
+
+async def _forward_to_new_user(
+    adbot_srv: AdBotServices, catched_events: list, messages_cnt: int = 1
+) -> models.User:
+    async def fake_subscriber_func_local(event: mb.AdBotEvent):
+        catched_events.append(event)
+
+    adbot_srv.messagebus.subscribe(
+        [events.AdBotMessageForwardRequest], fake_subscriber_func_local
+    )
+    user = await adbot_srv.create_user_by_telegram_data(11111, 'asd')
+    await adbot_srv.set_subscription_state(user.id, True)
+    await adbot_srv.add_keyword(user.id, 'apple')
+    for i in range(messages_cnt):
+        await adbot_srv.add_message(i, i, f'apple {i}', f'https://t.me/c/123/{i}')
+    await adbot_srv._process_messages()
+    await adbot_srv._forward_messages()
+    await asyncio.sleep(0.00000001)     # Give time to process asyncio tasks
+    return user
+
+
+async def _get_outbox_states(adbot_srv: AdBotServices) -> list[tuple[str, int]]:
+    async with adbot_srv._db_pool() as session:
+        session: AsyncSession
+        st = select(models.OutboxMessage.state, models.OutboxMessage.attempts) \
+            .order_by(models.OutboxMessage.id)
+        return [tuple(row) for row in (await session.execute(st)).all()]
+
+
+@pytest.mark.asyncio
+async def test_outbox_message_sent_acknowledged(in_memory_adbot_srv: AdBotServices):
+    adbot_srv = in_memory_adbot_srv
+    catched_events = []
+    await _forward_to_new_user(adbot_srv, catched_events, 2)
+
+    assert len(catched_events) == 2
+    assert await _get_outbox_states(adbot_srv) == [('in_flight', 1), ('in_flight', 1)]
+
+    # Acknowledgements are buffered until flush
+    for event in catched_events:
+        adbot_srv.record_message_sent(event)
+    assert await _get_outbox_states(adbot_srv) == [('in_flight', 1), ('in_flight', 1)]
+
+    await adbot_srv._flush_outbox_acks()
+    assert await _get_outbox_states(adbot_srv) == [('sent', 1), ('sent', 1)]
+
+    # Sent messages are not forwarded again
+    await adbot_srv._forward_messages()
+    await asyncio.sleep(0.00000001)     # Give time to process asyncio tasks
+    assert len(catched_events) == 2
+
+    # Old entries are purged
+    assert await adbot_srv._purge_outbox() == 0
+    adbot_srv._OUTBOX_KEEP_DONE_HOURS = -1
+    assert await adbot_srv._purge_outbox() == 2
+    assert await _get_outbox_states(adbot_srv) == []
+
+
+@pytest.mark.asyncio
+async def test_outbox_acks_batch_wakes_up_outbox_stage(
+    in_memory_adbot_srv: AdBotServices
+):
+    adbot_srv = in_memory_adbot_srv
+    adbot_srv._OUTBOX_ACK_BATCH_SIZE = 2
+    catched_events = []
+    await _forward_to_new_user(adbot_srv, catched_events, 2)
+
+    adbot_srv.record_message_sent(catched_events[0])
+    assert adbot_srv._outbox_ack_event.is_set() == False
+    adbot_srv.record_message_failed(catched_events[1])
+    assert adbot_srv._outbox_ack_event.is_set() == True
+
+    adbot_srv._OUTBOX_FLUSH_INTERVAL_SEC = 100
+    adbot_srv._stop = False
+    await asyncio.wait_for(adbot_srv._outbox_step(), 1)
+    assert await _get_outbox_states(adbot_srv) == [('sent', 1), ('pending', 1)]
+
+
+@pytest.mark.asyncio
+async def test_outbox_failed_message_retried_with_backoff(
+    in_memory_adbot_srv: AdBotServices
+):
+    adbot_srv = in_memory_adbot_srv
+    adbot_srv._OUTBOX_MAX_ATTEMPTS = 2
+    catched_events = []
+    await _forward_to_new_user(adbot_srv, catched_events)
+
+    adbot_srv.record_message_failed(catched_events[0])
+    dt_before = datetime.now()
+    await adbot_srv._flush_outbox_acks()
+    assert await _get_outbox_states(adbot_srv) == [('pending', 1)]
+    async with adbot_srv._db_pool() as session:
+        due_dt = await session.scalar(select(models.OutboxMessage.due_dt))
+    assert due_dt >= dt_before + timedelta(seconds=adbot_srv._OUTBOX_RETRY_MIN_DELAY_SEC)
+
+    # Not forwarded before delay expired
+    assert await adbot_srv._dispatch_outbox() == 0
+
+    adbot_srv._OUTBOX_RETRY_MIN_DELAY_SEC = 0
+    catched_events[0].outbox_id = None  # this event mustn't be acknowledged
+    adbot_srv.record_message_failed(catched_events[0])
+    async with adbot_srv._db_pool() as session:
+        await session.execute(text("UPDATE outbox SET due_dt = :dt"), {'dt': dt_before})
+        await session.commit()
+    assert await adbot_srv._dispatch_outbox() == 1
+    await asyncio.sleep(0.00000001)     # Give time to process asyncio tasks
+    assert len(catched_events) == 2
+    assert catched_events[1].message_url == 'https://t.me/c/123/0'
+    assert await _get_outbox_states(adbot_srv) == [('in_flight', 2)]
+
+    # Max attempts reached
+    adbot_srv.record_message_failed(catched_events[1])
+    await adbot_srv._flush_outbox_acks()
+    assert await _get_outbox_states(adbot_srv) == [('failed', 2)]
+    assert await adbot_srv._dispatch_outbox() == 0
+
+
+@pytest.mark.asyncio
+async def test_outbox_failed_message_not_retried_if_retry_is_false(
+    in_memory_adbot_srv: AdBotServices
+):
+    adbot_srv = in_memory_adbot_srv
+    catched_events = []
+    await _forward_to_new_user(adbot_srv, catched_events)
+
+    adbot_srv.record_message_failed(catched_events[0], retry=False)
+    await adbot_srv._flush_outbox_acks()
+    assert await _get_outbox_states(adbot_srv) == [('failed', 1)]
+
+
+@pytest.mark.asyncio
+async def test_outbox_message_forwarded_again_after_lease_expired(
+    in_memory_adbot_srv: AdBotServices
+):
+    adbot_srv = in_memory_adbot_srv
+    adbot_srv._OUTBOX_LEASE_SEC = 0
+    catched_events = []
+    await _forward_to_new_user(adbot_srv, catched_events)
+
+    assert await adbot_srv._dispatch_outbox() == 1
+    await asyncio.sleep(0.00000001)     # Give time to process asyncio tasks
+    assert len(catched_events) == 2
+    assert catched_events[0].outbox_id == catched_events[1].outbox_id
+
+    adbot_srv.record_message_sent(catched_events[1])
+    assert await adbot_srv._dispatch_outbox() == 0
+    assert await _get_outbox_states(adbot_srv) == [('sent', 2)]
+
+
+@pytest.mark.asyncio
+async def test_outbox_in_flight_entries_limited(in_memory_adbot_srv: AdBotServices):
+    adbot_srv = in_memory_adbot_srv
+    adbot_srv._OUTBOX_MAX_IN_FLIGHT_PER_USER = 2
+    catched_events = []
+    await _forward_to_new_user(adbot_srv, catched_events, 5)
+
+    assert len(catched_events) == 2
+    assert await adbot_srv._dispatch_outbox() == 0
+
+    adbot_srv.record_message_sent(catched_events[0])
+    assert await adbot_srv._dispatch_outbox() == 1
+    await asyncio.sleep(0.00000001)     # Give time to process asyncio tasks
+    assert [event.message_url for event in catched_events] == \
+        [f'https://t.me/c/123/{i}' for i in range(3)]
+
+    adbot_srv._OUTBOX_MAX_IN_FLIGHT = 2
+    adbot_srv.record_message_sent(catched_events[1])
+    adbot_srv.record_message_sent(catched_events[2])
+    assert await adbot_srv._dispatch_outbox() == 2
+    assert await adbot_srv._dispatch_outbox() == 0
+    assert await _get_outbox_states(adbot_srv) == \
+        [('sent', 1)] * 3 + [('in_flight', 1)] * 2
+
+
+@pytest.mark.asyncio
+async def test_outbox_dispatch_resumes_after_acks_free_in_flight_slots(
+    in_memory_adbot_srv: AdBotServices
+):
+    adbot_srv = in_memory_adbot_srv
+    adbot_srv._OUTBOX_MAX_IN_FLIGHT_PER_USER = 2
+    catched_events = []
+    await _forward_to_new_user(adbot_srv, catched_events, 7)
+    dispatched_counts = [len(catched_events)]
+
+    while True:
+        for event in catched_events[-dispatched_counts[-1]:]:
+            adbot_srv.record_message_sent(event)
+        dispatched_cnt = await adbot_srv._dispatch_outbox()
+        await asyncio.sleep(0.00000001)     # Give time to process asyncio tasks
+        if dispatched_cnt == 0:
+            break
+        dispatched_counts.append(dispatched_cnt)
+    await adbot_srv._flush_outbox_acks()
+
+    assert dispatched_counts == [2, 2, 2, 1]
+    assert [event.message_url for event in catched_events] == \
+        [f'https://t.me/c/123/{i}' for i in range(7)]
+    assert await _get_outbox_states(adbot_srv) == [('sent', 1)] * 7
+
+
+@pytest.mark.asyncio
+async def test_outbox_lease_renewed_when_sending_starts(
+    in_memory_adbot_srv: AdBotServices
+):
+    adbot_srv = in_memory_adbot_srv
+    catched_events = []
+    await _forward_to_new_user(adbot_srv, catched_events)
+    async with adbot_srv._db_pool() as session:
+        due_dt = await session.scalar(select(models.OutboxMessage.due_dt))
+
+    await asyncio.sleep(0.01)
+    adbot_srv.record_message_sending(catched_events[0])
+    await adbot_srv._flush_outbox_acks()
+    async with adbot_srv._db_pool() as session:
+        assert await session.scalar(select(models.OutboxMessage.due_dt)) > due_dt
+
+
+@pytest.mark.asyncio
+async def test_outbox_slow_sender_doesnt_get_duplicates(
+    in_memory_adbot_srv: AdBotServices
+):
+    adbot_srv = in_memory_adbot_srv
+    adbot_srv._OUTBOX_LEASE_SEC = 0.3
+    adbot_srv._OUTBOX_MAX_IN_FLIGHT_PER_USER = 2
+    messages_cnt = 8
+    sent_ids = []
+    sender_lock = asyncio.Lock()
+    async def slow_sender(event: events.AdBotMessageForwardRequest):
+        async with sender_lock:     # sends 10 messages per second
+            adbot_srv.record_message_sending(event)
+            await asyncio.sleep(0.1)
+            sent_ids.append(event.outbox_id)
+            adbot_srv.record_message_sent(event)
+
+    adbot_srv.messagebus.subscribe([events.AdBotMessageForwardRequest], slow_sender)
+    user = await adbot_srv.create_user_by_telegram_data(11111, 'asd')
+    await adbot_srv.set_subscription_state(user.id, True)
+    await adbot_srv.add_keyword(user.id, 'apple')
+    for i in range(messages_cnt):
+        await adbot_srv.add_message(i, i, f'apple {i}', f'https://t.me/c/123/{i}')
+    await adbot_srv._process_messages()
+    await adbot_srv._forward_messages()
+
+    # Sending of all messages takes longer than the lease
+    for _ in range(30):
+        await asyncio.sleep(0.05)
+        await adbot_srv._dispatch_outbox()
+    await adbot_srv.messagebus.wait_for_tasks_done()
+    await adbot_srv._flush_outbox_acks()
+
+    assert len(sent_ids) == messages_cnt
+    assert len(set(sent_ids)) == messages_cnt
+    assert await _get_outbox_states(adbot_srv) == [('sent', 1)] * messages_cnt
+
+
+@pytest.mark.asyncio
+async def test_outbox_acks_kept_on_sql_error(in_memory_adbot_srv: AdBotServices):
+    adbot_srv = in_memory_adbot_srv
+    catched_events = []
+    await _forward_to_new_user(adbot_srv, catched_events)
+    adbot_srv.record_message_sent(catched_events[0])
+
+    db_pool = adbot_srv._db_pool
+    adbot_srv._db_pool = brake_sessionmaker(db_pool)
+    with pytest.raises(exc.AdBotExceptionSQL):
+        await adbot_srv._flush_outbox_acks()
+
+    adbot_srv._db_pool = db_pool
+    await adbot_srv._flush_outbox_acks()
+    assert await _get_outbox_states(adbot_srv) == [('sent', 1)]
 
 
 # ========================================================================================
@@ -1253,6 +2146,47 @@ async def test_inactivity_timeouts_several_users(in_memory_adbot_srv: AdBotServi
 # ========================================================================================
 # `User data updated` events
 
+
+@pytest.mark.asyncio
+async def test_inactivity_timeouts_menu_state_changed_while_publishing(
+    in_memory_db_sessionmaker
+):
+    adbot_srv = await AdBotServices(
+        in_memory_db_sessionmaker, messagebus_workers=1, messagebus_queue_size=1
+    )
+    release = asyncio.Event()
+    catched_events = []
+    async def fake_subscriber_func_local(event: mb.AdBotEvent):
+        await release.wait()
+        catched_events.append(event)
+
+    adbot_srv.messagebus.subscribe(
+        [events.AdBotInactivityTimeout], fake_subscriber_func_local
+    )
+    users = []
+    for i in range(6):
+        user = await adbot_srv.create_user_by_telegram_data(111111 + i, 'asd')
+        await adbot_srv.set_menu_closed_state(user.id, False)
+        adbot_srv._menu_activity_cache[user.id]['act_dt'] = \
+            datetime.now() - timedelta(minutes=IDLE_TIMEOUT_MINUTES)
+        users.append(user)
+
+    try:
+        check_task = asyncio.create_task(adbot_srv._check_idle_timeouts())
+        await asyncio.sleep(0.1)
+        assert not check_task.done()    # waits while events queue is full
+        # User closes the menu, another user opens it
+        await adbot_srv.set_menu_closed_state(users[-1].id, True)
+        new_user = await adbot_srv.create_user_by_telegram_data(999999, 'new')
+        await adbot_srv.set_menu_closed_state(new_user.id, False)
+        release.set()
+        await asyncio.wait_for(check_task, 1)
+        await adbot_srv.messagebus.wait_for_tasks_done()
+    finally:
+        adbot_srv.messagebus.stop()
+    assert sorted(e.user_id for e in catched_events) == [u.id for u in users[:-1]]
+
+
 @pytest.mark.asyncio
 async def test_check_user_data_updated_generate_event(in_memory_adbot_srv: AdBotServices):
     adbot_srv = in_memory_adbot_srv
@@ -1491,6 +2425,143 @@ async def test_main_cycle_generates_AdBotStop_event_after_stop_cmd(
     assert catched_events[0].__class__ == events.AdBotStop
 
 
+@pytest.mark.asyncio
+async def test_main_cycle_wakes_up_on_new_message(in_memory_adbot_srv: AdBotServices):
+    adbot_srv = in_memory_adbot_srv
+    adbot_srv._WAKE_DEBOUNCE_SEC = 0.01
+    adbot_srv._MIN_LOOP_WAIT_SEC = adbot_srv._loop_wait_sec = 100
+    adbot_srv._MAX_LOOP_WAIT_SEC = 100
+
+    user = await adbot_srv.create_user_by_telegram_data(11111, 'asd')
+    await adbot_srv.set_subscription_state(user.id, True)
+    await adbot_srv.add_keyword(user.id, 'apple')
+
+    task = asyncio.create_task(adbot_srv.run())
+    await asyncio.sleep(0.05)
+    await adbot_srv.add_message(11, 22, 'apple banana', 'https://t.me/c/123/456')
+    await asyncio.sleep(0.2)    # much less than _MIN_LOOP_WAIT_SEC
+
+    async with adbot_srv._db_pool() as session:
+        session: AsyncSession
+        res = (await session.execute(text(f"SELECT processed FROM chat_message"))).all()
+        assert [row[0] for row in res] == [1]
+
+    await adbot_srv.stop()
+    await asyncio.wait_for(task, 1)
+
+
+@pytest.mark.asyncio
+async def test_main_cycle_wait_timeout_adapts_to_backlog(
+    in_memory_adbot_srv: AdBotServices
+):
+    adbot_srv = in_memory_adbot_srv
+    adbot_srv._stop = False
+    adbot_srv._WAKE_DEBOUNCE_SEC = 0
+    adbot_srv._MIN_LOOP_WAIT_SEC = adbot_srv._loop_wait_sec = 0.01
+    adbot_srv._MAX_LOOP_WAIT_SEC = 0.03
+
+    await adbot_srv._loop_iter()
+    assert adbot_srv._loop_wait_sec == 0.02
+    await adbot_srv._loop_iter()
+    await adbot_srv._loop_iter()
+    assert adbot_srv._loop_wait_sec == 0.03     # not more than max
+
+    await adbot_srv.add_message(11, 22, 'apple banana', 'https://t.me/c/123/456')
+    await adbot_srv._loop_iter()
+    assert adbot_srv._loop_wait_sec == 0.01     # reset to min after processing
+
+
+@pytest.mark.asyncio
+async def test_main_cycle_checks_idle_timeouts_while_waiting(
+    in_memory_adbot_srv: AdBotServices
+):
+    adbot_srv = in_memory_adbot_srv
+    adbot_srv._CHECK_IDLE_INTERVAL_SEC = 0.01
+    adbot_srv._MIN_LOOP_WAIT_SEC = adbot_srv._loop_wait_sec = 100
+
+    checks_cnt = 0
+    async def fake_check_idle_timeouts():
+        nonlocal checks_cnt
+        checks_cnt += 1
+
+    adbot_srv._check_idle_timeouts = fake_check_idle_timeouts
+    task = asyncio.create_task(adbot_srv.run())
+    await asyncio.sleep(0.1)
+    assert checks_cnt > 3
+
+    await adbot_srv.stop()
+    await asyncio.wait_for(task, 1)
+
+
+@pytest.mark.asyncio
+async def test_main_cycle_forwards_processed_chunk_while_processing_next_one(
+    in_memory_adbot_srv: AdBotServices
+):
+    adbot_srv = in_memory_adbot_srv
+    adbot_srv._PROCESS_MESSAGES_CHUNK_SIZE = 1
+    adbot_srv._WAKE_DEBOUNCE_SEC = 0
+
+    user = await adbot_srv.create_user_by_telegram_data(11111, 'asd')
+    await adbot_srv.set_subscription_state(user.id, True)
+    await adbot_srv.add_keyword(user.id, 'apple')
+    for i in range(3):
+        await adbot_srv.add_message(i, i, f'apple {i}', f'https://t.me/c/123/{i}')
+
+    process_messages_chunk = adbot_srv._process_messages_chunk
+    async def slow_process_messages_chunk(last_id):
+        res = await process_messages_chunk(last_id)
+        await asyncio.sleep(0.05)
+        return res
+
+    forwarded_cnt = []
+    forward_messages = adbot_srv._forward_messages
+    async def fake_forward_messages():
+        forwarded_cnt.append(adbot_srv._processed_cnt)
+        await forward_messages()
+
+    adbot_srv._process_messages_chunk = slow_process_messages_chunk
+    adbot_srv._forward_messages = fake_forward_messages
+    task = asyncio.create_task(adbot_srv.run())
+    await asyncio.sleep(0.3)
+    await adbot_srv.stop()
+    await asyncio.wait_for(task, 1)
+
+    assert forwarded_cnt[0] < 3     # forwarding started before processing finished
+
+
+@pytest.mark.asyncio
+async def test_main_cycle_db_error_in_processing_doesnt_stop_other_stages(
+    in_memory_adbot_srv: AdBotServices
+):
+    adbot_srv = in_memory_adbot_srv
+    adbot_srv._MIN_LOOP_WAIT_SEC = adbot_srv._loop_wait_sec = 0.01
+    adbot_srv._CHECK_IDLE_INTERVAL_SEC = 0.01
+    adbot_srv._STAGE_RESTART_MIN_DELAY_SEC = 0.01
+
+    calls = {'process': 0, 'forward': 0, 'idle': 0}
+    async def fake_process_messages(chunk_done=None):
+        calls['process'] += 1
+        raise exc.AdBotExceptionSQL()
+    async def fake_forward_messages():
+        calls['forward'] += 1
+    async def fake_check_idle_timeouts():
+        calls['idle'] += 1
+
+    adbot_srv._process_messages = fake_process_messages
+    adbot_srv._forward_messages = fake_forward_messages
+    adbot_srv._check_idle_timeouts = fake_check_idle_timeouts
+    task = asyncio.create_task(adbot_srv.run())
+    await asyncio.sleep(0.2)
+
+    assert calls['process'] > 1     # stage restarted
+    assert calls['forward'] > 0
+    assert calls['idle'] > 1
+    assert not task.done()
+
+    await adbot_srv.stop()
+    await asyncio.wait_for(task, 1)
+
+
 @pytest.mark.asyncio
 async def test_main_cycle_reraises_and_stops_on_exception_in_loop(
     in_memory_adbot_srv: AdBotServices
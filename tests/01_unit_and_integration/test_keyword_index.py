@@ -0,0 +1,44 @@
+from adbot.domain.keyword_index import KeywordIndex
+
+
+def test_index_load():
+    index = KeywordIndex()
+    index.load(
+        [(1, 'apple', True), (1, 'pen', True), (2, 'apple', True), (3, 'sofa', False)],
+        generation=5
+    )
+
+    assert index.generation == 5
+    assert index.as_dict() == {'apple': {1, 2}, 'pen': {1}}
+    assert index.matcher.find_all('apple pen sofa') == {'apple', 'pen'}
+
+
+def test_index_add_remove_keyword():
+    index = KeywordIndex()
+    index.add_keyword(1, 'apple', True)
+    index.add_keyword(2, 'apple', True)
+    index.add_keyword(3, 'sofa', False)
+
+    assert index.as_dict() == {'apple': {1, 2}}
+
+    index.remove_keyword(1, 'apple')
+    assert index.as_dict() == {'apple': {2}}
+
+    index.remove_keyword(2, 'apple')
+    assert index.as_dict() == {}
+    assert index.matcher.find_all('apple') == set()
+
+
+def test_index_set_subscription_state():
+    index = KeywordIndex()
+    index.add_keyword(1, 'apple', False)
+    index.add_keyword(1, 'pen', False)
+    index.add_keyword(2, 'pen', True)
+
+    index.set_subscription_state(1, True)
+    assert index.as_dict() == {'apple': {1}, 'pen': {1, 2}}
+    assert index.matcher.find_all('apple pen') == {'apple', 'pen'}
+
+    index.set_subscription_state(1, False)
+    assert index.as_dict() == {'pen': {2}}
+    assert index.matcher.find_all('apple pen') == {'pen'}
@@ -0,0 +1,78 @@
+import random
+
+from adbot.domain.keyword_matcher import KeywordMatcher
+
+
+def test_matcher_finds_all_keywords():
+    matcher = KeywordMatcher(['apple', 'scooter', 'sofa', 'pen'])
+
+    assert matcher.find_all('apple banana orange') == {'apple'}
+    assert matcher.find_all('car bicycle scooter') == {'scooter'}
+    assert matcher.find_all('pen pencil brush, sofa') == {'pen', 'sofa'}
+    assert matcher.find_all('chair table') == set()
+
+
+def test_matcher_finds_overlapping_keywords():
+    matcher = KeywordMatcher(['he', 'she', 'his', 'hers'])
+
+    assert matcher.find_all('ushers') == {'he', 'she', 'hers'}
+    assert matcher.find_all('this') == {'his'}
+
+
+def test_matcher_empty():
+    matcher = KeywordMatcher()
+
+    assert len(matcher) == 0
+    assert matcher.find_all('apple banana orange') == set()
+
+
+def test_matcher_empty_keyword_matches_any_text():
+    matcher = KeywordMatcher(['', 'apple'])
+
+    assert matcher.find_all('') == {''}
+    assert matcher.find_all('apple') == {'', 'apple'}
+
+
+def test_matcher_same_result_as_substring_search():
+    rnd = random.Random(12345)
+    for _ in range(500):
+        keywords = {
+            ''.join(rnd.choice('abc') for _ in range(rnd.randint(1, 4)))
+                for _ in range(rnd.randint(1, 10))
+        }
+        text = ''.join(rnd.choice('abcd') for _ in range(rnd.randint(0, 30)))
+        matcher = KeywordMatcher(keywords)
+        assert matcher.find_all(text) == {kw for kw in keywords if kw in text}
+
+
+def test_matcher_add_remove_keywords():
+    matcher = KeywordMatcher(['apple'])
+
+    matcher.add('pen')
+    matcher.add('pencil')
+    assert matcher.find_all('pencil and apple') == {'pen', 'pencil', 'apple'}
+
+    matcher.remove('pen')
+    assert 'pen' not in matcher
+    assert matcher.find_all('pencil and apple') == {'pencil', 'apple'}
+
+    matcher.remove('apple')
+    matcher.remove('not_added')
+    assert len(matcher) == 1
+    assert matcher.find_all('pencil and apple') == {'pencil'}
+
+
+def test_matcher_add_remove_same_result_as_substring_search():
+    rnd = random.Random(54321)
+    matcher = KeywordMatcher()
+    keywords = set()
+    for _ in range(3000):
+        keyword = ''.join(rnd.choice('abc') for _ in range(rnd.randint(1, 4)))
+        if rnd.random() < 0.5:
+            matcher.add(keyword)
+            keywords.add(keyword)
+        else:
+            matcher.remove(keyword)
+            keywords.discard(keyword)
+        text = ''.join(rnd.choice('abcd') for _ in range(rnd.randint(0, 30)))
+        assert matcher.find_all(text) == {kw for kw in keywords if kw in text}
@@ -0,0 +1,37 @@
+from datetime import datetime, timedelta
+
+from adbot.domain.latency_stats import LatencyHistogram, LatencyStats
+
+
+def test_latency_histogram_percentiles():
+    histogram = LatencyHistogram()
+    for _ in range(98):
+        histogram.record(0.1)
+    histogram.record(10)
+    histogram.record(20)
+
+    assert histogram.count == 100
+    assert 0.1 <= histogram.percentile(50) < 0.2
+    assert 10 <= histogram.percentile(99) < 20
+    assert histogram.percentile(100) == 20
+    assert histogram.max == 20
+
+
+def test_latency_histogram_empty():
+    summary = LatencyHistogram().summary()
+    assert summary['count'] == 0
+    assert summary['p99'] == 0.0
+
+
+def test_latency_stats_record():
+    stats = LatencyStats()
+    now = datetime.now()
+    stats.record('stage_1', now - timedelta(seconds=3), now)
+    stats.record('stage_1', now - timedelta(seconds=1), now)
+    stats.record('stage_2', None, now)  # no timestamp, ignored
+
+    summary = stats.summary()
+    assert list(summary.keys()) == ['stage_1']
+    assert summary['stage_1']['count'] == 2
+    assert summary['stage_1']['mean'] == 2
+    assert summary['stage_1']['max'] == 3
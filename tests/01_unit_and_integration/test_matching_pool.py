@@ -0,0 +1,32 @@
+import pytest
+
+from adbot.domain import matching_pool
+from adbot.domain.matching_pool import MatchingPool
+
+
+def test_match_chunk_reports_outdated_index():
+    msgs = [(1, 'Apple banana'), (2, 'pen')]
+
+    assert matching_pool._match_chunk(1, msgs, ['apple']) == [(1, ['apple']), (2, [])]
+    assert matching_pool._match_chunk(1, msgs) == [(1, ['apple']), (2, [])]
+
+    # generation changed, index has to be refreshed
+    assert matching_pool._match_chunk(2, msgs) is None
+    assert matching_pool._match_chunk(2, msgs, ['pen']) == [(1, []), (2, ['pen'])]
+
+
+@pytest.mark.asyncio
+async def test_matching_pool_match():
+    pool = MatchingPool(2)
+    try:
+        msgs = [(i, f'Apple {i}' if i % 2 else f'pen {i}') for i in range(10)]
+
+        hits = await pool.match(msgs, ['apple'], 1)
+        assert sorted(msg_id for msg_id, kws in hits if kws == ['apple']) == \
+            [1, 3, 5, 7, 9]
+
+        hits = await pool.match(msgs, ['pen'], 2)
+        assert sorted(msg_id for msg_id, kws in hits if kws == ['pen']) == \
+            [0, 2, 4, 6, 8]
+    finally:
+        pool.shutdown()
@@ -0,0 +1,55 @@
+from datetime import datetime
+import os
+
+from adbot.domain.message_archive import MessageArchive, INDEX_FILE_NAME
+
+
+def _messages(first_id: int, cnt: int) -> list[dict]:
+    return [
+        {'id': i, 'text': f'message {i}', 'added_dt': datetime(2023, 9, 1, 12, 0)}
+            for i in range(first_id, first_id + cnt)
+    ]
+
+
+def test_message_archive_append_and_get(tmp_path):
+    archive = MessageArchive(str(tmp_path))
+    archive.append(_messages(1, 10))
+    archive.append(_messages(11, 10))
+
+    assert len(archive) == 20
+    assert archive.get(15) == {
+        'id': 15, 'text': 'message 15', 'added_dt': '2023-09-01T12:00:00'
+    }
+    assert archive.get(21) is None
+    assert [msg['id'] for msg in archive.iter_messages()] == list(range(1, 21))
+
+
+def test_message_archive_reopen(tmp_path):
+    MessageArchive(str(tmp_path)).append(_messages(1, 10))
+
+    archive = MessageArchive(str(tmp_path))
+    archive.append(_messages(11, 10))
+    assert len(archive) == 20
+    assert archive.get(5)['text'] == 'message 5'
+
+
+def test_message_archive_new_segment_when_size_exceeded(tmp_path):
+    archive = MessageArchive(str(tmp_path), segment_max_bytes=1)
+    archive.append(_messages(1, 10))
+    archive.append(_messages(11, 10))
+
+    segments = sorted(f for f in os.listdir(tmp_path) if f.startswith('segment_'))
+    assert segments == ['segment_000000000001.jsonl.gz', 'segment_000000000011.jsonl.gz']
+    assert archive.get(12)['text'] == 'message 12'
+
+
+def test_message_archive_ignores_incomplete_index_line(tmp_path):
+    archive = MessageArchive(str(tmp_path))
+    archive.append(_messages(1, 10))
+    with open(os.path.join(tmp_path, INDEX_FILE_NAME), 'a') as f:
+        f.write('{"segment": "segm')
+
+    archive = MessageArchive(str(tmp_path))
+    assert len(archive) == 10
+    archive.append(_messages(11, 10))
+    assert len(MessageArchive(str(tmp_path))) == 20
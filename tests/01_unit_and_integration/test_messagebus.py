@@ -210,3 +210,317 @@ async def test_post_events_several_subscribers_with_fault_in_one_handler():
 
     assert len(catched_events) == 0
     assert set(catched_events) == set()
+
+
+@pytest.mark.asyncio
+async def test_post_events_finished_tasks_are_released():
+    bus = mb.MessageBus()
+    release = asyncio.Event()
+    async def slow_handler(event: mb.AdBotEvent):
+        await release.wait()
+    async def fast_handler(event: mb.AdBotEvent):
+        pass
+    bus.subscribe([events.AdBotCriticalError], slow_handler)
+    bus.subscribe([events.AdBotInactivityTimeout], fast_handler)
+
+    bus.post_event(events.AdBotCriticalError('slow'))
+    for i in range(10):
+        bus.post_event(events.AdBotInactivityTimeout(i))
+    await asyncio.sleep(0.01)
+
+    assert len(bus._tasks) == 1     # finished tasks are not kept behind slow one
+    release.set()
+    await bus.wait_for_tasks_done()
+    assert len(bus._tasks) == 0
+
+
+@pytest.mark.asyncio
+async def test_workers_pool_limits_concurrency():
+    bus = mb.MessageBus(workers=2)
+    running = 0
+    max_running = 0
+    handled = []
+    async def handler(event: mb.AdBotEvent):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.01)
+        handled.append(event.user_id)
+        running -= 1
+    bus.subscribe([events.AdBotInactivityTimeout, events.AdBotUserDataUpdated], handler)
+
+    try:
+        for i in range(5):
+            await bus.publish(events.AdBotInactivityTimeout(i))
+            bus.post_event(events.AdBotUserDataUpdated(i))
+        await bus.wait_for_tasks_done()
+    finally:
+        bus.stop()
+
+    assert sorted(handled) == sorted(list(range(5)) * 2)
+    assert max_running == 2
+
+
+@pytest.mark.asyncio
+async def test_publish_waits_when_queue_is_full():
+    bus = mb.MessageBus(workers=1, queue_size=2)
+    release = asyncio.Event()
+    handled = []
+    async def handler(event: mb.AdBotEvent):
+        await release.wait()
+        handled.append(event.user_id)
+    bus.subscribe([events.AdBotInactivityTimeout], handler)
+
+    try:
+        # 1 is being handled, 1 waits for free worker, 2 are queued
+        for i in range(4):
+            await bus.publish(events.AdBotInactivityTimeout(i))
+            await asyncio.sleep(0)
+        assert bus.get_queue_sizes() == {'AdBotInactivityTimeout': 2}
+
+        publish_task = asyncio.create_task(
+            bus.publish(events.AdBotInactivityTimeout(4))
+        )
+        await asyncio.sleep(0.01)
+        assert not publish_task.done()  # producer waits
+
+        release.set()
+        await asyncio.wait_for(publish_task, 1)
+        await bus.wait_for_tasks_done()
+    finally:
+        bus.stop()
+
+    assert handled == [0, 1, 2, 3, 4]
+
+
+@pytest.mark.asyncio
+async def test_post_event_doesnt_lose_events_when_queue_is_full():
+    bus = mb.MessageBus(workers=1, queue_size=1)
+    handled = []
+    async def handler(event: mb.AdBotEvent):
+        await asyncio.sleep(0.001)
+        handled.append(event.user_id)
+    bus.subscribe([events.AdBotInactivityTimeout], handler)
+
+    try:
+        for i in range(5):
+            bus.post_event(events.AdBotInactivityTimeout(i))
+        await bus.wait_for_tasks_done()
+    finally:
+        bus.stop()
+
+    assert sorted(handled) == list(range(5))
+
+
+@pytest.mark.asyncio
+async def test_post_events_to_handlers_of_base_class():
+    bus = mb.MessageBus()
+    base_handler = FakeSubscriber()
+    handler = FakeSubscriber()
+    bus.subscribe([events.AdBotEvent], base_handler.handler)
+    bus.subscribe(
+        [events.AdBotEvent, events.AdBotInactivityTimeout], handler.handler
+    )
+
+    event1 = events.AdBotInactivityTimeout(2)
+    event2 = events.AdBotCriticalError('critical')
+    bus.post_event(event1)
+    bus.post_event(event2)
+    await asyncio.sleep(0.00000001)     # Give time to process asyncio tasks
+
+    assert base_handler._catched_events == [str(event1), str(event2)]
+    assert handler._catched_events == [str(event1), str(event2)]   # handled once
+
+
+@pytest.mark.asyncio
+async def test_post_events_after_new_subscription():
+    bus = mb.MessageBus()
+    handler1 = FakeSubscriber()
+    handler2 = FakeSubscriber()
+    bus.subscribe([events.AdBotInactivityTimeout], handler1.handler)
+    bus.post_event(events.AdBotInactivityTimeout(1))
+
+    bus.subscribe([events.AdBotInactivityTimeout], handler2.handler)
+    bus.post_event(events.AdBotInactivityTimeout(2))
+    await asyncio.sleep(0.00000001)     # Give time to process asyncio tasks
+
+    assert len(handler1._catched_events) == 2
+    assert len(handler2._catched_events) == 1
+
+
+@pytest.mark.asyncio
+async def test_partitions_events_with_same_key_handled_in_order():
+    bus = mb.MessageBus(partitions=4)
+    handled = []
+    running = set()
+    max_running = 0
+    async def handler(event: mb.AdBotEvent):
+        nonlocal max_running
+        assert event.user_id not in running     # one event of user at a time
+        running.add(event.user_id)
+        max_running = max(max_running, len(running))
+        await asyncio.sleep(0.001 * (event.user_id + 1))
+        handled.append((event.user_id, int(event.message_url)))
+        running.remove(event.user_id)
+    bus.subscribe([events.AdBotMessageForwardRequest], handler)
+
+    try:
+        for i in range(12):
+            await bus.publish(events.AdBotMessageForwardRequest(i % 3, 0, str(i), ''))
+        await bus.wait_for_tasks_done()
+    finally:
+        bus.stop()
+
+    for user_id in range(3):
+        user_events = [i for uid, i in handled if uid == user_id]
+        assert user_events == sorted(user_events)
+        assert len(user_events) == 4
+    assert max_running > 1      # different keys are handled concurrently
+
+
+@pytest.mark.asyncio
+async def test_partitions_keep_order_of_user_events():
+    bus = mb.MessageBus(partitions=2)
+    handled = []
+    async def handler(event: mb.AdBotEvent):
+        await asyncio.sleep(0.005 if event.message_url == '1' else 0)
+        handled.append((event.user_id, event.message_url))
+    bus.subscribe([events.AdBotMessageForwardRequest], handler)
+
+    try:
+        for url in ('1', '2', '3'):
+            bus.post_event(events.AdBotMessageForwardRequest(1, 1, url, ''))
+        await bus.wait_for_tasks_done()
+    finally:
+        bus.stop()
+
+    assert handled == [(1, '1'), (1, '2'), (1, '3')]
+
+
+@pytest.mark.asyncio
+async def test_partitions_keep_order_of_key_events_waiting_for_free_lane():
+    bus = mb.MessageBus(partitions=1)
+    release = asyncio.Event()
+    handled = []
+    async def handler(event: mb.AdBotEvent):
+        if event.user_id == 1:
+            await release.wait()
+        handled.append(f'{event.user_id}-{event.message_url}')
+    bus.subscribe([events.AdBotMessageForwardRequest], handler)
+
+    try:
+        bus.post_event(events.AdBotMessageForwardRequest(1, 1, '0', ''))
+        await asyncio.sleep(0.001)      # the only lane is busy
+        bus.post_event(events.AdBotMessageForwardRequest(2, 2, '1', ''))
+        await bus.publish(events.AdBotMessageForwardRequest(2, 2, '2', ''))
+        await asyncio.sleep(0.001)
+        bus.post_event(events.AdBotMessageForwardRequest(2, 2, '3', ''))
+        release.set()
+        await bus.wait_for_tasks_done()
+    finally:
+        bus.stop()
+
+    assert handled == ['1-0', '2-1', '2-2', '2-3']
+
+
+@pytest.mark.asyncio
+async def test_partitions_heavy_key_doesnt_block_other_keys():
+    bus = mb.MessageBus(partitions=4)
+    handled = []
+    async def handler(event: mb.AdBotEvent):
+        await asyncio.sleep(0.01)
+        handled.append(event.user_id)
+    bus.subscribe([events.AdBotMessageForwardRequest], handler)
+
+    try:
+        for i in range(10):
+            await bus.publish(events.AdBotMessageForwardRequest(1, 1, str(i), ''))
+        await bus.publish(events.AdBotMessageForwardRequest(5, 5, '0', ''))
+        await bus.wait_for_tasks_done()
+    finally:
+        bus.stop()
+
+    assert handled.index(5) < 2     # doesn't wait for events of user 1
+
+
+@pytest.mark.asyncio
+async def test_partitions_interactive_events_dont_wait_for_bulk_events():
+    bus = mb.MessageBus(partitions=1)
+    handled = []
+    async def handler(event: mb.AdBotEvent):
+        await asyncio.sleep(0.01)
+        handled.append(event.__class__.__name__)
+    bus.subscribe(
+        [events.AdBotMessageForwardRequest, events.AdBotUserDataUpdated], handler
+    )
+
+    try:
+        for user_id in (1, 2):
+            for i in range(3):
+                bus.post_event(events.AdBotMessageForwardRequest(user_id, 1, str(i), ''))
+        bus.post_event(events.AdBotUserDataUpdated(2))
+        await bus.wait_for_tasks_done()
+    finally:
+        bus.stop()
+
+    assert handled.index('AdBotUserDataUpdated') < 2
+    assert len(handled) == 7
+
+
+@pytest.mark.asyncio
+async def test_partitions_respect_workers_limit():
+    bus = mb.MessageBus(workers=2, partitions=10)
+    running = 0
+    max_running = 0
+    handled = []
+    async def handler(event: mb.AdBotEvent):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.005)
+        handled.append(event.__class__.__name__)
+        running -= 1
+    bus.subscribe(
+        [events.AdBotMessageForwardRequest, events.AdBotInactivityTimeout], handler
+    )
+
+    try:
+        for user_id in range(6):
+            await bus.publish(events.AdBotMessageForwardRequest(user_id, 1, '', ''))
+        await bus.publish(events.AdBotInactivityTimeout(1))
+        await bus.wait_for_tasks_done()
+    finally:
+        bus.stop()
+
+    assert max_running == 2
+    assert len(handled) == 7
+    # Interactive events get free workers before waiting bulk events
+    assert handled.index('AdBotInactivityTimeout') < 4
+
+
+@pytest.mark.asyncio
+async def test_failed_handler_goes_to_dead_letters():
+    bus = mb.MessageBus(max_retries=2)
+    calls = 0
+    async def handler(event: mb.AdBotEvent):
+        nonlocal calls
+        calls += 1
+        raise ValueError('error')
+    bus.subscribe([events.AdBotInactivityTimeout], handler)
+
+    event = events.AdBotInactivityTimeout(1)
+    bus.post_event(event)
+    await bus.wait_for_tasks_done()
+
+    assert calls == 3
+    assert len(bus.dead_letters) == 1
+    dead_letter = bus.dead_letters[0]
+    assert dead_letter.event == event
+    assert dead_letter.handler == handler
+    assert isinstance(dead_letter.error, ValueError)
+    assert dead_letter.retries == 2
+
+    assert await bus.retry_dead_letters() == 1
+    await bus.wait_for_tasks_done()
+    assert calls == 4
+    assert bus.dead_letters[0].retries == 3
@@ -0,0 +1,127 @@
+import pytest
+
+from sqlalchemy import inspect, text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from adbot.domain import migrations
+
+
+OLD_SCHEMA = [
+    "CREATE TABLE user_account (id INTEGER NOT NULL PRIMARY KEY, telegram_id INTEGER, " \
+        "telegram_name VARCHAR(32), subscription_state BOOLEAN, " \
+        "forwarding_state BOOLEAN, menu_closed BOOLEAN)",
+    "CREATE TABLE keyword (id INTEGER NOT NULL PRIMARY KEY, word VARCHAR(50) UNIQUE)",
+    "CREATE TABLE chat_message (id INTEGER NOT NULL PRIMARY KEY, " \
+        "source_id INTEGER NOT NULL, cat_id INTEGER NOT NULL, processed BOOLEAN, " \
+        "text TEXT NOT NULL, url VARCHAR(120) NOT NULL, text_hash VARCHAR(16) NOT NULL)",
+    "CREATE TABLE user_keyword_link (user_id INTEGER NOT NULL, " \
+        "keyword_id INTEGER NOT NULL, PRIMARY KEY (user_id, keyword_id))",
+    "CREATE TABLE user_message_link (user_id INTEGER NOT NULL, " \
+        "message_id INTEGER NOT NULL, PRIMARY KEY (user_id, message_id))",
+    "INSERT INTO chat_message (id, source_id, cat_id, processed, text, url, text_hash) " \
+        "VALUES (1, 0, 0, 0, 'some text', 'https://t.me/c/1/1', 'abc')",
+]
+
+
+def _get_schema(conn):
+    insp = inspect(conn)
+    columns = {c['name'] for c in insp.get_columns('chat_message')}
+    indexes = {
+        index['name']
+            for table in insp.get_table_names() for index in insp.get_indexes(table)
+    }
+    return columns, indexes
+
+
+@pytest.mark.asyncio
+async def test_migrations_upgrade_existing_db():
+    engine = create_async_engine('sqlite+aiosqlite:///:memory:')
+    async with engine.begin() as conn:
+        for st in OLD_SCHEMA:
+            await conn.execute(text(st))
+
+    async with engine.begin() as conn:
+        version = await conn.run_sync(migrations.run_migrations)
+    assert version == migrations.LATEST_VERSION
+
+    async with engine.begin() as conn:
+        columns, indexes = await conn.run_sync(_get_schema)
+        assert {'fetched_dt', 'added_dt', 'processed_dt', 'minhash'} <= columns
+        assert {
+            'ix_chat_message_unprocessed', 'ix_chat_message_text_hash',
+            'ix_user_account_telegram_id', 'ix_user_account_forwarding',
+            'ix_user_message_link_message_id', 'ix_outbox_state_due_dt'
+        } <= indexes
+        res = (await conn.execute(text("SELECT text, added_dt FROM chat_message"))).all()
+        assert res[0][0] == 'some text'     # data is not lost
+        assert res[0][1] is not None
+        user_columns = await conn.run_sync(
+            lambda c: {col['name'] for col in inspect(c).get_columns('user_account')}
+        )
+        assert {'digest_mode', 'digest_sent_dt'} <= user_columns
+        res = await conn.execute(text("SELECT version FROM schema_version"))
+        assert res.scalar() == migrations.LATEST_VERSION
+
+    # Second run does nothing
+    async with engine.begin() as conn:
+        version = await conn.run_sync(migrations.run_migrations)
+    assert version == migrations.LATEST_VERSION
+
+
+def _get_full_schema(conn):
+    insp = inspect(conn)
+    return {
+        table: (
+            {(c['name'], str(c['type']), c['nullable']) for c in insp.get_columns(table)},
+            {
+                (i['name'], tuple(i['column_names']))
+                    for i in insp.get_indexes(table)
+            }
+        ) for table in insp.get_table_names()
+    }
+
+
+@pytest.mark.asyncio
+async def test_migrations_upgraded_db_matches_new_db():
+    upgraded_engine = create_async_engine('sqlite+aiosqlite:///:memory:')
+    async with upgraded_engine.begin() as conn:
+        for st in OLD_SCHEMA:
+            await conn.execute(text(st))
+        await conn.run_sync(migrations.run_migrations)
+        upgraded_schema = await conn.run_sync(_get_full_schema)
+
+    new_engine = create_async_engine('sqlite+aiosqlite:///:memory:')
+    async with new_engine.begin() as conn:
+        await conn.run_sync(migrations.run_migrations)
+        new_schema = await conn.run_sync(_get_full_schema)
+
+    assert upgraded_schema.keys() == new_schema.keys()
+    for table in ('chat_message', 'user_account', 'user_message_link'):
+        # columns of old tables can differ in types and nullability
+        assert {c[0] for c in upgraded_schema[table][0]} == \
+            {c[0] for c in new_schema[table][0]}
+        assert upgraded_schema[table][1] == new_schema[table][1]
+    for table in ('outbox', 'keywords_generation'):
+        assert upgraded_schema[table] == new_schema[table]
+
+
+@pytest.mark.asyncio
+async def test_migrations_new_db_created_with_latest_version():
+    engine = create_async_engine('sqlite+aiosqlite:///:memory:')
+    applied = []
+    old_migrations = migrations.MIGRATIONS
+    migrations.MIGRATIONS = [
+        (version, lambda conn, v=version: applied.append(v))
+            for version, _ in old_migrations
+    ]
+    try:
+        async with engine.begin() as conn:
+            version = await conn.run_sync(migrations.run_migrations)
+    finally:
+        migrations.MIGRATIONS = old_migrations
+
+    assert version == migrations.LATEST_VERSION
+    assert applied == []
+    async with engine.begin() as conn:
+        _, indexes = await conn.run_sync(_get_schema)
+        assert 'ix_chat_message_unprocessed' in indexes
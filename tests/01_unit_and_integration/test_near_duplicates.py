@@ -0,0 +1,77 @@
+from datetime import datetime, timedelta
+
+from adbot.domain import minhash
+from adbot.domain.near_duplicates import NearDuplicate, NearDuplicatesIndex, lsh_params
+
+AD_TEXT = 'Продаю велосипед Trek Marlin 7, размер рамы L, отличное состояние, ' \
+    'цена 450 евро, торг уместен. Будва, самовывоз. Пишите в личку'
+OTHER_AD_TEXT = 'Сдается квартира в Баре, две спальни, вид на море, 600 евро в ' \
+    'месяц, долгосрочно'
+
+
+def test_minhash_similarity():
+    sig = minhash.minhash(AD_TEXT)
+
+    assert minhash.similarity(sig, minhash.minhash(AD_TEXT + ' 🔥🔥')) == 1
+    assert minhash.similarity(sig, minhash.minhash(AD_TEXT.replace('450', '400'))) > 0.7
+    assert minhash.similarity(sig, minhash.minhash(OTHER_AD_TEXT)) < 0.3
+
+
+def test_minhash_short_text_has_no_signature():
+    assert minhash.minhash('apple banana orange') is None
+
+
+def test_minhash_many_same_as_minhash():
+    texts = [AD_TEXT, 'short', OTHER_AD_TEXT]
+    assert minhash.minhash_many(texts) == [minhash.minhash(text) for text in texts]
+
+
+def test_minhash_to_bytes_from_bytes():
+    sig = minhash.minhash(AD_TEXT)
+    assert minhash.from_bytes(minhash.to_bytes(sig)) == sig
+    assert minhash.from_bytes(minhash.to_bytes(None)) is None
+
+
+def test_near_duplicates_index_find():
+    index = NearDuplicatesIndex(0.7)
+    now = datetime.now()
+    index.add(NearDuplicate(1, minhash.minhash(AD_TEXT), now, {1}))
+    index.add(NearDuplicate(2, minhash.minhash(OTHER_AD_TEXT), now, {2}))
+
+    found = index.find(minhash.minhash(AD_TEXT.replace('450', '400')))
+    assert [entry.msg_id for entry in found] == [1]
+
+    index.remove(1)
+    assert index.find(minhash.minhash(AD_TEXT)) == []
+
+
+def test_near_duplicates_index_evict():
+    index = NearDuplicatesIndex(0.7)
+    now = datetime.now()
+    index.add(NearDuplicate(1, minhash.minhash(AD_TEXT), now - timedelta(hours=2), {1}))
+    index.add(NearDuplicate(2, minhash.minhash(OTHER_AD_TEXT), now, {2}))
+
+    index.evict(now - timedelta(hours=1))
+
+    assert len(index) == 1
+    assert index.find(minhash.minhash(AD_TEXT)) == []
+    assert len(index.find(minhash.minhash(OTHER_AD_TEXT))) == 1
+
+
+def test_near_duplicates_index_evict_entries_added_out_of_order():
+    index = NearDuplicatesIndex(0.7)
+    now = datetime.now()
+    index.add(NearDuplicate(1, minhash.minhash(OTHER_AD_TEXT), now, {2}))
+    index.add(NearDuplicate(2, minhash.minhash(AD_TEXT), now - timedelta(hours=2), {1}))
+
+    index.evict(now - timedelta(hours=1))
+
+    assert len(index) == 1
+    assert index.find(minhash.minhash(AD_TEXT)) == []
+
+
+def test_lsh_params_depend_on_threshold():
+    assert lsh_params(0.7) == (8, 4)
+    bands, rows = lsh_params(0.9)
+    assert bands * rows <= minhash.NUM_PERM
+    assert rows > 4     # higher threshold - longer bands, less candidates
@@ -0,0 +1,202 @@
+import asyncio
+import time
+from unittest.mock import AsyncMock, Mock
+
+import pytest
+
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import GetUpdates, SendMessage
+
+from adbot.presentation.telegram.sender import (
+    LANE_BULK, LANE_INTERACTIVE, LaneRequestMiddleware, RateLimitedSender, TokenBucket
+)
+
+
+def test_token_bucket_reserve():
+    bucket = TokenBucket(rate=10, capacity=2)
+    delays = [bucket.reserve() for _ in range(4)]
+    assert delays[0] == delays[1] == 0
+    assert delays[2] == pytest.approx(0.1, abs=0.01)
+    assert delays[3] == pytest.approx(0.2, abs=0.01)
+
+
+def test_token_bucket_pause():
+    bucket = TokenBucket(rate=10, capacity=2)
+    bucket.pause(1)
+    assert bucket.reserve() == pytest.approx(1.1, abs=0.01)
+    assert not bucket.is_idle()
+
+
+@pytest.mark.asyncio
+async def test_sender_respects_chat_rate():
+    sent = []
+    bot = AsyncMock()
+    bot.send_message.side_effect = lambda chat_id, text: sent.append(
+        (chat_id, time.monotonic())
+    )
+    sender = RateLimitedSender(bot, chat_rate=20)
+    try:
+        await asyncio.gather(
+            *[sender.send_message(1, 'text') for _ in range(3)],
+            sender.send_message(2, 'text')
+        )
+    finally:
+        sender.stop()
+
+    chat_1_times = [t for chat_id, t in sent if chat_id == 1]
+    assert len(chat_1_times) == 3
+    assert chat_1_times[2] - chat_1_times[0] >= 0.09    # 2 intervals of 0.05 s
+    assert [chat_id for chat_id, _ in sent][0:2] == [1, 2]  # chat 2 is not blocked
+
+
+@pytest.mark.asyncio
+async def test_sender_calls_on_start_when_message_is_taken():
+    calls = []
+    bot = AsyncMock()
+    bot.send_message.side_effect = lambda chat_id, text: calls.append(('send', text))
+    sender = RateLimitedSender(bot, chat_rate=20)
+    try:
+        await asyncio.gather(*[
+            sender.send_message(
+                1, str(i), on_start=lambda i=i: calls.append(('start', i))
+            )
+                for i in range(2)
+        ])
+    finally:
+        sender.stop()
+
+    assert calls == [('start', 0), ('send', '0'), ('start', 1), ('send', '1')]
+
+
+@pytest.mark.asyncio
+async def test_sender_bounded_workers():
+    running = 0
+    max_running = 0
+    async def send_message(chat_id, text):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+
+    bot = AsyncMock()
+    bot.send_message.side_effect = send_message
+    sender = RateLimitedSender(bot, workers=2, global_rate=1000)
+    try:
+        await asyncio.gather(*[sender.send_message(i, 'text') for i in range(10)])
+    finally:
+        sender.stop()
+
+    assert bot.send_message.await_count == 10
+    assert max_running == 2
+
+
+@pytest.mark.asyncio
+async def test_sender_retries_after_flood_limit():
+    bot = AsyncMock()
+    bot.send_message.side_effect = [
+        TelegramRetryAfter(method=Mock(), message='Flood', retry_after=0.1), 'result'
+    ]
+    sender = RateLimitedSender(bot)
+    try:
+        start = time.monotonic()
+        assert await sender.send_message(1, 'text') == 'result'
+        assert time.monotonic() - start >= 0.1
+    finally:
+        sender.stop()
+
+
+@pytest.mark.asyncio
+async def test_sender_reraises_exceptions():
+    bot = AsyncMock()
+    bot.send_message.side_effect = ValueError()
+    sender = RateLimitedSender(bot)
+    try:
+        with pytest.raises(ValueError):
+            await sender.send_message(1, 'text')
+    finally:
+        sender.stop()
+
+
+@pytest.mark.asyncio
+async def test_sender_interactive_lane_before_bulk():
+    sent = []
+    async def request(name):
+        sent.append(name)
+        await asyncio.sleep(0.01)
+
+    sender = RateLimitedSender(AsyncMock(), workers=1, global_rate=1000)
+    try:
+        bulk = [
+            asyncio.create_task(sender.submit(i, lambda i=i: request(f'bulk {i}')))
+                for i in range(5)
+        ]
+        await asyncio.sleep(0.001)
+        assert sender.get_queue_depth() == {LANE_INTERACTIVE: 0, LANE_BULK: 5}
+        await sender.submit(1, lambda: request('interactive'), LANE_INTERACTIVE)
+        await asyncio.gather(*bulk)
+    finally:
+        sender.stop()
+
+    assert sent[:2] == ['bulk 0', 'interactive']
+    assert sender.get_queue_depth() == {LANE_INTERACTIVE: 0, LANE_BULK: 0}
+
+
+@pytest.mark.asyncio
+async def test_sender_lanes_have_own_rate_limits():
+    sent = {}
+    bot = AsyncMock()
+    bot.send_message.side_effect = lambda chat_id, text: sent.setdefault(
+        text, []
+    ).append(time.monotonic())
+    sender = RateLimitedSender(
+        bot, global_rate=1000,
+        lane_limits={LANE_INTERACTIVE: (1000, 10), LANE_BULK: (20, 1)}
+    )
+    try:
+        await asyncio.gather(
+            *[sender.send_message(i, 'bulk') for i in range(3)],
+            *[sender.send_message(1, 'interactive', LANE_INTERACTIVE) for _ in range(3)]
+        )
+    finally:
+        sender.stop()
+
+    assert sent['bulk'][2] - sent['bulk'][0] >= 0.09    # 2 intervals of 0.05 s
+    # Interactive lane isn't limited by bulk lane limit and chat rate
+    assert sent['interactive'][2] - sent['interactive'][0] < 0.05
+
+
+@pytest.mark.asyncio
+async def test_lane_request_middleware():
+    bot = AsyncMock()
+    sender = RateLimitedSender(bot)
+    middleware = LaneRequestMiddleware(sender)
+    lanes = []
+    submit = sender.submit
+    async def submit_spy(chat_id, request, lane=LANE_BULK):
+        lanes.append(lane)
+        return await submit(chat_id, request, lane)
+    sender.submit = submit_spy
+    make_request = AsyncMock(return_value='result')
+
+    try:
+        # Request to chat goes through interactive lane
+        method = SendMessage(chat_id=1, text='text')
+        assert await middleware(make_request, bot, method) == 'result'
+        assert lanes == [LANE_INTERACTIVE]
+        make_request.assert_awaited_once_with(bot, method)
+
+        # Other requests are passed through
+        assert await middleware(make_request, bot, GetUpdates()) == 'result'
+        assert lanes == [LANE_INTERACTIVE]
+
+        # Requests made by sender's workers are passed through
+        async def send_message(chat_id, text):
+            return await middleware(
+                make_request, bot, SendMessage(chat_id=chat_id, text=text)
+            )
+        bot.send_message.side_effect = send_message
+        assert await sender.send_message(1, 'text') == 'result'
+        assert lanes == [LANE_INTERACTIVE, LANE_BULK]
+    finally:
+        sender.stop()
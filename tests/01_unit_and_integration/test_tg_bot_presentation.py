@@ -3,6 +3,9 @@ from datetime import datetime, timedelta
 import pytest
 from unittest.mock import AsyncMock, patch
 
+from aiogram.exceptions import TelegramNetworkError
+from aiogram.methods import SendMessage
+from aiogram_dialog.test_tools import BotClient
 from aiogram_dialog.test_tools.keyboard import InlineButtonTextLocator
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
@@ -27,6 +30,40 @@ async def test_first_start_cmd_creates_user(env: Env):
     assert user.telegram_id == env.client.user.id
 
 
+@pytest.mark.asyncio
+async def test_user_is_resolved_once_per_update(env: Env):
+    await env.client.send("/start")
+    message = env.message_manager.one_message()
+    env.message_manager.reset_history()
+
+    srv = env.ad_bot_srv
+    with patch.object(
+        srv, 'get_user_by_telegram_id', wraps=srv.get_user_by_telegram_id
+    ) as get_user:
+        await env.client.click(message, InlineButtonTextLocator('Enable subscription'))
+        assert get_user.await_count == 1
+
+    assert env.message_manager.one_message().text.find('✅ enabled') > 0
+
+
+@pytest.mark.asyncio
+async def test_group_chat_message_doesnt_create_user(env: Env):
+    group_client = BotClient(
+        env.tg_bot._dp, env.client.user.id, -100123, chat_type='supergroup'
+    )
+    with patch.object(
+        env.ad_bot_srv, 'get_user_by_telegram_id',
+        wraps=env.ad_bot_srv.get_user_by_telegram_id
+    ) as get_user:
+        await group_client.send('some text')
+        assert get_user.await_count == 0
+
+    async with env.ad_bot_srv._db_pool() as session:
+        session: AsyncSession
+        users = (await session.scalars(select(models.User))).all()
+    assert len(users) == 0
+
+
 @pytest.mark.asyncio
 async def test_second_start_cmd_doesnt_create_duplicate_of_user(env: Env):
     await env.client.send("/start")
@@ -192,6 +229,27 @@ async def test_subcription_disable_click(env: Env):
     assert second_message.text.find('☑ disabled')  > 0
 
 
+@pytest.mark.asyncio
+async def test_digest_mode_toggle_click(env: Env):
+    await env.ad_bot_srv.create_user_by_telegram_data(
+        env.client.user.id, env.client.user.full_name
+    )
+    await env.client.send('/menu')
+
+    message = env.message_manager.one_message()
+    assert message.text.find('Digest mode:</b> ☑ disabled') > 0
+
+    env.message_manager.reset_history()
+    callback_id = await env.client.click(
+        message, InlineButtonTextLocator('Enable digest mode'),
+    )
+    env.message_manager.assert_answered(callback_id)
+    second_message = env.message_manager.one_message()
+    assert second_message.text.find('Digest mode:</b> ✅ enabled') > 0
+    user = await env.ad_bot_srv.get_user_by_telegram_id(env.client.user.id)
+    assert user.digest_mode == True
+
+
 @pytest.mark.asyncio
 async def test_subcription_toogle_click_shows_error_msg_on_sql_error(env: Env):
     # Open menu
@@ -331,6 +389,8 @@ async def test_show_in_menu_number_of_messages_in_the_queue(env: Env):
         user.forward_queue.append(msg)
         session.add(user)
         await session.commit()
+        # links were added bypassing services, reload counters as on startup
+        await env.ad_bot_srv._load_forward_queue_lens(session)
 
     # Open menu and check
     await env.client.send('/menu')
@@ -366,6 +426,53 @@ async def test_MessageForwardRequest_event_handler_sends_message(env: Env):
     )
 
 
+@pytest.mark.asyncio
+async def test_MessageForwardRequest_event_handler_records_latency(env: Env):
+    event = events.AdBotMessageForwardRequest(
+        user_id=1, telegram_id=env.client.user.id, message_url='https://t.me',
+        message_text='some text', added_dt=datetime.now() - timedelta(seconds=10),
+        requested_dt=datetime.now() - timedelta(seconds=1)
+    )
+    await env.tg_bot.user_message_forward_request_handler(event)
+
+    stats = env.ad_bot_srv.get_latency_stats()
+    assert stats['forward_to_send']['count'] == 1
+    assert 1 <= stats['forward_to_send']['max'] < 2
+    assert 10 <= stats['total']['max'] < 11
+
+
+@pytest.mark.asyncio
+async def test_MessageForwardRequest_event_handler_acknowledges_delivery(env: Env):
+    event = events.AdBotMessageForwardRequest(
+        user_id=1, telegram_id=env.client.user.id, message_url='https://t.me/c/1/1',
+        message_text='text', outbox_id=123
+    )
+    await env.tg_bot.user_message_forward_request_handler(event)
+    assert env.ad_bot_srv._outbox_sent_ids == [123]
+
+    env.tg_bot._bot.send_message.side_effect = TelegramNetworkError(
+        method=SendMessage(chat_id=env.client.user.id, text=''), message='timeout'
+    )
+    event.outbox_id = 124
+    await env.tg_bot.user_message_forward_request_handler(event)
+    assert env.ad_bot_srv._outbox_failed == {124: True}
+
+
+@pytest.mark.asyncio
+async def test_DigestForwardRequest_event_handler_sends_one_message(env: Env):
+    event = events.AdBotDigestForwardRequest(
+        user_id=1, telegram_id=env.client.user.id,
+        message_urls=['https://t.me/c/1/1', 'https://t.me/c/1/2']
+    )
+    await env.tg_bot.user_digest_forward_request_handler(event)
+
+    env.tg_bot._bot.send_message.assert_awaited_once_with(
+        env.client.user.id,
+        '✉ 2 new messages:\nhttps://t.me/c/1/1\nhttps://t.me/c/1/2',
+        disable_web_page_preview=True
+    )
+
+
 # ========================================================================================
 # Idle timeout event, close_dialog cmd
 
@@ -463,6 +570,8 @@ async def test_refreshdialog_cmd_updates_data_in_window(env: Env):
         )
         user.forward_queue.append(msg)
         await session.commit()
+        # links were added bypassing services, reload counters as on startup
+        await env.ad_bot_srv._load_forward_queue_lens(session)
     env.message_manager.reset_history()
     await env.client.send('/refresh_dialog')
 
@@ -0,0 +1,57 @@
+from adbot.domain import models
+from adbot.domain.user_cache import UserCache
+
+
+def _user(user_id: int, telegram_id: int) -> models.User:
+    return models.User(id=user_id, telegram_id=telegram_id, telegram_name=f'u{user_id}')
+
+
+def test_user_cache_get_by_id_and_telegram_id():
+    cache = UserCache()
+    user = _user(1, 100)
+    cache.put(user, cache.generation)
+
+    assert cache.get_by_id(1) is user
+    assert cache.get_by_telegram_id(100) is user
+    assert cache.get_by_id(2) is None
+    assert cache.get_by_telegram_id(200) is None
+
+
+def test_user_cache_evicts_least_recently_used():
+    cache = UserCache(max_size=2)
+    cache.put(_user(1, 100), cache.generation)
+    cache.put(_user(2, 200), cache.generation)
+    cache.get_by_id(1)
+    cache.put(_user(3, 300), cache.generation)
+
+    assert len(cache) == 2
+    assert cache.get_by_id(1) is not None
+    assert cache.get_by_id(2) is None
+    assert cache.get_by_telegram_id(200) is None
+    assert cache.get_by_id(3) is not None
+
+
+def test_user_cache_ttl():
+    cache = UserCache(ttl_sec=0)
+    cache.put(_user(1, 100), cache.generation)
+
+    assert cache.get_by_id(1) is None
+    assert len(cache) == 0
+
+
+def test_user_cache_invalidate():
+    cache = UserCache()
+    cache.put(_user(1, 100), cache.generation)
+    cache.invalidate(1)
+
+    assert cache.get_by_id(1) is None
+    assert cache.get_by_telegram_id(100) is None
+
+
+def test_user_cache_put_skipped_after_invalidation():
+    cache = UserCache()
+    generation = cache.generation   # user is being read from DB
+    cache.invalidate(1)             # user is updated meanwhile
+    cache.put(_user(1, 100), generation)
+
+    assert cache.get_by_id(1) is None
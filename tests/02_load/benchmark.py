@@ -0,0 +1,295 @@
+"""
+    Benchmark of messages processing pipeline (`add_message`, `_process_messages`,
+    `_forward_messages`) on synthetic reproducible corpora.
+
+    Run:
+        PYTHONPATH=src python tests/02_load/benchmark.py [--scale small|medium|large]
+            [--db memory|file] [--baseline PATH] [--save-baseline]
+
+    Reports throughput, p50/p99 latency and SQL statements count for every phase and
+    peak RSS. Results are compared with the baseline (stored in JSON file, one entry
+    per scale and DB type), regressions are marked.
+"""
+import argparse
+import asyncio
+from dataclasses import dataclass
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from typing import Optional
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from adbot.domain import events, models
+from adbot.domain.services import AdBotServices
+
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'benchmark_baseline.json')
+REGRESSION_THRESHOLD = 0.2  # metric is marked as regression if it's 20% worse
+
+SCALES = {
+    # users, keywords, messages
+    'small': (50, 200, 1000),
+    'medium': (200, 1000, 10000),
+    'large': (1000, 5000, 50000),
+}
+
+ITEMS = [
+    'велосипед', 'самокат', 'ноутбук', 'монитор', 'телефон', 'диван', 'холодильник',
+    'стиральная машина', 'коляска', 'автокресло', 'шкаф', 'кровать', 'телевизор',
+    'bicycle', 'laptop', 'monitor', 'iphone', 'sofa', 'fridge', 'stroller', 'scooter',
+]
+BRANDS = [
+    'Trek', 'Xiaomi', 'Samsung', 'Apple', 'Lenovo', 'Bosch', 'IKEA', 'LG', 'Cybex',
+    'Giant', 'Dell', 'Sony', 'Philips', 'Cube', 'Asus',
+]
+CITIES = ['Будва', 'Бар', 'Подгорица', 'Тиват', 'Котор', 'Херцег-Нови', 'Budva', 'Bar']
+CONDITIONS = ['отличное', 'хорошее', 'новое', 'как новый', 'excellent', 'good', 'new']
+TEMPLATES = [
+    'Продаю {item} {brand} {model}, состояние {cond}, цена {price} евро. {city}, ' \
+        'самовывоз. {extra}',
+    'Selling {item} {brand} {model}, condition {cond}, {price} EUR, {city}. {extra}',
+    'Отдам {item} {brand} {model} в {city}, {cond} состояние. Пишите в личку. {extra}',
+    'Куплю {item} {brand} {model} до {price} евро, {city}. {extra}',
+    'Сдается квартира в {city}, {price} евро в месяц. Есть {item}, {extra}',
+]
+
+
+@dataclass
+class Corpus:
+    users_keywords: list[list[str]]     # keywords of every user
+    messages: list[str]
+
+
+def _zipf_weights(n: int, s: float) -> list[float]:
+    return [1 / (rank ** s) for rank in range(1, n + 1)]
+
+
+def generate_corpus(
+    users_cnt: int, keywords_cnt: int, messages_cnt: int, seed: int = 20230901,
+    zipf_s: float = 1.1, keywords_per_user: int = 5
+) -> Corpus:
+    """
+        Generates reproducible corpus: keywords with Zipf-distributed popularity (both
+        among users's keywords and in messages), users's keyword lists and ad-like
+        messages.
+    """
+    rnd = random.Random(seed)
+    base = ITEMS + [brand.lower() for brand in BRANDS]
+    keywords = list(base)
+    while len(keywords) < keywords_cnt:
+        keywords.append(f'{rnd.choice(base)}{len(keywords)}')
+    keywords = keywords[:keywords_cnt]
+    rnd.shuffle(keywords)           # popularity rank doesn't depend on the word
+    weights = _zipf_weights(keywords_cnt, zipf_s)
+
+    users_keywords = []
+    for _ in range(users_cnt):
+        user_keywords = set(rnd.choices(keywords, weights, k=keywords_per_user))
+        users_keywords.append(sorted(user_keywords))
+
+    messages = []
+    for _ in range(messages_cnt):
+        extra = ' '.join(rnd.choices(keywords, weights, k=rnd.randint(0, 2)))
+        messages.append(rnd.choice(TEMPLATES).format(
+            item=rnd.choice(keywords),
+            brand=rnd.choice(BRANDS),
+            model=f'{rnd.choice("ABCDEFGHKMXZ")}{rnd.randint(1, 999)}',
+            cond=rnd.choice(CONDITIONS),
+            price=rnd.randint(5, 3000),
+            city=rnd.choice(CITIES),
+            extra=extra
+        ))
+    return Corpus(users_keywords, messages)
+
+
+def _percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def _phase_result(
+    items_cnt: int, total_sec: float, latencies: list[float], sql_cnt: int
+) -> dict[str, float]:
+    return {
+        'items': items_cnt,
+        'throughput': (items_cnt / total_sec) if total_sec else 0.0,
+        'p50_ms': _percentile(latencies, 50) * 1000,
+        'p99_ms': _percentile(latencies, 99) * 1000,
+        'sql_statements': sql_cnt,
+    }
+
+
+async def run_benchmark(
+    corpus: Corpus, db: str = 'memory', db_path: Optional[str] = None
+) -> dict:
+    """
+        Runs benchmark on `corpus`. `db` is 'memory' (in-memory SQLite) or 'file'
+        (SQLite file, temporary file if `db_path` is not set).
+        Returns dict of results per phase and peak RSS (KB).
+    """
+    tmp_dir = None
+    if db == 'memory':
+        url = 'sqlite+aiosqlite:///:memory:'
+    else:
+        if db_path is None:
+            tmp_dir = tempfile.TemporaryDirectory()
+            db_path = os.path.join(tmp_dir.name, 'benchmark.db')
+        url = f'sqlite+aiosqlite:///{db_path}'
+
+    engine = create_async_engine(url)
+    async with engine.begin() as conn:
+        await conn.run_sync(models.Base.metadata.drop_all)
+        await conn.run_sync(models.Base.metadata.create_all)
+    db_pool = async_sessionmaker(bind=engine, expire_on_commit=False)
+
+    sql_cnt = 0
+    def count_statement(*args):
+        nonlocal sql_cnt
+        sql_cnt += 1
+    event.listen(engine.sync_engine, 'before_cursor_execute', count_statement)
+
+    try:
+        adbot_srv = await AdBotServices(db_pool)
+        forwarded = 0
+        async def forward_handler(event: events.AdBotMessageForwardRequest):
+            nonlocal forwarded
+            forwarded += 1
+            adbot_srv.record_message_sent(event)
+        adbot_srv.messagebus.subscribe(
+            [events.AdBotMessageForwardRequest], forward_handler
+        )
+
+        for i, user_keywords in enumerate(corpus.users_keywords):
+            user = await adbot_srv.create_user_by_telegram_data(1000000 + i, f'u{i}')
+            for keyword in user_keywords:
+                await adbot_srv.add_keyword(user.id, keyword)
+            await adbot_srv.set_subscription_state(user.id, True)
+            await adbot_srv.set_forwarding_state(user.id, True)
+
+        results = {}
+
+        # add_message
+        latencies = []
+        sql_cnt = 0
+        start = time.perf_counter()
+        for i, text in enumerate(corpus.messages):
+            t = time.perf_counter()
+            await adbot_srv.add_message(0, 0, text, f'https://t.me/c/1/{i}')
+            latencies.append(time.perf_counter() - t)
+        results['add_message'] = _phase_result(
+            len(corpus.messages), time.perf_counter() - start, latencies, sql_cnt
+        )
+
+        # _process_messages (latency per chunk)
+        latencies = []
+        process_messages_chunk = adbot_srv._process_messages_chunk
+        async def timed_process_messages_chunk(last_id):
+            t = time.perf_counter()
+            res = await process_messages_chunk(last_id)
+            latencies.append(time.perf_counter() - t)
+            return res
+        adbot_srv._process_messages_chunk = timed_process_messages_chunk
+        sql_cnt = 0
+        start = time.perf_counter()
+        await adbot_srv._process_messages()
+        results['process_messages'] = _phase_result(
+            len(corpus.messages), time.perf_counter() - start, latencies, sql_cnt
+        )
+
+        # _forward_messages
+        sql_cnt = 0
+        start = time.perf_counter()
+        await adbot_srv._forward_messages()
+        await adbot_srv.messagebus.wait_for_tasks_done()
+        # The rest of outbox is dispatched as acknowledgements free in-flight slots
+        while await adbot_srv._dispatch_outbox():
+            await adbot_srv.messagebus.wait_for_tasks_done()
+        await adbot_srv._flush_outbox_acks()
+        total = time.perf_counter() - start
+        results['forward_messages'] = _phase_result(forwarded, total, [total], sql_cnt)
+
+        results['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return results
+    finally:
+        await engine.dispose()
+        if tmp_dir is not None:
+            tmp_dir.cleanup()
+
+
+# Metrics to compare with baseline. True - higher is better
+COMPARED_METRICS = {
+    'throughput': True, 'p50_ms': False, 'p99_ms': False, 'sql_statements': False
+}
+
+
+def compare_with_baseline(results: dict, baseline: dict) -> list[str]:
+    """
+        Returns report lines (one line per metric) with the difference from baseline.
+        Lines of regressions (worse than baseline by more than REGRESSION_THRESHOLD)
+        start with '!'.
+    """
+    lines = []
+    for phase, phase_results in results.items():
+        if not isinstance(phase_results, dict):
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            value = phase_results[metric]
+            base = baseline.get(phase, {}).get(metric)
+            if not base:
+                lines.append(f'  {phase:18} {metric:15} {value:12.2f}')
+                continue
+            change = (value - base) / base
+            worse = (-change) if higher_is_better else change
+            mark = '!' if worse > REGRESSION_THRESHOLD else ' '
+            lines.append(
+                f'{mark} {phase:18} {metric:15} {value:12.2f} ' \
+                    f'(baseline {base:.2f}, {change:+.0%})'
+            )
+    line = f'  peak RSS, KB: {results["peak_rss_kb"]}'
+    if 'peak_rss_kb' in baseline:
+        line += f' (baseline {baseline["peak_rss_kb"]})'
+    lines.append(line)
+    return lines
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='AdBot matching pipeline benchmark')
+    parser.add_argument('--scale', choices=SCALES.keys(), default='small')
+    parser.add_argument('--db', choices=['memory', 'file'], default='memory')
+    parser.add_argument('--seed', type=int, default=20230901)
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true')
+    args = parser.parse_args(argv)
+
+    corpus = generate_corpus(*SCALES[args.scale], seed=args.seed)
+    results = asyncio.run(run_benchmark(corpus, args.db))
+
+    key = f'{args.scale}-{args.db}'
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+
+    print(f'Benchmark {key} (seed {args.seed})')
+    lines = compare_with_baseline(results, baselines.get(key, {}))
+    print('\n'.join(lines))
+
+    if args.save_baseline:
+        baselines[key] = results
+        with open(args.baseline, 'w') as f:
+            json.dump(baselines, f, indent=4)
+        print(f'Baseline saved to {args.baseline}')
+        return 0
+    return 1 if any(line.startswith('!') for line in lines) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
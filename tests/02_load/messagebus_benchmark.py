@@ -0,0 +1,91 @@
+"""
+    Micro-benchmark of `MessageBus` event dispatching (every forwarded message goes
+    through it).
+
+    Run:
+        PYTHONPATH=src python tests/02_load/messagebus_benchmark.py [--events N]
+            [--handlers N] [--other-subscribers N] [--workers N]
+
+    Reports the number of events per second for `post_event` (dispatching only) and
+    for `publish` with handling of all events.
+"""
+import argparse
+import asyncio
+import sys
+import time
+from typing import Optional
+
+from adbot.domain import events
+from adbot.domain.messagebus import MessageBus
+
+
+async def run_messagebus_benchmark(
+    events_cnt: int = 100000, handlers_cnt: int = 1, other_subscribers_cnt: int = 5,
+    workers: int = 0
+) -> dict[str, float]:
+    """
+        Posts `events_cnt` `AdBotMessageForwardRequest` events to the bus with
+        `handlers_cnt` handlers of this event and `other_subscribers_cnt` handlers of
+        other events.
+        Returns dict with events per second of `post_event` and `publish` phases.
+    """
+    bus = MessageBus(workers)
+    handled = 0
+    async def handler(event: events.AdBotEvent):
+        nonlocal handled
+        handled += 1
+    for _ in range(handlers_cnt):
+        bus.subscribe(
+            [events.AdBotMessageForwardRequest], lambda event: handler(event)
+        )
+    for _ in range(other_subscribers_cnt):
+        bus.subscribe(
+            [events.AdBotUserDataUpdated, events.AdBotInactivityTimeout],
+            lambda event: handler(event)
+        )
+    event = events.AdBotMessageForwardRequest(
+        user_id=1, telegram_id=1, message_url='https://t.me/c/1/1', message_text='text'
+    )
+
+    results = {}
+    try:
+        # Dispatching only (handlers are not run)
+        start = time.perf_counter()
+        for _ in range(events_cnt):
+            bus._get_handlers(event)
+        results['dispatch_per_sec'] = events_cnt / (time.perf_counter() - start)
+
+        # Publishing and handling
+        start = time.perf_counter()
+        for _ in range(events_cnt):
+            await bus.publish(event)
+        await bus.wait_for_tasks_done()
+        results['publish_per_sec'] = events_cnt / (time.perf_counter() - start)
+        results['handled'] = handled
+    finally:
+        bus.stop()
+    return results
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='AdBot MessageBus micro-benchmark')
+    parser.add_argument('--events', type=int, default=100000)
+    parser.add_argument('--handlers', type=int, default=1)
+    parser.add_argument('--other-subscribers', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    results = asyncio.run(run_messagebus_benchmark(
+        args.events, args.handlers, args.other_subscribers, args.workers
+    ))
+    print(
+        f'MessageBus benchmark ({args.events} events, {args.handlers} handlers, ' \
+            f'{args.other_subscribers} other subscribers, {args.workers} workers)'
+    )
+    print(f'  dispatch, events/s: {results["dispatch_per_sec"]:12.0f}')
+    print(f'  publish,  events/s: {results["publish_per_sec"]:12.0f}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
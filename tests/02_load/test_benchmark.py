@@ -0,0 +1,31 @@
+import pytest
+
+from benchmark import generate_corpus, run_benchmark, compare_with_baseline
+
+
+def test_generate_corpus_is_reproducible():
+    corpus_1 = generate_corpus(10, 50, 100, seed=1)
+    corpus_2 = generate_corpus(10, 50, 100, seed=1)
+    assert corpus_1 == corpus_2
+    assert len(corpus_1.users_keywords) == 10
+    assert len(corpus_1.messages) == 100
+    assert corpus_1 != generate_corpus(10, 50, 100, seed=2)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('db', ['memory', 'file'])
+async def test_run_benchmark_smoke(db):
+    corpus = generate_corpus(5, 30, 100)
+    results = await run_benchmark(corpus, db)
+
+    assert results['add_message']['items'] == 100
+    assert results['add_message']['sql_statements'] >= 100
+    assert results['process_messages']['throughput'] > 0
+    assert results['forward_messages']['items'] > 0
+    assert results['peak_rss_kb'] > 0
+
+    baseline = {'add_message': {'throughput': results['add_message']['throughput'] * 2}}
+    lines = compare_with_baseline(results, baseline)
+    assert [line for line in lines if line.startswith('!')] == [
+        line for line in lines if 'add_message' in line and 'throughput' in line
+    ]
@@ -0,0 +1,13 @@
+import pytest
+
+from messagebus_benchmark import run_messagebus_benchmark
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('workers', [0, 4])
+async def test_run_messagebus_benchmark_smoke(workers):
+    results = await run_messagebus_benchmark(1000, handlers_cnt=2, workers=workers)
+
+    assert results['handled'] == 2000
+    assert results['dispatch_per_sec'] > 0
+    assert results['publish_per_sec'] > 0
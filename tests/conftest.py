@@ -108,6 +108,9 @@ def env(in_memory_adbot_srv: AdBotServices) -> Env:
         def _create_bot(self, bot_token: str):
             return AsyncMock(Bot)
 
+        def _setup_request_lanes(self) -> None:
+            pass
+
         def _create_dp(
             self, redis_host: str, redis_port: int, redis_db: int
         ) -> Dispatcher:
@@ -130,6 +133,7 @@ def env(in_memory_adbot_srv: AdBotServices) -> Env:
     with patch('aiogram.types.Message.delete', new=AsyncMock()):
         with patch('aiogram.types.Message.answer', new=AsyncMock()):
             yield e 
+    e.tg_bot._sender.stop()
 
 
 # ========================================================================================
@@ -176,7 +180,6 @@ class TestableApp(AdBotApp):
         self, db_pool: async_sessionmaker
     ) -> TestableAdBotSrv:
         ad_bot_srv = await TestableAdBotSrv(db_pool)
-        ad_bot_srv._CHECK_IDLE_CYCLES = 1
         ad_bot_srv._CHECK_IDLE_INTERVAL_SEC = 1
         return ad_bot_srv
 